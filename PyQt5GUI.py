@@ -1,8 +1,325 @@
+import asyncio
 import logging.config
 import json
+import os
+import sys
+
+from PyQt5 import QtCore, QtWidgets
+from PyQt5.QtCore import Qt
+
+from packagemanager import manager as mngr, iemods, aioinstall, search
+from packagemanager.tools import progress
 
 log = logging.getLogger(__name__)
-logging.config.dictConfig(json.load(open('logging_config.json', 'r')))
+
+# The progress bar shows per mille
+PROGRESS_SCALE = 1000
+
+
+class WorkerSignals(QtCore.QObject):
+    finished = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(object)
+
+
+class Worker(QtCore.QRunnable):
+    '''
+    Runs fn(*args) on a thread of a QThreadPool. The result is sent through signals.finished, an exception raised
+    by fn through signals.failed, both are delivered in the thread of the connected receivers.
+    '''
+
+    def __init__(self, fn, *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.signals = WorkerSignals()
+
+    def run(self):
+        try:
+            res = self.fn(*self.args)
+        except Exception as e:
+            log.exception('Error in worker running %s', self.fn)
+            self.signals.failed.emit(e)
+        else:
+            self.signals.finished.emit(res)
+
+
+class ProgressBridge(QtCore.QObject):
+    '''
+    Forwards the events of progress.bus, published from any thread, to the event signal
+    '''
+    event = QtCore.pyqtSignal(object)
+
+    def __init__(self, bus: progress.ProgressBus = progress.bus):
+        super().__init__()
+        self.bus = bus
+        bus.subscribe(self.forward)
+
+    def forward(self, event: progress.ProgressEvent):
+        self.event.emit(event)
+
+    def close(self):
+        self.bus.unsubscribe(self.forward)
+
+
+class Node:
+    __slots__ = ('item', 'parent', 'row', 'children')
+
+    def __init__(self, item, parent, row):
+        self.item = item
+        self.parent = parent
+        self.row = row
+        # Filled by fetchMore
+        self.children = []
+
+    def pending(self) -> int:
+        return len(self.item.subcomponents) - len(self.children)
+
+
+class CatalogModel(QtCore.QAbstractItemModel):
+    '''
+    Tree model of packages and their components, rows are created batch rows at a time when the view needs them.
+    Components can be checked to be selected.
+    '''
+    HEADERS = ('Name', 'Id')
+
+    def __init__(self, packages=(), batch: int = 200, parent=None):
+        super().__init__(parent)
+        self.batch = batch
+        self.checked = set()
+        self.set_packages(packages)
+
+    def set_packages(self, packages):
+        self.beginResetModel()
+        self.packages = list(packages)
+        self.roots = []
+        self.endResetModel()
+
+    def node(self, index: QtCore.QModelIndex) -> Node:
+        return index.internalPointer() if index.isValid() else None
+
+    def _children(self, node: Node) -> list:
+        return self.roots if node is None else node.children
+
+    def _pending(self, node: Node) -> int:
+        return len(self.packages) - len(self.roots) if node is None else node.pending()
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        children = self._children(self.node(parent))
+        if 0 <= row < len(children) and 0 <= column < len(self.HEADERS):
+            return self.createIndex(row, column, children[row])
+        return QtCore.QModelIndex()
+
+    def parent(self, index):
+        node = self.node(index)
+        if node is None or node.parent is None:
+            return QtCore.QModelIndex()
+        return self.createIndex(node.parent.row, 0, node.parent)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return len(self._children(self.node(parent)))
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.HEADERS)
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        node = self.node(parent)
+        return node is None or bool(node.item.subcomponents)
+
+    def canFetchMore(self, parent):
+        return self._pending(self.node(parent)) > 0
+
+    def fetchMore(self, parent):
+        node = self.node(parent)
+        children = self._children(node)
+        items = self.packages if node is None else node.item.subcomponents
+        start = len(children)
+        end = min(start + self.batch, len(items))
+        if end <= start:
+            return
+        self.beginInsertRows(parent, start, end - 1)
+        children.extend(Node(items[i], node, i) for i in range(start, end))
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        node = self.node(index)
+        if node is None:
+            return None
+        if role == Qt.DisplayRole:
+            return node.item.name if index.column() == 0 else node.item.get_full_id()
+        if role == Qt.CheckStateRole and index.column() == 0 and node.parent is not None:
+            return Qt.Checked if node.item in self.checked else Qt.Unchecked
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        node = self.node(index)
+        if role != Qt.CheckStateRole or node is None or node.parent is None:
+            return False
+        if value == Qt.Checked:
+            self.checked.add(node.item)
+        else:
+            self.checked.discard(node.item)
+        self.dataChanged.emit(index, index, [role])
+        return True
+
+    def flags(self, index):
+        node = self.node(index)
+        if node is None:
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if node.parent is not None and index.column() == 0:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+
+def load_catalog(filename: str):
+    '''
+    Returns a manager holding the packages of filename and the search index of the catalog
+    '''
+    manager = mngr.Manager()
+    for mod in iemods.load_catalog(filename).values():
+        manager.add_pkg(mod)
+    return manager, search.CatalogIndex.from_manager(manager, os.path.dirname(filename))
+
+
+def resolve(manager: mngr.Manager, components) -> list:
+    '''
+    Replaces the selection of manager with components, returns the install order
+    '''
+    manager.clear_selection()
+    manager.select_components(components)
+    return manager.install_order()
+
+
+def install(manager: mngr.Manager, concurrency: int = 4):
+    return asyncio.run(aioinstall.AsyncInstaller(concurrency=concurrency).install(manager))
+
+
+class MainWindow(QtWidgets.QMainWindow):
+    '''
+    Catalog loading, searching, resolution and installation run on pool, the window only handles their results
+    '''
+
+    def __init__(self, pool: QtCore.QThreadPool = None):
+        super().__init__()
+        self.pool = pool or QtCore.QThreadPool.globalInstance()
+        self.manager = mngr.Manager()
+        self.index = search.CatalogIndex()
+        self.workers = set()
+        self._query = 0
+
+        self.model = CatalogModel()
+        self.tree = QtWidgets.QTreeView()
+        self.tree.setModel(self.model)
+        self.tree.setUniformRowHeights(True)
+        self.searchbox = QtWidgets.QLineEdit()
+        self.searchbox.setPlaceholderText('Search')
+        self.installbutton = QtWidgets.QPushButton('Install')
+        self.progressbar = QtWidgets.QProgressBar()
+        self.progressbar.setMaximum(PROGRESS_SCALE)
+        self.status = QtWidgets.QLabel()
+
+        # Searches start once typing pauses
+        self.searchtimer = QtCore.QTimer(self)
+        self.searchtimer.setSingleShot(True)
+        self.searchtimer.setInterval(200)
+        self.searchtimer.timeout.connect(self.search)
+        self.searchbox.textChanged.connect(self.searchtimer.start)
+        self.installbutton.clicked.connect(self.install)
+
+        self.bridge = ProgressBridge()
+        self.bridge.event.connect(self.show_progress)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(self.searchbox)
+        layout.addWidget(self.tree)
+        bottom = QtWidgets.QHBoxLayout()
+        bottom.addWidget(self.progressbar)
+        bottom.addWidget(self.installbutton)
+        layout.addLayout(bottom)
+        layout.addWidget(self.status)
+        central = QtWidgets.QWidget()
+        central.setLayout(layout)
+        self.setCentralWidget(central)
+        self.setWindowTitle('Package Manager')
+
+    def run(self, fn, args, finished, failed=None) -> Worker:
+        worker = Worker(fn, *args)
+        # The window keeps the worker, and its signals, alive until it is done
+        self.workers.add(worker)
+        worker.signals.finished.connect(finished)
+        worker.signals.failed.connect(failed or self.show_error)
+        worker.signals.finished.connect(lambda _: self.workers.discard(worker))
+        worker.signals.failed.connect(lambda _: self.workers.discard(worker))
+        self.pool.start(worker)
+        return worker
+
+    def show_error(self, e):
+        self.status.setText('Error: {!r}'.format(e))
+
+    def show_progress(self, event: progress.ProgressEvent):
+        # QProgressBar takes C ints, byte counts of large archives would overflow them
+        if event.total:
+            self.progressbar.setValue(min(PROGRESS_SCALE * event.current // event.total, PROGRESS_SCALE))
+        self.status.setText('{} {}{}'.format(event.stage, event.task, ' done' if event.done else ''))
+
+    def load(self, filename: str):
+        self.status.setText('Loading {}'.format(filename))
+        self.run(load_catalog, [filename], self.loaded)
+
+    def loaded(self, res):
+        self.manager, self.index = res
+        self.model.set_packages(self.manager.availablepkg.values())
+        self.status.setText('{} mods loaded'.format(len(self.manager.availablepkg)))
+
+    def search(self):
+        query = self.searchbox.text()
+        self._query += 1
+        if not query.strip():
+            self.model.set_packages(self.manager.availablepkg.values())
+            return
+        self.run(self.index.search, [query, len(self.manager.availablepkg), True],
+                 lambda results, n=self._query: self.searched(n, results))
+
+    def searched(self, n: int, results):
+        # Results of an older query arriving late are dropped
+        if n != self._query:
+            return
+        self.model.set_packages(self.manager.availablepkg[pkgid] for pkgid, _ in results)
+
+    def install(self):
+        self.installbutton.setEnabled(False)
+        self.status.setText('Resolving the selection')
+        self.run(resolve, [self.manager, list(self.model.checked)], self.resolved, self.install_failed)
+
+    def resolved(self, order):
+        self.status.setText('Installing {} components'.format(len(order)))
+        self.run(install, [self.manager], self.installed, self.install_failed)
+
+    def installed(self, res):
+        self.installbutton.setEnabled(True)
+        self.status.setText('Installation done')
+
+    def install_failed(self, e):
+        self.installbutton.setEnabled(True)
+        self.show_error(e)
+
+    def closeEvent(self, event):
+        self.bridge.close()
+        super().closeEvent(event)
+
 
 if __name__ == '__main__':
-    log.info('Starting GUI')
\ No newline at end of file
+    logging.config.dictConfig(json.load(open('logging_config.json', 'r')))
+    log.info('Starting GUI')
+    app = QtWidgets.QApplication(sys.argv)
+    window = MainWindow()
+    window.load('Config/mods.json')
+    window.show()
+    sys.exit(app.exec_())
@@ -0,0 +1,310 @@
+'''
+Benchmark harness for the package manager.
+
+Generates synthetic catalogs, archives and directory trees, then times the main stages of an install
+(catalog loading, selection, action sorting, download, extraction and merge) and records the peak memory
+allocated by python during each of them.
+
+Usage:
+    python benchmark.py [--packages N] [--depth D] [--width W] [--conflicts C] [--files F] [--filesize B]
+                        [--repeat R] [--only stage [stage ...]] [--json out.json]
+
+Results are printed as a table, and can also be written as json to compare runs against a baseline.
+'''
+import argparse
+import http.server
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from functools import partial
+
+from packagemanager import manager as mngr, iemods
+from packagemanager.tools import download, extraction, Utils
+
+log = logging.getLogger(__name__)
+
+STAGES = ['load_from_json', 'add_pkg', 'select_pkg', 'sortInstallActionList', 'DownloadFile', 'Extract_Archive',
+          'MergeFolderTo']
+
+
+def generate_component(rng, prefix, depth, width):
+    '''
+    Returns a dict describing a component tree of the given depth, every component having width subcomponents
+    :param rng: random.Random instance
+    :param prefix: id of the component
+    :param depth: number of levels under this component
+    :param width: number of subcomponents per component
+    :return:
+    '''
+    return {'id': prefix,
+            'name': 'Component {}'.format(prefix),
+            'dependencies': {'requirements': [], 'conflicts': [], 'before': [], 'after': []},
+            'subcomponents': [generate_component(rng, '{}_{}'.format(prefix, i), depth - 1, width)
+                              for i in range(width)] if depth > 0 else []}
+
+
+def generate_catalog(packages=1000, depth=3, width=3, conflicts=5, seed=0):
+    '''
+    Returns a dict in the format used by Package.load_from_json.
+    Each package gets a component tree of the given depth and width, and each top level component
+    gets up to conflicts conflicts against random top level components of other packages.
+    :return:
+    '''
+    rng = random.Random(seed)
+    catalog = {}
+    for p in range(packages):
+        pkgid = 'pkg{:05d}'.format(p)
+        catalog[pkgid] = {'id': pkgid,
+                          'name': 'Package {}'.format(p),
+                          'downloadurl': 'http://127.0.0.1/{}.zip'.format(pkgid),
+                          'desc': 'Synthetic package number {}'.format(p),
+                          'readmeurl': None,
+                          'version': '1.{}.{}'.format(p % 7, p % 13),
+                          'dependencies': {'requirements': [], 'conflicts': [], 'before': [], 'after': []},
+                          'components': [generate_component(rng, 'c{}'.format(i), depth - 1, width)
+                                         for i in range(width)]}
+
+    ids = list(catalog)
+    for pkgid, pkg in catalog.items():
+        for comp in pkg['components']:
+            for _ in range(rng.randint(0, conflicts)):
+                other = rng.choice(ids)
+                if other == pkgid:
+                    continue
+                comp['dependencies']['conflicts'].append('{}.c{}'.format(other, rng.randrange(width)))
+    return catalog
+
+
+def generate_tree(root, files=1000, filesize=1024, fanout=10, seed=0):
+    '''
+    Creates a directory tree under root containing files files of filesize bytes, at most fanout entries per directory
+    :return: the list of created files relative to root
+    '''
+    rng = random.Random(seed)
+    created = []
+    for i in range(files):
+        parts = []
+        n = i
+        while n >= fanout:
+            n //= fanout
+            parts.append('d{}'.format(n % fanout))
+        rel = '/'.join(parts + ['f{}.dat'.format(i)])
+        path = root + '/' + rel
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(rng.getrandbits(8 * filesize).to_bytes(filesize, 'little') if filesize else b'')
+        created.append(rel)
+    return created
+
+
+def generate_archive(filename, files=1000, filesize=1024, seed=0):
+    '''
+    Creates a zip archive containing a synthetic tree
+    :return: the path of the archive
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        generate_tree(tmp, files, filesize, seed=seed)
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as z:
+            for dirpath, _, filenames in os.walk(tmp):
+                for f in filenames:
+                    p = os.path.join(dirpath, f)
+                    z.write(p, os.path.relpath(p, tmp))
+    return filename
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer:
+    '''
+    Serves the content of a directory over http on localhost, used as a stand-in for mod hosts.
+    '''
+
+    def __init__(self, directory):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StageResult:
+    def __init__(self, name, seconds, peak, info=''):
+        self.name = name
+        self.seconds = seconds
+        self.peak = peak
+        self.info = info
+
+    def to_dict(self):
+        return {'stage': self.name, 'seconds': self.seconds, 'peak_bytes': self.peak, 'info': self.info}
+
+
+def measure(name, func, *args, repeat=1, info='', **kwargs):
+    '''
+    Runs func repeat times, returns a StageResult with the best time and the highest peak of traced memory,
+    along with the last result of func
+    '''
+    best = None
+    peak = 0
+    res = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        res = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+    return StageResult(name, best, peak, info), res
+
+
+def select_all(m: mngr.Manager):
+    for pkg in m.availablepkg.values():
+        m.select_pkg(pkg, list(pkg.get_childrens()), raiseconflicts=False)
+
+
+def chained_actions(n, seed=0):
+    '''
+    Returns n actions, each one depending on up to 3 random earlier actions
+    '''
+    rng = random.Random(seed)
+    actions = []
+    for i in range(n):
+        prev = rng.sample(actions, min(len(actions), rng.randint(0, 3)))
+        actions.append(mngr.InstallAction(installmethod=print, args=[], id='a{}'.format(i), prev=prev))
+    rng.shuffle(actions)
+    return actions
+
+
+def run(args):
+    results = []
+    stages = set(args.only) if args.only else set(STAGES)
+    with tempfile.TemporaryDirectory() as tmp:
+        catalogfile = tmp + '/catalog.json'
+        catalog = generate_catalog(args.packages, args.depth, args.width, args.conflicts)
+        with open(catalogfile, 'w', encoding='utf-8') as f:
+            json.dump(catalog, f)
+        del catalog
+
+        size = os.path.getsize(catalogfile)
+        r, pkgs = measure('load_from_json', iemods.IEMod.load_from_json, catalogfile, repeat=args.repeat,
+                          info='{} packages, {} bytes'.format(args.packages, size))
+        if 'load_from_json' in stages:
+            results.append(r)
+
+        def add_all():
+            m = mngr.Manager()
+            for pkg in pkgs.values():
+                m.add_pkg(pkg)
+            return m
+
+        r, m = measure('add_pkg', add_all, repeat=args.repeat)
+        if 'add_pkg' in stages:
+            results.append(r)
+
+        if 'select_pkg' in stages:
+            nbcomp = sum(1 for pkg in pkgs.values() for _ in pkg.get_childrens())
+
+            def fresh_select():
+                select_all(add_all())
+
+            # Component conflict counters are stored on the components, reload them for each repeat
+            r, _ = measure('select_pkg', fresh_select, repeat=args.repeat, info='{} components'.format(nbcomp))
+            results.append(r)
+
+        if 'sortInstallActionList' in stages:
+            nbactions = args.packages * 5
+            r, _ = measure('sortInstallActionList', lambda: mngr.sortInstallActionList(chained_actions(nbactions)),
+                           repeat=args.repeat, info='{} actions'.format(nbactions))
+            results.append(r)
+
+        served = tmp + '/served'
+        os.makedirs(served)
+        archive = generate_archive(served + '/archive.zip', args.files, args.filesize)
+        archivesize = os.path.getsize(archive)
+
+        if 'DownloadFile' in stages:
+            with LocalServer(served) as server:
+                r, _ = measure('DownloadFile', download.DownloadFile, server.url + '/archive.zip',
+                               tmp + '/downloaded.zip', lambda n: None, repeat=args.repeat,
+                               info='{} bytes'.format(archivesize))
+            results.append(r)
+
+        if 'Extract_Archive' in stages:
+            if extraction.SelectTool(archive) and shutil.which(extraction.SelectTool(archive)[0].split()[0].strip('"')):
+                def extract():
+                    target = tmp + '/extracted'
+                    shutil.rmtree(target, ignore_errors=True)
+                    os.makedirs(target)
+                    return extraction.Extract_Archive(archive, target)
+
+                r, _ = measure('Extract_Archive', extract, repeat=args.repeat,
+                               info='{} files, {} bytes'.format(args.files, archivesize))
+                results.append(r)
+            else:
+                log.warning('No extraction tool available, skipping Extract_Archive')
+                results.append(StageResult('Extract_Archive', float('nan'), 0, 'skipped: no extraction tool'))
+
+        if 'MergeFolderTo' in stages:
+            best = None
+            peak = 0
+            for i in range(args.repeat):
+                src, dst = tmp + '/merge_src{}'.format(i), tmp + '/merge_dst{}'.format(i)
+                generate_tree(src, args.files, args.filesize)
+                # Half of the files already exist in the destination and have to be replaced
+                generate_tree(dst, args.files // 2, args.filesize, seed=1)
+                r, _ = measure('MergeFolderTo', Utils.MergeFolderTo, src, dst)
+                best = r.seconds if best is None else min(best, r.seconds)
+                peak = max(peak, r.peak)
+            results.append(StageResult('MergeFolderTo', best, peak, '{} files'.format(args.files)))
+
+    return results
+
+
+def report(results):
+    lines = ['{:<24}{:>12}{:>14}  {}'.format('stage', 'seconds', 'peak KiB', 'info')]
+    for r in results:
+        lines.append('{:<24}{:>12.4f}{:>14.1f}  {}'.format(r.name, r.seconds, r.peak / 1024, r.info))
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the package manager stages on synthetic data')
+    parser.add_argument('--packages', type=int, default=1000, help='number of packages in the catalog')
+    parser.add_argument('--depth', type=int, default=3, help='depth of the component trees')
+    parser.add_argument('--width', type=int, default=3, help='number of subcomponents per component')
+    parser.add_argument('--conflicts', type=int, default=5, help='maximum conflicts per top level component')
+    parser.add_argument('--files', type=int, default=2000, help='number of files in archives and merged trees')
+    parser.add_argument('--filesize', type=int, default=1024, help='size of each generated file in bytes')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per stage, the best time is kept')
+    parser.add_argument('--only', nargs='+', choices=STAGES, help='stages to run')
+    parser.add_argument('--json', help='file to write the results to')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    arguments = parse_args()
+    res = run(arguments)
+    print(report(res))
+    if arguments.json:
+        with open(arguments.json, 'w', encoding='utf-8') as f:
+            json.dump({'parameters': vars(arguments), 'results': [r.to_dict() for r in res]}, f, indent=4)
@@ -1,49 +1,250 @@
-import logging.config
+import time
+
+# Start of the imports, reported by --profile-startup
+STARTED = time.perf_counter()
+
+import argparse
+import bisect
+import contextlib
+import itertools
+import logging
 import json
+import os
+import sys
 
-from packagemanager import manager as mngr, iemods
+from packagemanager import manager as mngr, iemods, search
+
+IMPORTED = time.perf_counter()
 
 log = logging.getLogger(__name__)
-logging.config.dictConfig(json.load(open('logging_config.json', 'r')))
 
+INDENT = '    '
+
+
+class PagedTreeView:
+    '''
+    Pages through a tree of packages and components, writing each page to out in a single call.
+    Components start collapsed and are walked only when they are expanded and on the page being rendered: the
+    number of visible rows of expanded subtrees is cached so that pages are reached without walking the rows
+    before them.
+    '''
+
+    def __init__(self, roots: list, pagesize: int = 40, out=sys.stdout):
+        self.roots = roots
+        self.pagesize = pagesize
+        self.out = out
+        self.expanded = set()
+        self.page = 0
+        self.rows = []
+        self._sizes = {}
+        self._offsets = None
+
+    def _size(self, node) -> int:
+        if node not in self.expanded or not node.subcomponents:
+            return 1
+        size = self._sizes.get(node)
+        if size is None:
+            self._sizes[node] = size = 1 + sum(self._size(c) for c in node.subcomponents)
+        return size
+
+    @property
+    def offsets(self) -> list:
+        '''
+        First visible row of each root, followed by the total number of rows
+        '''
+        if self._offsets is None:
+            self._offsets = list(itertools.accumulate((self._size(r) for r in self.roots), initial=0))
+        return self._offsets
+
+    @property
+    def pages(self) -> int:
+        return max(1, -(-self.offsets[-1] // self.pagesize))
+
+    def toggle(self, node):
+        if node in self.expanded:
+            self.expanded.discard(node)
+        elif node.subcomponents:
+            self.expanded.add(node)
+        self._sizes.clear()
+        self._offsets = None
+
+    def _walk(self, node, depth: int, skip: int):
+        if skip:
+            skip -= 1
+        else:
+            yield depth, node
+        if node in self.expanded:
+            for c in node.subcomponents:
+                size = self._size(c)
+                if skip >= size:
+                    skip -= size
+                    continue
+                yield from self._walk(c, depth + 1, skip)
+                skip = 0
+
+    def walk(self, start: int = 0):
+        '''
+        Yields the (depth, node) of the visible rows from row start
+        '''
+        offsets = self.offsets
+        i = bisect.bisect_right(offsets, start) - 1
+        if i >= len(self.roots):
+            return
+        skip = start - offsets[i]
+        for root in self.roots[i:]:
+            yield from self._walk(root, 0, skip)
+            skip = 0
+
+    def render(self) -> str:
+        start = self.page * self.pagesize
+        rows = list(itertools.islice(self.walk(start), self.pagesize))
+        self.rows = [node for _, node in rows]
+        lines = []
+        for n, (depth, node) in enumerate(rows):
+            marker = ('-' if node in self.expanded else '+') if node.subcomponents else ' '
+            name = node.name if node.parent else node.name + ' : ' + node.id
+            lines.append('{:>4} {}{} {}'.format(n + 1, INDENT * depth, marker, name))
+        lines.append('Page {}/{}'.format(self.page + 1, self.pages))
+        return '\n'.join(lines) + '\n'
+
+    def show(self):
+        self.out.write(self.render())
+        self.out.flush()
+
+    def browse(self, ask=input):
+        '''
+        Shows pages until the user quits. A row number expands or collapses the row, i and a row number show the
+        details of a package
+        '''
+        while True:
+            self.show()
+            choice = ask('[n]ext, [p]revious, row number to expand/collapse, i row number for details, [q]uit:')
+            choice = choice.strip().lower()
+            if choice == 'q':
+                break
+            elif choice == 'n':
+                self.page = min(self.page + 1, self.pages - 1)
+            elif choice == 'p':
+                self.page = max(self.page - 1, 0)
+            elif choice.startswith('i') and choice[1:].strip().isdigit():
+                row = int(choice[1:]) - 1
+                if 0 <= row < len(self.rows):
+                    node = self.rows[row]
+                    while node.parent is not None:
+                        node = node.parent
+                    self.out.write(format_mod(node))
+            elif choice.isdigit() and 0 < int(choice) <= len(self.rows):
+                self.toggle(self.rows[int(choice) - 1])
+
+
+def format_mod(mod: iemods.IEMod) -> str:
+    lines = [mod.name + ' : ' + mod.id, mod.desc or '', str(mod.version), 'Components :']
+    stack = [(c, 1) for c in reversed(mod.subcomponents)]
+    while stack:
+        comp, depth = stack.pop()
+        lines.append(INDENT * depth + comp.name)
+        stack.extend((c, depth + 1) for c in reversed(comp.subcomponents))
+    lines.extend([mod.downloadurl or '', mod.readmeurl or '', ''])
+    return '\n'.join(lines) + '\n'
+
+
+class StartupProfile:
+    '''
+    Wall clock time of each step of the startup, reported by --profile-startup
+    '''
 
-class BWSconsoleGUI:
     def __init__(self):
+        self.steps = []
+
+    def add(self, name: str, seconds: float):
+        self.steps.append((name, seconds))
+
+    @contextlib.contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def report(self) -> str:
+        lines = ['{:<10} {:8.1f} ms'.format(name, seconds * 1000) for name, seconds in self.steps]
+        lines.append('{:<10} {:8.1f} ms'.format('total', (time.perf_counter() - STARTED) * 1000))
+        loaded = sorted(m for m in sys.modules if m.startswith('packagemanager.'))
+        lines.append('{} packagemanager modules loaded: {}'.format(len(loaded), ', '.join(loaded)))
+        return '\n'.join(lines) + '\n'
+
+
+def setup_logging(filename: str = 'logging_config.json'):
+    import logging.config
+    with open(filename, 'r') as f:
+        logging.config.dictConfig(json.load(f))
+
+
+def is_game_directory(path: str) -> bool:
+    # Every Infinity Engine game has its resource index at its root
+    return os.path.isfile(os.path.join(path, 'chitin.key'))
+
+
+class BWSconsoleGUI:
+    def __init__(self, gamedir: str = None):
         self.mngr = mngr.Manager()
+        self.gamedir = gamedir
+        self.inidir = None
+        self._index = None
+
+    @property
+    def index(self) -> search.CatalogIndex:
+        # Built on the first search, listing the mods doesn't pay for indexing the catalog
+        if self._index is None:
+            self._index = search.CatalogIndex.from_manager(self.mngr, self.inidir)
+        return self._index
 
     def load_mods(self, filename):
-        mods = iemods.IEMod.load_from_json(filename)
+        mods = iemods.load_catalog(filename)
         for mod in mods.values():
             self.mngr.add_pkg(mod)
+        self.inidir = os.path.dirname(filename)
+        self._index = None
+
+    def list_mods(self):
+        sys.stdout.write(''.join('{} : {}\n'.format(mod.name, mod.id) for mod in self.mngr.availablepkg.values()))
+
+    def print_search(self, query: str, limit: int = 20):
+        results = self.index.search(query, limit, substring=True)
+        if not results:
+            print('No mod found')
+        for pkgid, score in results:
+            print(self.mngr.availablepkg[pkgid].name + ' : ' + pkgid)
+
+    def print_status(self, installed: str, selection: str = None):
+        '''
+        Prints the components of the installed state saved in installed and, if a selection file is given, the
+        changes installing it would make
+        '''
+        state = mngr.InstalledState.load_from_json(installed)
+        print('{} components installed'.format(len(state.components)))
+        if selection:
+            self.mngr.load_selection(selection)
+            diff = self.mngr.diff(state)
+            print('{} kept, {} to uninstall, {} to install'.format(diff.kept, len(diff.uninstall), len(diff.install)))
 
     def display_available_mods(self):
         print('Available mods')
-        for mod in list(self.mngr.availablepkg.values()):
-            self.display_mod(mod)
-            print('\n')
-
-    def display_mod(self, mod: iemods.IEMod, indent=0):
-        indentstr = ' ' * indent
-        print(indentstr + mod.name + ' : ' + mod.id)
-        print(indentstr + mod.desc)
-        print(indentstr + str(mod.version))
-        print(indentstr + 'Components :')
-        for c in mod.subcomponents:
-            self.display_component(c, indent + 4)
-        print(indentstr + mod.downloadurl)
-        print(indentstr + mod.readmeurl)
-
-    def display_component(self, comp: mngr.Component, indent=0):
-        indentstr = ' ' * indent
-        print(indentstr + comp.name)
-        for c in comp.subcomponents:
-            self.display_component(c, indent + 4)
+        PagedTreeView(list(self.mngr.availablepkg.values())).browse()
+
+    def display_mod(self, mod: iemods.IEMod):
+        sys.stdout.write(format_mod(mod))
 
     def display_selected_mods(self):
+        lines = []
         for selection in self.mngr.selectedpkg.values():
-            print(selection.pkg.name)
-            for c in selection.components:
-                print(' ' * 4 + c.name)
+            lines.append(selection.pkg.name)
+            lines.extend(INDENT + c.name for c in selection.components)
+        print('\n'.join(lines))
+
+    def search_mods(self):
+        self.print_search(input('Search:'))
 
     def pick_mod(self):
         choice = input('Write the Mod ID:')
@@ -64,10 +265,56 @@ class BWSconsoleGUI:
             selection.append(comps[compchoice])
         self.mngr.select_pkg(mod, selection)
 
+    def save_selection(self):
+        filename = input('Write the name of the selection file:')
+        self.mngr.save_selection(filename)
+
+    def load_selection(self):
+        filename = input('Write the name of the selection file:')
+        try:
+            self.mngr.load_selection(filename)
+        except FileNotFoundError:
+            print('No such file')
+        except mngr.UnexistingComponentException as e:
+            print('Unknown components: ' + ', '.join(e.args[0]))
+        except mngr.PackageHasConflictException as e:
+            print('Conflicting components: ' + ', '.join(e.args[0]))
+
+    def analyse_conflicts(self):
+        from packagemanager import conflicts
+        report = conflicts.analyse(self.mngr, '.')
+        print(report.summary())
+
     def install_current(self):
-        self.mngr.generate_action_list()
-        for action in self.mngr.installActions:
-            action.execute()
+        # The install machinery is only loaded when needed, to keep the short commands fast
+        import asyncio
+        from packagemanager import aioinstall, planning
+        from packagemanager.tools import download, progress, scheduler
+        gamedir = self.gamedir or input('Write the game directory:')
+        if not is_game_directory(gamedir):
+            print('{} is not a game directory, aborting installation'.format(gamedir or 'No directory'))
+            return
+        self.gamedir = gamedir
+        # Only the components after the first change of the recorded install order are redone
+        diff = self.mngr.diff(mngr.InstalledState.load_from_game(gamedir))
+        print('{} kept, {} to uninstall, {} to install'.format(diff.kept, len(diff.uninstall), len(diff.install)))
+        if not diff:
+            return
+        dirs = {'cachedir': '.', 'stagingdir': 'staging', 'gamedir': gamedir}
+        plan = planning.plan_install(self.mngr, **dirs)
+        print(plan.summary())
+        if not plan.ok:
+            print('Not enough disk space, aborting installation')
+            return
+        if scheduler.scheduler.validators is None:
+            scheduler.scheduler.validators = download.ValidatorStore('validators.json')
+        printer = progress.bus.subscribe(progress.ConsolePrinter())
+        try:
+            limits = {mngr.NETWORK: plan.download_concurrency, mngr.CPU: plan.extraction_concurrency, mngr.DISK: 1}
+            asyncio.run(aioinstall.AsyncInstaller(limits=limits).apply(self.mngr, diff=diff, **dirs))
+        finally:
+            progress.bus.flush()
+            progress.bus.unsubscribe(printer)
 
     def main_menu(self):
         while True:
@@ -75,8 +322,12 @@ class BWSconsoleGUI:
                                '2. Display currently selected mods\n'
                                '3. Pick Mod\n'
                                '4. Install Current Selection\n'
-                               '5. Exit\n'))
-            if choice < 1 or choice > 5:
+                               '5. Save Selection\n'
+                               '6. Load Selection\n'
+                               '7. Search Mods\n'
+                               '8. Analyse File Conflicts\n'
+                               '9. Exit\n'))
+            if choice < 1 or choice > 9:
                 continue
             if choice == 1:
                 self.display_available_mods()
@@ -87,11 +338,75 @@ class BWSconsoleGUI:
             elif choice == 4:
                 self.install_current()
             elif choice == 5:
+                self.save_selection()
+            elif choice == 6:
+                self.load_selection()
+            elif choice == 7:
+                self.search_mods()
+            elif choice == 8:
+                self.analyse_conflicts()
+            elif choice == 9:
                 break
 
 
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Console front end of the package manager, the interactive menu '
+                                                 'starts when no command is given')
+    parser.add_argument('--catalog', default='Config/mods.json', help='json file of the available mods')
+    parser.add_argument('--logging-config', default='logging_config.json',
+                        help='logging configuration of the interactive menu')
+    parser.add_argument('--gamedir', help='game directory the mods are installed to, asked for on install if not '
+                                          'given')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print the time spent importing, loading the catalog and running the command to stderr')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='list the available mods')
+    search_parser = commands.add_parser('search', help='search the available mods')
+    search_parser.add_argument('query', nargs='+')
+    search_parser.add_argument('--limit', type=int, default=20)
+    status_parser = commands.add_parser('status', help='show the installed components')
+    status_parser.add_argument('--installed', help='installed state file, the one recorded in --gamedir (or the '
+                                                   'current directory) by default')
+    status_parser.add_argument('--selection', help='selection file to compare with the installed state')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    profile = StartupProfile()
+    profile.add('imports', IMPORTED - STARTED)
+    with profile.step('logging'):
+        if args.command is None:
+            setup_logging(args.logging_config)
+        else:
+            # Commands keep stdout for their output
+            logging.basicConfig(level=logging.WARNING)
+    gui = BWSconsoleGUI(args.gamedir)
+    with profile.step('catalog'):
+        gui.load_mods(args.catalog)
+
+    if args.command is None:
+        if args.profile_startup:
+            sys.stderr.write(profile.report())
+        log.info('Starting console-based GUI')
+        gui.main_menu()
+        return 0
+
+    if args.command == 'search':
+        with profile.step('index'):
+            gui.index
+    with profile.step(args.command):
+        if args.command == 'list':
+            gui.list_mods()
+        elif args.command == 'search':
+            gui.print_search(' '.join(args.query), args.limit)
+        elif args.command == 'status':
+            installed = args.installed or mngr.InstalledState.game_file(args.gamedir or '.')
+            gui.print_status(installed, args.selection)
+    if args.profile_startup:
+        sys.stderr.write(profile.report())
+    return 0
+
+
 if __name__ == '__main__':
-    log.info('Starting console-based GUI')
-    gui = BWSconsoleGUI()
-    gui.load_mods('Config/mods.json')
-    gui.main_menu()
+    sys.exit(main())
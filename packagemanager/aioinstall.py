@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from typing import Dict, List, Any
+
+from packagemanager import manager as mngr
+
+log = logging.getLogger(__name__)
+
+
+class AsyncInstaller:
+    '''
+    Executes install actions on an asyncio event loop.
+    Each action starts once all its prev actions are done. Actions with an asyncmethod run on the loop, the others
+    run in executor (the default executor of the loop if None).
+    limits maps resource classes (manager.NETWORK, CPU, DISK) to the number of actions of that class executing at
+    the same time, so that downloads, extractions and merges of different packages overlap without any class
+    oversubscribing its resource. Actions of other classes are limited to concurrency at the same time.
+    The limits apply across every install started on the installer, so front ends can submit many installs.
+    If an action fails, or the install is cancelled, the actions that haven't finished are cancelled and aborted
+    (see InstallAction.abort). Actions already running in an executor can't be interrupted and finish in the
+    background.
+    '''
+
+    def __init__(self, concurrency: int = 4, executor=None, limits: Dict[str, int] = None):
+        self.concurrency = concurrency
+        self.executor = executor
+        self.limits = dict(limits) if limits else {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        return self.semaphore_for(None)
+
+    def semaphore_for(self, resource: str) -> asyncio.Semaphore:
+        if resource not in self.limits:
+            resource = None
+        # Created on first use so that they belong to the running loop
+        if resource not in self._semaphores:
+            self._semaphores[resource] = asyncio.Semaphore(self.limits.get(resource, self.concurrency))
+        return self._semaphores[resource]
+
+    async def _run_action(self, action: mngr.InstallAction, prev: List[asyncio.Future]):
+        if prev:
+            await asyncio.gather(*prev)
+        async with self.semaphore_for(action.resource):
+            log.info('Executing action %s', action.id)
+            return await action.execute_async(self.executor)
+
+    async def run(self, actions: List[mngr.InstallAction]) -> Dict[str, Any]:
+        '''
+        Executes actions and their predecessors.
+        Returns a dict of the results of the actions by action id.
+        Raises IncompatibleActionsException if there is a loop in the actions, or the first exception raised by
+        an action.
+        '''
+        tasks = {}
+        for action in mngr.sortInstallActionList(actions):
+            tasks[action] = asyncio.ensure_future(self._run_action(action, [tasks[p] for p in action.prev]))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            for action, task in tasks.items():
+                if task.cancelled() or task.exception() is not None:
+                    action.abort()
+            raise
+        return {action.id: task.result() for action, task in tasks.items()}
+
+    async def install(self, manager: mngr.Manager, **kwargs) -> Dict[str, Any]:
+        '''
+        Executes the install actions of the current selection of manager, kwargs are passed to its
+        generate_action_list
+        '''
+        return await self.run(manager.generate_action_list(**kwargs))
+
+    async def apply(self, manager: mngr.Manager, gamedir: str, diff: mngr.SelectionDiff = None,
+                    **kwargs) -> Dict[str, Any]:
+        '''
+        Brings gamedir from its recorded InstalledState to the current selection of manager: only the components
+        after the first difference with the installed order are uninstalled and installed, see Manager.diff.
+        diff is that difference if it was already computed.
+        The new installed state is recorded in gamedir once every action succeeded. kwargs are passed to the
+        generate_diff_action_list of manager.
+        '''
+        if diff is None:
+            diff = manager.diff(mngr.InstalledState.load_from_game(gamedir))
+        results = await self.run(manager.generate_diff_action_list(diff, gamedir=gamedir, **kwargs))
+        mngr.InstalledState(diff.order).save_to_game(gamedir)
+        return results
+
+    def submit(self, manager: mngr.Manager, **kwargs) -> asyncio.Task:
+        '''
+        Starts installing the current selection of manager in the background, the returned task can be awaited
+        or cancelled.
+        '''
+        return asyncio.ensure_future(self.install(manager, **kwargs))
@@ -0,0 +1,172 @@
+import concurrent.futures
+import logging
+import os
+import subprocess
+from sys import platform
+from typing import Dict, List, Tuple
+
+from packagemanager import logs
+from packagemanager import manager as mngr
+from packagemanager.tools import mapped
+
+log = logging.getLogger(__name__)
+
+
+def normalize(path: str) -> str:
+    '''
+    Game files are case insensitive, paths are compared lowercased with '/' separators
+    '''
+    path = path.replace('\\', '/').lower()
+    while path.startswith('./'):
+        path = path[2:]
+    return path.strip('/')
+
+
+def parse_7z_listing(output: bytes) -> List[str]:
+    '''
+    Returns the files of the technical listing printed by 7z l -slt
+    '''
+    files = []
+    path = None
+    started = False
+    for line in output.decode('utf-8', 'replace').splitlines():
+        # The entries follow the properties of the archive itself
+        if not started:
+            started = line.startswith('----------')
+        elif line.startswith('Path = '):
+            path = line[len('Path = '):]
+        elif line.startswith('Folder = ') and path is not None:
+            if line.strip() != 'Folder = +':
+                files.append(path)
+            path = None
+    return files
+
+
+def list_archive(filename: str) -> List[str]:
+    '''
+    Returns the normalized paths of the files in the archive without extracting it: zip files are listed from
+    the central directory of their shared mapping, other archives with 7z l.
+    '''
+    try:
+        with mapped.mappings.open(filename) as m:
+            return [normalize(member.name) for member in mapped.zip_members(m) if not member.is_dir]
+    except mapped.ZipFormatException:
+        pass
+    if platform == 'win32':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    else:
+        startupinfo = None
+    res = subprocess.check_output(['7z', 'l', '-slt', filename], startupinfo=startupinfo)
+    return [normalize(p) for p in parse_7z_listing(res)]
+
+
+class ConflictReport:
+    '''
+    Files of the selected packages by path.
+    index maps each path to the ids of the packages containing it, in install order: the last one wins.
+    missing lists the packages whose archive wasn't found, unreadable the ones whose archive couldn't be listed and
+    unconstrained the pairs of packages overwriting each other's files without any before or after constraint
+    between them.
+    '''
+
+    def __init__(self, order: List[str]):
+        self.order = order
+        self.index: Dict[str, List[str]] = {}
+        self.missing: List[str] = []
+        self.unreadable: List[str] = []
+        self.unconstrained: List[Tuple[str, str]] = []
+
+    @property
+    def conflicts(self) -> Dict[str, List[str]]:
+        return {path: pkgs for path, pkgs in self.index.items() if len(pkgs) > 1}
+
+    def pairs(self) -> Dict[Tuple[str, str], List[str]]:
+        '''
+        Returns the overwritten paths by (package installed first, package installed later)
+        '''
+        pairs = {}
+        for path, pkgs in self.conflicts.items():
+            for i, first in enumerate(pkgs):
+                for later in pkgs[i + 1:]:
+                    pairs.setdefault((first, later), []).append(path)
+        return pairs
+
+    def summary(self, maxpaths: int = 5) -> str:
+        lines = ['{} files, {} overwritten'.format(len(self.index), len(self.conflicts))]
+        for (first, later), paths in self.pairs().items():
+            shown = ', '.join(sorted(paths)[:maxpaths]) + (', ...' if len(paths) > maxpaths else '')
+            lines.append('{} overwrites {} files of {}{}: {}'.format(
+                later, len(paths), first,
+                ' (no before/after constraint)' if (first, later) in self.unconstrained else '', shown))
+        if self.missing:
+            lines.append('Archives not found for {}'.format(', '.join(self.missing)))
+        if self.unreadable:
+            lines.append('Archives that could not be listed for {}'.format(', '.join(self.unreadable)))
+        return '\n'.join(lines)
+
+
+def package_order(manager: mngr.Manager) -> List[str]:
+    '''
+    Returns the ids of the selected packages in the install order of their first component
+    '''
+    order = []
+    for cid in manager.install_order():
+        pkgid = cid.split('.')[0]
+        if pkgid not in order:
+            order.append(pkgid)
+    return order
+
+
+def constrained(manager: mngr.Manager, first: str, later: str) -> bool:
+    '''
+    Returns True if a before or after constraint of the selected components of first or later refers to the other
+    '''
+    for pkgid, other in ((first, later), (later, first)):
+        depends = manager.selectedpkg[pkgid].get_dependencies()
+        if any(t.split('.')[0] == other for t in depends.before | depends.after):
+            return True
+    return False
+
+
+def analyse(manager: mngr.Manager, cachedir: str = '.', workers: int = 4) -> ConflictReport:
+    '''
+    Lists the archives of the selected packages found in cachedir and returns a ConflictReport of the files they
+    install. Packages are taken in install order, see Manager.install_order.
+    '''
+    report = ConflictReport(package_order(manager))
+    archives = {}
+    for pkgid in report.order:
+        pkg = manager.availablepkg[pkgid]
+        filename = os.path.join(cachedir, pkg.get_archive_name()) if hasattr(pkg, 'get_archive_name') else None
+        if filename is None or not os.path.isfile(filename):
+            report.missing.append(pkgid)
+        else:
+            archives[pkgid] = filename
+
+    def listing(pkgid):
+        try:
+            return list_archive(archives[pkgid])
+        except (OSError, subprocess.CalledProcessError):
+            log.exception('Could not list %s', archives[pkgid])
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = dict(zip(archives, executor.map(listing, archives)))
+    # Packages are reported in install order whatever order their listings fail in
+    report.unreadable.extend(pkgid for pkgid in report.order if pkgid in listings and listings[pkgid] is None)
+
+    trace = logs.tracing(log)
+    for pkgid in report.order:
+        for path in listings.get(pkgid) or ():
+            pkgs = report.index.setdefault(path, [])
+            if pkgid not in pkgs:
+                pkgs.append(pkgid)
+            if trace and len(pkgs) > 1:
+                log.debug('%s is overwritten by %s', path, pkgid)
+
+    for first, later in report.pairs():
+        if not constrained(manager, first, later):
+            report.unconstrained.append((first, later))
+    log.info('File conflicts:\n%s', report.summary())
+    return report
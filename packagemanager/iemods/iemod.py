@@ -1,23 +1,50 @@
+import configparser
 import logging
+import os
+import urllib.parse
+from functools import partial
 from typing import List, Dict, Any, Tuple
 
 from packagemanager.manager import Package, Dependencies, Component, SubComponent
 
+from packagemanager import search
 from packagemanager import tools
-from packagemanager.manager import InstallAction
+from packagemanager.manager import InstallAction, DownloadAction, VerifyAction, ExtractAction, MergeAction, \
+    InstallScriptAction, CleanupAction
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = ('zip', '7z', 'rar', 'exe')
+
+
+class UnknownComponentNumberException(Exception): pass
 
 
 class IEMod(Package):
     def __init__(self, packageid: str, name: str, depends: Dependencies, components: List[SubComponent],
-                 versionno: str, downloadurl: str, readmeurl: str = None, desc: str = None):
+                 versionno: str, downloadurl: str, readmeurl: str = None, desc: str = None, size: int = None,
+                 checksum: str = None, mirrors: List[str] = None, tp2: str = None, languages: Dict[str, int] = None):
+        '''
+        size is the size of the downloaded archive in bytes, if known. It is an estimate used to plan disk usage: the
+        archives of moving targets (latest releases, branches) change size, so it is only enforced on downloads
+        together with checksum, see get_verified_size
+        checksum is the expected hash of the archive as 'algorithm:hexdigest', see tools.download.IntegrityChecker
+        mirrors are urls tried in order when downloadurl fails
+        tp2 is the setup file of the mod in the game directory, setup-<id>.tp2 by default
+        languages maps language codes to the language indexes of the setup, as in the Tra entry of the mod INI
+        '''
         super().__init__(packageid, name, depends, components)
 
-        log = logging.getLogger(__name__)
-        log.debug('Parsing versionno {}'.format(versionno))
+        log.debug('Parsing versionno %s', versionno)
         self.version = tools.parse(versionno)
         self.downloadurl = downloadurl
         self.readmeurl = readmeurl
         self.desc = desc
+        self.size = size
+        self.checksum = checksum
+        self.mirrors = list(mirrors) if mirrors else []
+        self.tp2 = tp2
+        self.languages = dict(languages) if languages else {}
 
     def to_dict(self):
         d = super().to_dict()
@@ -25,23 +52,198 @@ class IEMod(Package):
         d['downloadurl'] = self.downloadurl
         d['readmeurl'] = self.readmeurl
         d['desc'] = self.desc
+        d['size'] = self.size
+        d['checksum'] = self.checksum
+        d['mirrors'] = self.mirrors
+        d['tp2'] = self.tp2
+        d['languages'] = self.languages
+        return d
 
     @classmethod
     def from_dict(cls, d: Dict[str, Any]) -> "IEMod":
         return cls(packageid=d['id'],
                    name=d['name'],
                    depends=Dependencies.from_dict(d['dependencies']),
-                   components=[Component.from_dict(comp) for comp in d['components']],
+                   components=[SubComponent.from_dict(comp) for comp in d['components']],
                    versionno=d['version'],
                    downloadurl=d['downloadurl'],
                    readmeurl=d['readmeurl'],
-                   desc=d['desc'])
-
-    def generate_install_actions(self, comp: List[SubComponent]) -> List[InstallAction]:
-        actions = []
-        dlAction = InstallAction(installmethod=tools.download.DownloadFile,
-                                 args=[self.downloadurl, "_".join([self.id, str(self.version)])],
-                                 id='Download {}'.format(self.name),
-                                 prev=[])
-        actions.append(dlAction)
-        return actions
+                   desc=d['desc'],
+                   size=d.get('size'),
+                   checksum=d.get('checksum'),
+                   mirrors=d.get('mirrors'),
+                   tp2=d.get('tp2'),
+                   languages=d.get('languages'))
+
+    def get_urls(self) -> List[str]:
+        return [self.downloadurl] + self.mirrors
+
+    def get_archive_name(self) -> str:
+        '''
+        Returns the filename of the downloaded archive. Its extension is the one of the download url if it is a
+        known archive format, zip otherwise
+        '''
+        ext = urllib.parse.urlsplit(self.downloadurl).path.rsplit('.', 1)[-1].lower()
+        if ext not in ARCHIVE_EXTENSIONS:
+            ext = 'zip'
+        return "_".join([self.id, str(self.version)]) + '.' + ext
+
+    def get_verified_size(self) -> int:
+        '''
+        Returns the size the downloaded archive must have, None unless the catalog pins the archive with a checksum
+        '''
+        return self.size if self.checksum else None
+
+    def get_tp2(self) -> str:
+        return self.tp2 or 'setup-{}.tp2'.format(self.id)
+
+    def get_language(self, code: str = 'EN') -> int:
+        return self.languages.get(code, 0)
+
+    def get_component_number(self, comp: SubComponent) -> int:
+        '''
+        Returns the number of comp in the setup, read from the mod INI (see read_ini) or its id if it is a number
+        '''
+        number = getattr(comp, 'number', None)
+        if number is not None:
+            return number
+        if comp.id.isdigit():
+            return int(comp.id)
+        log.error('Unknown setup number of component %s of %s', comp.id, self.id)
+        raise UnknownComponentNumberException(self.id, comp.id)
+
+    def read_ini(self, filename: str):
+        '''
+        Completes the mod with its INI file: the setup filename of the [Tp2] section, the language indexes of the
+        Tra entry of [Mod] and the component numbers of the @N entries of [WeiDU-EN], or of the first WeiDU section.
+        The components are matched with the entries by name, or by position when there are as many of both.
+        Values already set in the catalog are kept.
+        '''
+        ini = search.read_ini(filename)
+        if self.tp2 is None and ini.has_section('Tp2'):
+            self.tp2 = next(iter(ini['Tp2']), None)
+        if not self.languages and ini.has_option('Mod', 'Tra'):
+            for entry in ini.get('Mod', 'Tra').split(','):
+                code, _, index = entry.partition(':')
+                if index.strip().isdigit():
+                    self.languages[code.strip()] = int(index)
+
+        sections = [s for s in ini.sections() if s.startswith('WeiDU-')]
+        if not sections:
+            return
+        section = 'WeiDU-EN' if 'WeiDU-EN' in sections else sections[0]
+        entries = [(int(key[1:]), value) for key, value in ini.items(section)
+                   if key.startswith('@') and key[1:].isdigit()]
+        numbers = {tuple(search.tokenize(value)): number for number, value in entries if value}
+        positional = len(entries) == len(self.subcomponents)
+        for i, comp in enumerate(self.subcomponents):
+            if getattr(comp, 'number', None) is not None:
+                continue
+            number = numbers.get(tuple(search.tokenize(comp.name)))
+            if number is None and positional:
+                number = entries[i][0]
+            comp.number = number
+
+    def get_staging_name(self) -> str:
+        return "_".join([self.id, str(self.version)])
+
+    def generate_download_action(self, cachedir: str = '.') -> DownloadAction:
+        return DownloadAction(installmethod=tools.scheduler.scheduler.download_or_raise,
+                              args=[self.get_urls(), os.path.join(cachedir, self.get_archive_name()), None,
+                                    self.get_verified_size(), self.checksum],
+                              id='Download {}'.format(self.name),
+                              prev=[],
+                              asyncmethod=tools.scheduler.scheduler.download_or_raise_async)
+
+    def generate_verify_action(self, download: InstallAction, cachedir: str = '.') -> VerifyAction:
+        '''
+        The verify action holds the mapping of the archive in its lease until the extract action is done with it
+        '''
+        archive = os.path.join(cachedir, self.get_archive_name())
+        lease = tools.mapped.MappingLease(archive)
+        verify = VerifyAction(installmethod=partial(tools.download.VerifyOrRaise, lease=lease),
+                              args=[archive, self.get_verified_size(), self.checksum],
+                              id='Verify {}'.format(self.name),
+                              prev=[download])
+        verify.lease = lease
+        return verify
+
+    def generate_extract_action(self, verify: InstallAction, cachedir: str = '.',
+                                stagingdir: str = 'staging') -> ExtractAction:
+        '''
+        The extract action releases the lease of verify once done, or when it is aborted
+        '''
+        extract = ExtractAction(installmethod=partial(tools.extraction.ExtractOrRaise, lease=verify.lease),
+                                args=[os.path.join(cachedir, self.get_archive_name()),
+                                      os.path.join(stagingdir, self.get_staging_name())],
+                                id='Extract {}'.format(self.name),
+                                prev=[verify])
+        extract.lease = verify.lease
+        return extract
+
+    def generate_cleanup_action(self, merge: InstallAction, stagingdir: str = 'staging') -> CleanupAction:
+        '''
+        Returns the action removing the extracted files of the mod from stagingdir once merge is done
+        '''
+        return CleanupAction(installmethod=tools.Utils.RemoveStaging,
+                             args=[os.path.join(stagingdir, self.get_staging_name())],
+                             id='Clean up {}'.format(self.name),
+                             prev=[merge])
+
+    def generate_script_action(self, comp: List[SubComponent], gamedir: str = '.', uninstall: bool = False,
+                               language: str = 'EN') -> InstallScriptAction:
+        return InstallScriptAction(installmethod=partial(tools.weidu.RunSetupOrRaise, uninstall=uninstall),
+                                   args=[gamedir, self.get_tp2(), [self.get_component_number(c) for c in comp],
+                                         self.get_language(language)],
+                                   id='{} {}'.format('Uninstall' if uninstall else 'Install', self.name),
+                                   prev=[])
+
+    def generate_install_actions(self, comp: List[SubComponent], cachedir: str = '.', stagingdir: str = 'staging',
+                                 gamedir: str = '.', language: str = 'EN') -> List[InstallAction]:
+        '''
+        Returns the stages installing the mod: the archive is downloaded to cachedir, verified, extracted to
+        stagingdir then merged into gamedir, where the setup installs comp. The staging directory is removed after
+        the merge.
+        '''
+        download = self.generate_download_action(cachedir)
+        verify = self.generate_verify_action(download, cachedir)
+        extract = self.generate_extract_action(verify, cachedir, stagingdir)
+        merge = MergeAction(installmethod=tools.Utils.MergeFolderTo,
+                            args=[os.path.join(stagingdir, self.get_staging_name()), gamedir],
+                            id='Merge {}'.format(self.name),
+                            prev=[extract])
+        script = self.generate_script_action(comp, gamedir, language=language)
+        script.prev.append(merge)
+        cleanup = self.generate_cleanup_action(merge, stagingdir)
+        return [download, verify, extract, merge, script, cleanup]
+
+    def generate_component_actions(self, comp: List[SubComponent], gamedir: str = '.', language: str = 'EN',
+                                   **kwargs) -> List[InstallAction]:
+        '''
+        Returns the setup of comp, for components installed after other components of the mod were merged. The
+        other keyword arguments of generate_install_actions are ignored.
+        '''
+        return [self.generate_script_action(comp, gamedir, language=language)]
+
+    def generate_uninstall_actions(self, comp: List[SubComponent], gamedir: str = '.', language: str = 'EN',
+                                   **kwargs) -> List[InstallAction]:
+        return [self.generate_script_action(comp, gamedir, uninstall=True, language=language)]
+
+
+def load_catalog(filename: str, inidir: str = None) -> Dict[str, IEMod]:
+    '''
+    Returns the mods of the catalog filename, completed with the INI files named after their ids in inidir, the
+    directory of the catalog by default
+    '''
+    mods = IEMod.load_from_json(filename)
+    if inidir is None:
+        inidir = os.path.dirname(os.path.abspath(filename))
+    for mod in mods.values():
+        ini = os.path.join(inidir, mod.id + '.ini')
+        if not os.path.isfile(ini):
+            continue
+        try:
+            mod.read_ini(ini)
+        except (ValueError, configparser.Error):
+            log.exception('Could not read %s', ini)
+    return mods
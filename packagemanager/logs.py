@@ -0,0 +1,29 @@
+'''
+Logging helpers for the package manager.
+
+Modules keep a single logger created at import time (log = logging.getLogger(__name__)) and pass arguments to the
+logging calls instead of formatting messages themselves, so nothing is formatted when the level is disabled.
+Debug traces inside hot loops are additionally guarded by tracing(log), evaluated once before the loop.
+
+Tracing can be switched off entirely (performance mode) by setting the PACKAGEMANAGER_PERFORMANCE environment
+variable, by running python with -O, or by calling set_performance_mode.
+'''
+import logging
+import os
+
+TRACE = __debug__ and not os.environ.get('PACKAGEMANAGER_PERFORMANCE')
+
+
+def set_performance_mode(enabled: bool = True):
+    '''
+    When enabled, tracing returns False whatever the level of the loggers
+    '''
+    global TRACE
+    TRACE = __debug__ and not enabled
+
+
+def tracing(logger: logging.Logger) -> bool:
+    '''
+    Returns True if debug traces should be emitted on logger
+    '''
+    return TRACE and logger.isEnabledFor(logging.DEBUG)
@@ -1,9 +1,15 @@
+import heapq
 import json
 import logging
+import os
 import itertools as it
 
 from typing import Callable, List, Any, Dict, Tuple, Union, Set, Iterable
 
+from packagemanager import logs
+
+log = logging.getLogger(__name__)
+
 
 class NonUniqueParentException(Exception): pass
 
@@ -82,14 +88,12 @@ class Component:
         :param comp:
         :return:
         '''
-        log = logging.getLogger(__name__)
         if comp.id in (c.id for c in self.subcomponents):
-            log.error('Non Unique ID encountered, component {} already exists in {}'.format(comp.id, self.id))
+            log.error('Non Unique ID encountered, component %s already exists in %s', comp.id, self.id)
             raise NonUniqueIDException
         if comp.parent is not None:
-            log.error('Non Unique Parent encountered, component {} already has {} as a parent before {}'.format(comp.id,
-                                                                                                                comp.parent.id,
-                                                                                                                self.id))
+            log.error('Non Unique Parent encountered, component %s already has %s as a parent before %s', comp.id,
+                      comp.parent.id, self.id)
             raise NonUniqueParentException
 
         self.subcomponents.append(comp)
@@ -154,8 +158,24 @@ class SubComponent(Component):
     """
 
     def __init__(self, componentid: str, name: str,
-                 subcomponents: List["SubComponent"] = None, depends: Dependencies = None):
+                 subcomponents: List["SubComponent"] = None, depends: Dependencies = None, number: int = None):
+        '''
+        number is the number of the component in the setup of its package, if it isn't its id
+        '''
         super().__init__(componentid=componentid, name=name, subcomponents=subcomponents, depends=depends)
+        self.number = number
+
+    def to_dict(self):
+        d = super().to_dict()
+        if self.number is not None:
+            d['number'] = self.number
+        return d
+
+    @classmethod
+    def from_dict(cls, dict_):
+        comp = super().from_dict(dict_)
+        comp.number = dict_.get('number')
+        return comp
 
 
 class Package(Component):
@@ -180,6 +200,16 @@ class Package(Component):
     def generate_install_actions(self, installed_components: List[SubComponent]) -> List["InstallAction"]:
         raise NotImplementedError
 
+    def generate_uninstall_actions(self, installed_components: List[SubComponent]) -> List["InstallAction"]:
+        raise NotImplementedError
+
+    def generate_component_actions(self, components: List[SubComponent], **kwargs) -> List["InstallAction"]:
+        '''
+        Returns the actions installing components of a package whose install actions were already generated, for
+        the components coming later in the install order. By default they are generate_install_actions.
+        '''
+        return self.generate_install_actions(components, **kwargs)
+
     def to_dict(self) -> Dict[str, Any]:
         return {'id': self.id,
                 'name': self.name,
@@ -195,14 +225,15 @@ class Package(Component):
 
     @classmethod
     def save_to_json(cls, pkgdict: Dict[str, "Package"], filename: str):
-        log = logging.getLogger(__name__)
         log.info('Starting dict creation')
+        trace = logs.tracing(log)
         d = {}
         for pkg in pkgdict.values():
-            log.debug('Saving mod {}'.format(pkg.id))
+            if trace:
+                log.debug('Saving mod %s', pkg.id)
             d[pkg.id] = pkg.to_dict()
 
-        log.info('Starting json dump to {}'.format(filename))
+        log.info('Starting json dump to %s', filename)
         with open(file=filename, mode='w', encoding='utf-8') as f:
             json.dump(d, f, indent=4)
 
@@ -210,7 +241,6 @@ class Package(Component):
 
     @classmethod
     def load_from_json(cls, filename: str) -> Dict[str, "Package"]:
-        log = logging.getLogger(__name__)
         log.info('Getting dict object')
         with open(file=filename, mode='r', encoding='utf-8') as f:
             d = json.load(f)
@@ -223,19 +253,88 @@ class Package(Component):
         return pkgdict
 
 
+# Resource classes of the install actions, schedulers can limit the actions of each class separately
+NETWORK = 'network'
+CPU = 'cpu'
+DISK = 'disk'
+
+
 class InstallAction:
     """
 
     """
+    stage: str = None
+    resource: str = None
+    # tools.mapped.MappingLease handed over from an action to the next ones, see abort
+    lease = None
 
-    def __init__(self, installmethod: Callable, args: List[Any], id: str, prev: List["InstallAction"]):
+    def __init__(self, installmethod: Callable, args: List[Any], id: str, prev: List["InstallAction"],
+                 asyncmethod: Callable = None):
+        """
+        installmethod is called with args when the action is executed.
+        asyncmethod is an optional coroutine function taking the same args, used instead of installmethod by
+        execute_async, actions without one run installmethod in an executor.
+        """
         self.method = installmethod
+        self.asyncmethod = asyncmethod
         self.args = args
         self.prev = prev
         self.id = id
 
     def execute(self):
-        self.method(*self.args)
+        return self.method(*self.args)
+
+    def abort(self):
+        '''
+        Called when the action failed or was cancelled, closes the lease it would have released when done
+        '''
+        if self.lease is not None:
+            self.lease.close()
+
+    async def execute_async(self, executor=None):
+        if self.asyncmethod is not None:
+            return await self.asyncmethod(*self.args)
+        # Imported here so that listing packages doesn't load asyncio, it is already loaded by the running loop
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(executor, self.method, *self.args)
+
+
+class DownloadAction(InstallAction):
+    stage = 'download'
+    resource = NETWORK
+
+
+class VerifyAction(InstallAction):
+    stage = 'verify'
+    resource = CPU
+
+
+class ExtractAction(InstallAction):
+    stage = 'extract'
+    resource = CPU
+
+
+class MergeAction(InstallAction):
+    stage = 'merge'
+    resource = DISK
+
+
+class InstallScriptAction(InstallAction):
+    stage = 'install-script'
+    resource = CPU
+
+
+class CleanupAction(InstallAction):
+    stage = 'cleanup'
+    resource = DISK
+
+
+# Stages working in the game directory, actions without a stage are assumed to work there too
+GAME_STAGES = (MergeAction.stage, InstallScriptAction.stage)
+
+
+def in_game_directory(action: InstallAction) -> bool:
+    return action.stage is None or action.stage in GAME_STAGES
 
 
 class IncompatibleActionsException(Exception): pass
@@ -262,11 +361,13 @@ class Selection:
         self.components.remove(comp)
 
     def get_components_id(self) -> List[str]:
-        log = logging.getLogger(__name__)
-        log.info('Getting components ids')
+        trace = logs.tracing(log)
+        if trace:
+            log.debug('Getting components ids')
         res = []
         for comp in self.components:
-            log.debug('Getting ancestors id for {}'.format(comp.id))
+            if trace:
+                log.debug('Getting ancestors id for %s', comp.id)
             res.append(comp.get_full_id())
         return res
 
@@ -278,30 +379,36 @@ class Selection:
 
 
 def sortInstallActionList(actions: List[InstallAction]) -> List[InstallAction]:
-    log = logging.getLogger(__name__)
     # depth first search into topologic sort
     sortedList = []
+    trace = logs.tracing(log)
 
     def depthFirstSort(action):
 
+        # Predecessors that are not in the list are new nodes
+        state = getattr(action, 'state', 0)
+
         # Open node
-        if action.state == 1:
-            log.error(
-                'There is a loop in the action list, the action {} is within its predecessors'.format(action.id))
+        if state == 1:
+            log.error('There is a loop in the action list, the action %s is within its predecessors', action.id)
             raise IncompatibleActionsException('There is a loop in the ')
 
         # Closed node
-        if action.state == 2:
-            log.debug('Action {} is closed, nothing new here'.format(action.id))
+        if state == 2:
+            if trace:
+                log.debug('Action %s is closed, nothing new here', action.id)
             return
 
         # New node
-        log.debug('Opening {}'.format(action.id))
+        if trace:
+            log.debug('Opening %s', action.id)
         action.state = 1
         for prevAction in action.prev:
-            log.debug('Looking at child {}'.format(action.id))
+            if trace:
+                log.debug('Looking at child %s', prevAction.id)
             depthFirstSort(prevAction)
-        log.debug('Closing {}'.format(action.id))
+        if trace:
+            log.debug('Closing %s', action.id)
         action.state = 2
         sortedList.append(action)
 
@@ -309,16 +416,78 @@ def sortInstallActionList(actions: List[InstallAction]) -> List[InstallAction]:
         action.state = 0
 
     for action in actions:
-        log.debug('Initialising search on action {}'.format(action.id))
+        if trace:
+            log.debug('Initialising search on action %s', action.id)
         # noinspection PyTypeChecker
         depthFirstSort(action)
 
-    for action in actions:
+    for action in sortedList:
         del action.state
 
     return sortedList
 
 
+class IncompatibleOrderException(Exception): pass
+
+
+class InstalledState:
+    '''
+    Full ids of the components installed in a game directory, in install order.
+    Installs record it in the FILENAME file of the game directory, see load_from_game and save_to_game.
+    '''
+    FILENAME = 'installed.json'
+
+    def __init__(self, components: Iterable[str] = None):
+        self.components: List[str] = list(components) if components else []
+
+    @classmethod
+    def game_file(cls, gamedir: str) -> str:
+        return os.path.join(gamedir, cls.FILENAME)
+
+    @classmethod
+    def load_from_game(cls, gamedir: str) -> "InstalledState":
+        return cls.load_from_json(cls.game_file(gamedir))
+
+    def save_to_game(self, gamedir: str):
+        self.save_to_json(self.game_file(gamedir))
+
+    def save_to_json(self, filename: str):
+        with open(file=filename, mode='w', encoding='utf-8') as f:
+            json.dump({'components': self.components}, f, indent=4)
+
+    @classmethod
+    def load_from_json(cls, filename: str) -> "InstalledState":
+        '''
+        Returns an empty state if filename doesn't exist
+        '''
+        if not os.path.isfile(filename):
+            return cls()
+        with open(file=filename, mode='r', encoding='utf-8') as f:
+            return cls(json.load(f)['components'])
+
+
+class SelectionDiff:
+    '''
+    Changes needed to go from an installed state to a selection.
+    The first kept components of the install order are left untouched, the rest of the installed components are
+    uninstalled in reverse install order and the rest of the new order is installed. Components both uninstalled
+    and installed are listed in reinstall.
+    '''
+
+    def __init__(self, order: List[str], kept: int, uninstall: List[str], install: List[str]):
+        self.order = order
+        self.kept = kept
+        self.uninstall = uninstall
+        self.install = install
+        self.reinstall = [c for c in install if c in set(uninstall)]
+
+    def __bool__(self):
+        return bool(self.uninstall or self.install)
+
+    def __repr__(self):
+        return 'SelectionDiff(kept={}, uninstall={}, install={})'.format(self.kept, self.uninstall, self.install)
+
+
 class UnavailablePackageException(Exception): pass
 
 
@@ -343,8 +512,7 @@ class Manager:
         :param pkg:
         :return:
         '''
-        log = logging.getLogger(__name__)
-        log.info('Adding Package {} to the Manager'.format(pkg.id))
+        log.info('Adding Package %s to the Manager', pkg.id)
 
         if pkg.id in self.availablepkg:
             log.error('The package id already exists in the manager')
@@ -364,8 +532,7 @@ class Manager:
         :param pkg:
         :return:
         '''
-        log = logging.getLogger(__name__)
-        log.info('Selecting Package {}'.format(pkg.id))
+        log.info('Selecting Package %s', pkg.id)
 
         if pkg.id not in self.availablepkg:
             raise UnavailablePackageException
@@ -394,10 +561,102 @@ class Manager:
                     self.getcomp(conflict).nb_conflicts += 1
                 s.select_component(comp)
 
+    def select_components(self, components: Iterable[Component], raiseconflicts=True):
+        '''
+        Selects components of any number of packages in one pass.
+        Conflicts are checked once all the components are selected instead of once per package: if a selected
+        component conflicts with another one and raiseconflicts is True, none of components is selected and
+        PackageHasConflictException is raised with the full ids of the conflicting components.
+        '''
+        trace = logs.tracing(log)
+        added: Dict[str, List[Component]] = {}
+        for comp in components:
+            ancestors = comp.get_ancestors()
+            pkg = ancestors[0] if ancestors else comp
+            if pkg.id not in self.availablepkg:
+                raise UnavailablePackageException(pkg.id)
+            if pkg.id not in self.selectedpkg:
+                self.selectedpkg[pkg.id] = Selection(pkg)
+            s = self.selectedpkg[pkg.id]
+            if comp in s.components:
+                continue
+            if trace:
+                log.debug('Selecting %s', comp.get_full_id())
+            s.select_component(comp)
+            added.setdefault(pkg.id, []).append(comp)
+
+        targets = []
+        for comps in added.values():
+            for comp in comps:
+                for conflict in comp.get_dependencies().conflicts:
+                    target = self.getcomp(conflict)
+                    target.nb_conflicts += 1
+                    targets.append(target)
+        log.info('Selected %s components of %s packages', sum(map(len, added.values())), len(added))
+
+        if raiseconflicts:
+            incompatible = {comp.get_full_id() for pkgid, comps in added.items() for comp in comps
+                            if comp.nb_conflicts > 0 or self.availablepkg[pkgid].nb_conflicts > 0}
+            incompatible.update(t.get_full_id() for t in targets if self.is_selected(t))
+            if incompatible:
+                for pkgid, comps in added.items():
+                    self.unselect_package(self.availablepkg[pkgid], comps)
+                raise PackageHasConflictException(sorted(incompatible))
+
+    def is_selected(self, comp: Component) -> bool:
+        ancestors = comp.get_ancestors()
+        if not ancestors:
+            return comp.id in self.selectedpkg
+        s = self.selectedpkg.get(ancestors[0].id)
+        return s is not None and comp in s.components
+
+    def clear_selection(self):
+        for selection in list(self.selectedpkg.values()):
+            self.unselect_package(selection.pkg, list(selection.components))
+
+    def save_selection(self, filename: str):
+        '''
+        Saves the full ids of the selected components to filename, one per line
+        '''
+        log.info('Saving selection to %s', filename)
+        with open(file=filename, mode='w', encoding='utf-8') as f:
+            for selection in self.selectedpkg.values():
+                f.writelines(cid + '\n' for cid in selection.get_components_id())
+
+    def load_selection(self, filename: str, raiseconflicts=True):
+        '''
+        Replaces the current selection with the one saved in filename by save_selection, blank lines and lines
+        starting with # are ignored.
+        Raises UnexistingComponentException with the unknown ids if some components aren't available, and
+        PackageHasConflictException as select_components, the current selection is kept in both cases.
+        '''
+        log.info('Loading selection from %s', filename)
+        comps = []
+        missing = []
+        with open(file=filename, mode='r', encoding='utf-8') as f:
+            for line in f:
+                cid = line.strip()
+                if not cid or cid.startswith('#'):
+                    continue
+                try:
+                    comps.append(self.getcomp(cid))
+                except (KeyError, UnexistingComponentException):
+                    missing.append(cid)
+        if missing:
+            log.error('Unknown components in %s: %s', filename, missing)
+            raise UnexistingComponentException(missing)
+
+        previous = [c for selection in self.selectedpkg.values() for c in selection.components]
+        self.clear_selection()
+        try:
+            self.select_components(comps, raiseconflicts)
+        except PackageHasConflictException:
+            self.select_components(previous, raiseconflicts=False)
+            raise
+
     def unselect_package(self, pkg: Package, components: List[Component]):
 
-        log = logging.getLogger(__name__)
-        log.info('Unselecting components from Package {}'.format(pkg.id))
+        log.info('Unselecting components from Package %s', pkg.id)
 
         if pkg.id not in self.availablepkg:
             raise UnavailablePackageException
@@ -417,14 +676,131 @@ class Manager:
             self.selectedpkg.pop(pkg.id)
 
     def getcomp(self, compid: str):
-        ids = '.'.split(compid)
+        ids = compid.split('.')
         c = self.availablepkg[ids[0]]
         for id_ in ids[1:]:
             c = c.get_comp(id_)
         return c
 
-    def generate_action_list(self):
-        self.installActions: List[InstallAction] = []
+    def _chain_steps(self, steps: Iterable[Tuple[str, bool]], **kwargs) -> List[InstallAction]:
+        '''
+        Returns the actions applying steps, (component full id, install) pairs in the order they are applied.
+        Consecutive steps of the same package are handled by a single call to its generate_uninstall_actions,
+        generate_install_actions or, for the later groups of a package, generate_component_actions.
+        The actions working in the game directory (see in_game_directory) of each group start once the ones of the
+        previous group are done, the other stages, like downloads and extractions, run as soon as they can.
+        '''
+        actions: List[InstallAction] = []
+        generated = set()
+        last = None
+        for (pkgid, install), group in it.groupby(steps, key=lambda s: (s[0].split('.')[0], s[1])):
+            pkg = self.availablepkg[pkgid]
+            comps = [self.getcomp(cid) for cid, _ in group]
+            if not install:
+                group_actions = pkg.generate_uninstall_actions(comps, **kwargs)
+            elif pkgid in generated:
+                group_actions = pkg.generate_component_actions(comps, **kwargs)
+            else:
+                generated.add(pkgid)
+                group_actions = pkg.generate_install_actions(comps, **kwargs)
+            game = [a for a in group_actions if in_game_directory(a)]
+            for action in game:
+                # Only the first game directory actions of the group wait, the others follow them
+                if last is not None and not any(p in game for p in action.prev):
+                    action.prev.append(last)
+            actions.extend(group_actions)
+            last = game[-1] if game else last
+        return actions
+
+    def generate_action_list(self, **kwargs):
+        '''
+        Returns the install actions of the selected components in install order, kwargs are passed to the
+        generate_install_actions of the packages. The packages work in the game directory one after the other,
+        see _chain_steps.
+        '''
+        self.installActions = self._chain_steps(((cid, True) for cid in self.install_order()), **kwargs)
+        return self.installActions
+
+    def install_order(self, previous: Iterable[str] = ()) -> List[str]:
+        '''
+        Returns the full ids of the selected components in an order respecting their before and after constraints.
+        A constraint on a component also applies to its subcomponents, constraints on unselected components are
+        ignored. Components keep their order in previous when the constraints allow it, the others follow in
+        selection order.
+        Raises IncompatibleOrderException if the constraints contain a loop.
+        '''
+        trace = logs.tracing(log)
+        comps = {}
         for selection in self.selectedpkg.values():
-            self.installActions.extend(selection.pkg.generate_install_actions(selection.components))
+            for comp in selection.components:
+                comps[comp.get_full_id()] = comp
+        rank = {cid: i for i, cid in enumerate(c for c in previous if c in comps)}
+        for cid in comps:
+            rank.setdefault(cid, len(rank))
+
+        # Components matched by a constraint id, the id of a component matches it and its subcomponents
+        matches: Dict[str, List[str]] = {}
+        for cid in comps:
+            parts = cid.split('.')
+            for i in range(1, len(parts) + 1):
+                matches.setdefault('.'.join(parts[:i]), []).append(cid)
+
+        successors: Dict[str, Set[str]] = {cid: set() for cid in comps}
+        for cid, comp in comps.items():
+            depends = comp.get_dependencies()
+            for other in depends.before:
+                successors[cid].update(c for c in matches.get(other, ()) if c != cid)
+            for other in depends.after:
+                for c in matches.get(other, ()):
+                    if c != cid:
+                        successors[c].add(cid)
+
+        indegree = {cid: 0 for cid in comps}
+        for succ in successors.values():
+            for cid in succ:
+                indegree[cid] += 1
+        ready = [(rank[cid], cid) for cid, n in indegree.items() if n == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            _, cid = heapq.heappop(ready)
+            if trace:
+                log.debug('Ordering %s', cid)
+            order.append(cid)
+            for succ in successors[cid]:
+                indegree[succ] -= 1
+                if indegree[succ] == 0:
+                    heapq.heappush(ready, (rank[succ], succ))
+
+        if len(order) != len(comps):
+            loop = sorted(cid for cid, n in indegree.items() if n > 0)
+            log.error('The before and after constraints of %s contain a loop', loop)
+            raise IncompatibleOrderException(loop)
+        return order
+
+    def diff(self, installed: InstalledState) -> SelectionDiff:
+        '''
+        Returns the minimal changes from installed to the current selection: components installed after the first
+        difference between the installed order and the new install order are uninstalled, then the rest of the new
+        order is installed.
+        '''
+        order = self.install_order(installed.components)
+        kept = 0
+        for old, new in zip(installed.components, order):
+            if old != new:
+                break
+            kept += 1
+        diff = SelectionDiff(order, kept, installed.components[kept:][::-1], order[kept:])
+        log.info('%s components kept, %s to uninstall, %s to install', kept, len(diff.uninstall), len(diff.install))
+        return diff
+
+    def generate_diff_action_list(self, diff: SelectionDiff, **kwargs) -> List[InstallAction]:
+        '''
+        Returns the actions applying diff, the uninstalls then the installs, grouped and chained as in
+        generate_action_list: a package installed in several groups is only fetched and merged once.
+        kwargs are passed to the generate_install_actions, generate_component_actions and generate_uninstall_actions
+        of the packages.
+        '''
+        steps = [(cid, False) for cid in diff.uninstall] + [(cid, True) for cid in diff.install]
+        self.installActions = self._chain_steps(steps, **kwargs)
         return self.installActions
@@ -0,0 +1,113 @@
+import itertools as it
+import logging
+import os
+from typing import Callable, Dict, List, Tuple
+
+from packagemanager import manager as mngr
+from packagemanager.tools import Utils
+
+log = logging.getLogger(__name__)
+
+
+class Profile:
+    '''
+    Selection of a game install: manager holds the selection and gamedir is the directory of the game
+    '''
+
+    def __init__(self, name: str, manager: mngr.Manager, gamedir: str):
+        self.name = name
+        self.manager = manager
+        self.gamedir = gamedir
+
+    def __repr__(self):
+        return 'Profile({!r}, {!r})'.format(self.name, self.gamedir)
+
+
+class MultiProfileInstall:
+    '''
+    Installs the selections of several profiles with a single download and extraction pipeline.
+    Packages selected by several profiles with the same version share an archive: it is downloaded once into
+    cachedir, extracted once into stagingdir, then copied into the game directory of each profile but the last one,
+    which gets the extracted files moved before the staging directory is removed. Each merge is followed by the
+    setup of the selected components in the game directory, the merges and setups of a profile happen in its
+    install order (see Manager.install_order), one after the other.
+    It has the generate_action_list method of a Manager, so AsyncInstaller.install accepts it.
+    merge and copy default to Utils.MergeFolderTo and Utils.CopyFolderTo, extract to the one chosen by
+    extraction.SelectExtract for each archive.
+    '''
+
+    def __init__(self, profiles: List[Profile], cachedir: str = '.', stagingdir: str = 'staging',
+                 extract: Callable = None, merge: Callable = Utils.MergeFolderTo,
+                 copy: Callable = Utils.CopyFolderTo):
+        self.profiles = profiles
+        self.cachedir = cachedir
+        self.stagingdir = stagingdir
+        self.extract = extract
+        self.merge = merge
+        self.copy = copy
+
+    def archives(self) -> Dict[Tuple[str, str], Tuple[mngr.Package, List[Profile]]]:
+        '''
+        Returns the packages to install by (id, version) with the profiles selecting them, in selection order
+        '''
+        archives = {}
+        for profile in self.profiles:
+            for selection in profile.manager.selectedpkg.values():
+                key = (selection.pkg.id, str(getattr(selection.pkg, 'version', '')))
+                if key not in archives:
+                    archives[key] = (selection.pkg, [])
+                archives[key][1].append(profile)
+        return archives
+
+    def generate_action_list(self) -> List[mngr.InstallAction]:
+        self.installActions: List[mngr.InstallAction] = []
+        merges: Dict[Tuple[Profile, Tuple[str, str]], mngr.InstallAction] = {}
+        extracts = {}
+        archives = self.archives()
+        for key, (pkg, profiles) in archives.items():
+            archive = os.path.join(self.cachedir, pkg.get_archive_name())
+            staging = os.path.join(self.stagingdir, pkg.get_staging_name())
+            download = pkg.generate_download_action(self.cachedir)
+            verify = pkg.generate_verify_action(download, self.cachedir)
+            extract = pkg.generate_extract_action(verify, self.cachedir, self.stagingdir)
+            extract.args.append(self.extract)
+            extracts[key] = staging, extract
+            self.installActions.extend([download, verify, extract])
+            log.info('%s is shared by %s profiles', archive, len(profiles))
+
+        for profile in self.profiles:
+            last = None
+            # Consecutive components of a package in the install order of the profile form a group, like in
+            # Manager._chain_steps: the first group of a package is merged, the later ones only run their setup
+            order = profile.manager.install_order()
+            for pkgid, group in it.groupby(order, key=lambda cid: cid.split('.')[0]):
+                pkg = profile.manager.availablepkg[pkgid]
+                comps = [profile.manager.getcomp(cid) for cid in group]
+                key = (pkg.id, str(getattr(pkg, 'version', '')))
+                if (profile, key) in merges:
+                    group_actions = pkg.generate_component_actions(comps, gamedir=profile.gamedir)
+                else:
+                    staging, extract = extracts[key]
+                    moves = archives[key][1][-1] is profile
+                    action = mngr.MergeAction(installmethod=self.merge if moves else self.copy,
+                                              args=[staging, profile.gamedir],
+                                              id='{} {}'.format('Merge' if moves else 'Copy', pkg.name),
+                                              prev=[extract])
+                    merges[profile, key] = action
+                    script = pkg.generate_script_action(comps, profile.gamedir)
+                    script.prev.append(action)
+                    group_actions = [action, script]
+                for action in group_actions:
+                    action.id += ' into {}'.format(profile.name)
+                if last is not None:
+                    group_actions[0].prev.append(last)
+                last = group_actions[-1]
+                self.installActions.extend(group_actions)
+
+        # The extracted files are moved by the last profile, once every other profile has its copy, then what is
+        # left of the staging directory is removed
+        for key, (pkg, profiles) in archives.items():
+            move = merges[profiles[-1], key]
+            move.prev.extend(merges[p, key] for p in profiles[:-1])
+            self.installActions.append(pkg.generate_cleanup_action(move, self.stagingdir))
+        return self.installActions
@@ -0,0 +1,178 @@
+import logging
+import os
+import shutil
+from typing import Dict, List
+
+from packagemanager import manager as mngr
+
+log = logging.getLogger(__name__)
+
+
+class InsufficientDiskSpaceException(Exception): pass
+
+
+def existing_parent(path: str) -> str:
+    '''
+    Returns path or its closest existing ancestor
+    '''
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class Volume:
+    '''
+    Disk space budget of a volume, shared by every install directory located on it
+    '''
+
+    def __init__(self, device: int, path: str, free: int, reserve: int):
+        self.device = device
+        self.path = path
+        self.free = free
+        self.reserve = reserve
+        self.required = 0
+        self.roles: List[str] = []
+
+    @property
+    def available(self) -> int:
+        return max(self.free - self.reserve, 0)
+
+    @property
+    def shortfall(self) -> int:
+        return max(self.required - self.available, 0)
+
+    def __repr__(self):
+        return 'Volume({!r}, roles={}, required={}, available={})'.format(self.path, self.roles, self.required,
+                                                                         self.available)
+
+
+class InstallPlan:
+    '''
+    Disk usage estimate of the installation of a selection, see plan_install
+    '''
+
+    def __init__(self):
+        self.archives: Dict[str, int] = {}
+        self.cached: List[str] = []
+        self.unknown: List[str] = []
+        self.download_bytes = 0
+        self.extracted_bytes = 0
+        self.peak_staging_bytes = 0
+        self.download_concurrency = 1
+        self.extraction_concurrency = 1
+        self.volumes: Dict[int, Volume] = {}
+
+    @property
+    def shortfalls(self) -> List[Volume]:
+        return [v for v in self.volumes.values() if v.shortfall]
+
+    @property
+    def ok(self) -> bool:
+        return not self.shortfalls
+
+    def check(self) -> "InstallPlan":
+        '''
+        Raises InsufficientDiskSpaceException if a volume doesn't have enough free space
+        '''
+        if self.shortfalls:
+            raise InsufficientDiskSpaceException(
+                ['{} ({}) is missing {} bytes'.format(v.path, '/'.join(v.roles), v.shortfall)
+                 for v in self.shortfalls])
+        return self
+
+    def summary(self) -> str:
+        lines = ['{} archives, {} bytes to download, ~{} bytes extracted, ~{} bytes peak staging'.format(
+            len(self.archives), self.download_bytes, self.extracted_bytes, self.peak_staging_bytes),
+            '{} concurrent downloads, {} concurrent extractions'.format(self.download_concurrency,
+                                                                       self.extraction_concurrency)]
+        if self.unknown:
+            lines.append('Unknown archive size for {}'.format(', '.join(self.unknown)))
+        for v in self.volumes.values():
+            lines.append('{} ({}): {} bytes required, {} bytes available'.format(v.path, '/'.join(v.roles),
+                                                                                v.required, v.available))
+        return '\n'.join(lines)
+
+
+def largest_sum(sizes: List[int], n: int) -> int:
+    return sum(sorted(sizes, reverse=True)[:n])
+
+
+def plan_install(manager: mngr.Manager, cachedir: str, stagingdir: str, gamedir: str, expansion: float = 2.5,
+                 reserve: int = 100 * 2 ** 20, maxdownloads: int = 4, maxextractions: int = 2,
+                 keep_archives: bool = True, default_size: int = None) -> InstallPlan:
+    '''
+    Estimates the disk space needed to install the current selection of manager.
+    Archive sizes come from the size of the packages, packages without one count as default_size (or nothing) and
+    are listed in the plan as unknown. Archives already present in cachedir are not downloaded again.
+    Extracted archives are estimated to take expansion times the size of the archive, they stay in stagingdir
+    until they are merged into gamedir.
+    Directories on the same volume share its free space, of which reserve bytes are kept untouched.
+    The concurrency of the extractions is the highest one, up to maxextractions, for which the largest extractions
+    fit in the staging space. If keep_archives is False archives are expected to be removed once extracted, and
+    the concurrency of the downloads is chosen so that the largest archives in flight fit in the cache, otherwise
+    the cache has to hold every archive and downloads run maxdownloads at a time.
+    Returns an InstallPlan, call its check method to raise InsufficientDiskSpaceException on shortfalls.
+    '''
+    plan = InstallPlan()
+    for selection in manager.selectedpkg.values():
+        pkg = selection.pkg
+        size = getattr(pkg, 'size', None)
+        if size is None:
+            plan.unknown.append(pkg.id)
+            size = default_size or 0
+        plan.archives[pkg.id] = size
+        if hasattr(pkg, 'get_archive_name') and os.path.isfile(os.path.join(cachedir, pkg.get_archive_name())):
+            plan.cached.append(pkg.id)
+
+    to_download = [size for pkgid, size in plan.archives.items() if pkgid not in plan.cached]
+    extracted = [int(size * expansion) for size in plan.archives.values()]
+    plan.download_bytes = sum(to_download)
+    plan.extracted_bytes = sum(extracted)
+
+    def volume(path, role):
+        path = existing_parent(path)
+        device = os.stat(path).st_dev
+        if device not in plan.volumes:
+            plan.volumes[device] = Volume(device, path, shutil.disk_usage(path).free, reserve)
+        v = plan.volumes[device]
+        v.roles.append(role)
+        return v
+
+    cache, staging, game = volume(cachedir, 'cache'), volume(stagingdir, 'staging'), volume(gamedir, 'game')
+
+    # Merged files end up in the game directory
+    game.required += plan.extracted_bytes
+
+    if keep_archives:
+        cache.required += plan.download_bytes
+
+    # Extracted files are moved to the game directory when it is on the same volume, so they only take
+    # additional space when the staging directory is on another volume
+    staging_budget = staging.available - staging.required
+    plan.extraction_concurrency = 1
+    for k in range(maxextractions, 0, -1):
+        if staging is game or largest_sum(extracted, k) <= staging_budget:
+            plan.extraction_concurrency = k
+            break
+    plan.peak_staging_bytes = largest_sum(extracted, plan.extraction_concurrency)
+    if staging is not game:
+        staging.required += plan.peak_staging_bytes
+
+    if keep_archives:
+        plan.download_concurrency = maxdownloads
+    else:
+        # Archives are kept until extracted, in flight are the downloads and the archives being extracted
+        cache_budget = cache.available - cache.required
+        plan.download_concurrency = 1
+        for k in range(maxdownloads, 0, -1):
+            if largest_sum(to_download, k + plan.extraction_concurrency) <= cache_budget:
+                plan.download_concurrency = k
+                break
+        cache.required += largest_sum(to_download, plan.download_concurrency + plan.extraction_concurrency)
+
+    log.info('Install plan:\n%s', plan.summary())
+    return plan
@@ -0,0 +1,158 @@
+import bisect
+import configparser
+import logging
+import os
+import re
+from typing import Dict, Iterator, List, Tuple
+
+from packagemanager import logs
+from packagemanager import manager as mngr
+
+log = logging.getLogger(__name__)
+
+TOKEN = re.compile(r'\w+')
+
+# Weight of a match in each field, names matter more than descriptions
+FIELD_WEIGHTS = {'id': 8, 'name': 5, 'component': 3, 'desc': 2, 'ini': 1}
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(text.lower())
+
+
+def read_ini(filename: str) -> configparser.ConfigParser:
+    '''
+    Parses a mod INI file, the files of the catalog are either UTF-8 or Latin-1.
+    Keys keep their case, the [Tp2] section holds the setup filename as a key.
+    '''
+    for encoding in ('utf-8', 'latin-1'):
+        ini = configparser.ConfigParser(interpolation=None, strict=False, allow_no_value=True)
+        ini.optionxform = str
+        try:
+            with open(filename, encoding=encoding) as f:
+                ini.read_file(f)
+        except UnicodeDecodeError:
+            continue
+        return ini
+    raise ValueError(filename)
+
+
+class CatalogIndex:
+    '''
+    Inverted index of the catalog mapping tokens to the ids of the packages containing them.
+    The package ids, names, descriptions and component names are indexed with add_package, the component names
+    and descriptions of the mod INI files with add_ini.
+    Tokens are kept sorted so that prefix queries are a binary search, substring queries scan the tokens.
+    '''
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self._tokens: List[str] = []
+        self._sorted = True
+
+    def __len__(self):
+        return len(self.postings)
+
+    def add(self, pkgid: str, field: str, text: str):
+        weight = FIELD_WEIGHTS[field]
+        for token in tokenize(text):
+            postings = self.postings.get(token)
+            if postings is None:
+                self.postings[token] = postings = {}
+                self._sorted = False
+            if postings.get(pkgid, 0) < weight:
+                postings[pkgid] = weight
+
+    def add_package(self, pkg: mngr.Package):
+        self.add(pkg.id, 'id', pkg.id)
+        self.add(pkg.id, 'name', pkg.name)
+        desc = getattr(pkg, 'desc', None)
+        if desc:
+            self.add(pkg.id, 'desc', desc)
+        for comp in pkg.get_childrens():
+            self.add(pkg.id, 'component', comp.name)
+
+    def add_ini(self, filename: str, pkgid: str = None):
+        '''
+        Indexes the [WeiDU-XX] and [Description] sections of a mod INI file under pkgid, which defaults to the name
+        of the file without its extension
+        '''
+        if pkgid is None:
+            pkgid = os.path.splitext(os.path.basename(filename))[0]
+        ini = read_ini(filename)
+        for section in ini.sections():
+            if section.startswith('WeiDU-') or section == 'Description':
+                for key, value in ini.items(section):
+                    if value and key.lower() != 'tra':
+                        self.add(pkgid, 'ini', value)
+
+    @classmethod
+    def from_manager(cls, manager: mngr.Manager, inidir: str = None) -> "CatalogIndex":
+        '''
+        Returns the index of the available packages of manager and of the INI files of inidir matching them
+        '''
+        index = cls()
+        trace = logs.tracing(log)
+        for pkg in manager.availablepkg.values():
+            if trace:
+                log.debug('Indexing %s', pkg.id)
+            index.add_package(pkg)
+        if inidir is not None and os.path.isdir(inidir):
+            with os.scandir(inidir) as it:
+                for entry in it:
+                    pkgid, ext = os.path.splitext(entry.name)
+                    if ext.lower() == '.ini' and pkgid in manager.availablepkg:
+                        try:
+                            index.add_ini(entry.path, pkgid)
+                        except (ValueError, configparser.Error):
+                            log.exception('Could not index %s', entry.path)
+        log.info('Indexed %s tokens', len(index))
+        return index
+
+    @property
+    def tokens(self) -> List[str]:
+        if not self._sorted:
+            self._tokens = sorted(self.postings)
+            self._sorted = True
+        return self._tokens
+
+    def prefix(self, prefix: str) -> Iterator[str]:
+        '''
+        Yields the indexed tokens starting with prefix
+        '''
+        tokens = self.tokens
+        for i in range(bisect.bisect_left(tokens, prefix), len(tokens)):
+            if not tokens[i].startswith(prefix):
+                break
+            yield tokens[i]
+
+    def substring(self, part: str) -> Iterator[str]:
+        return (token for token in self.tokens if part in token)
+
+    def _term_scores(self, term: str, substring: bool) -> Dict[str, float]:
+        # Exact matches count double, prefix matches and substring matches count once and half
+        scores = {pkgid: 2 * w for pkgid, w in self.postings.get(term, {}).items()}
+        for factor, tokens in ((1, self.prefix(term)), (0.5, self.substring(term) if substring else ())):
+            for token in tokens:
+                for pkgid, w in self.postings[token].items():
+                    if scores.get(pkgid, 0) < w * factor:
+                        scores[pkgid] = w * factor
+        return scores
+
+    def search(self, query: str, limit: int = 20, substring: bool = False) -> List[Tuple[str, float]]:
+        '''
+        Returns the ids of the packages matching every word of query with their score, best first.
+        A word matches the tokens it is equal to or a prefix of, or contained in if substring is True.
+        '''
+        results = None
+        for term in tokenize(query):
+            scores = self._term_scores(term, substring)
+            if results is None:
+                results = scores
+            else:
+                results = {pkgid: s + scores[pkgid] for pkgid, s in results.items() if pkgid in scores}
+            if not results:
+                return []
+        if results is None:
+            return []
+        return sorted(results.items(), key=lambda r: (-r[1], r[0]))[:limit]
@@ -1,9 +1,20 @@
+import collections
+import concurrent.futures
+import fnmatch
+import functools
 import os
 import re
 import stat
 import logging
 import shutil
+import threading
 import time
+import uuid
+
+from packagemanager import logs
+from . import progress
+
+log = logging.getLogger(__name__)
 
 
 def onerror(func, path, exc_info):
@@ -11,33 +22,146 @@ def onerror(func, path, exc_info):
     func(path)
 
 
+class RegexSeq:
+    '''
+    Compiled form of a sequence of bytes regex templates, as used by RegexBytesSeq.
+    Templates can reference the named groups matched by previous templates with %(name)s, templates without
+    references are compiled once, the others are compiled once per distinct set of referenced values and kept in
+    a cache of at most maxcache patterns, the least recently used patterns being evicted first.
+    '''
+    _keypat = re.compile(rb'%\((\w+)\)')
+
+    def __init__(self, templates, maxcache: int = 256):
+        self.templates = list(templates)
+        self.maxcache = maxcache
+        self._names = [tuple(dict.fromkeys(self._keypat.findall(t))) for t in self.templates]
+        self._static = [None if names else re.compile(t % {}) for t, names in zip(self.templates, self._names)]
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.templates)
+
+    def pattern(self, index: int, keywords):
+        '''
+        Returns the compiled pattern of the template at index once keywords are substituted
+        '''
+        static = self._static[index]
+        if static is not None:
+            return static
+        key = (index,) + tuple(keywords.get(n) for n in self._names[index])
+        try:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        except KeyError:
+            pass
+        compiled = re.compile(self.templates[index] % keywords)
+        self._cache[key] = compiled
+        if len(self._cache) > self.maxcache:
+            self._cache.popitem(last=False)
+        return compiled
+
+    def search(self, bstring: bytes, keywords=None):
+        '''
+        Searches each template in bstring, see RegexBytesSeq.
+        keywords is updated with the named groups that matched.
+        '''
+        if keywords is None:
+            keywords = {}
+        groups = []
+        trace = logs.tracing(log)
+        if trace:
+            log.debug('Base keywords : %s', keywords)
+        for i in range(len(self.templates)):
+            if trace:
+                log.debug('Current re is %s', self.templates[i])
+            match = self.pattern(i, keywords).search(bstring)
+            if match:
+                keywords.update({k.encode(): v for k, v in match.groupdict().items()})
+                if trace:
+                    log.debug('New keywords : %s', keywords)
+                groups.append(match.groups())
+        return groups
+
+    def scanner(self, keywords=None) -> "RegexSeqScanner":
+        return RegexSeqScanner(self, keywords)
+
+    def scan(self, chunks, keywords=None):
+        '''
+        Searches the templates in an iterable of bytes chunks, such as the stdout of a running tool
+        '''
+        scanner = self.scanner(keywords)
+        for chunk in chunks:
+            scanner.feed(chunk)
+        return scanner.close()
+
+
+class RegexSeqScanner:
+    '''
+    Incremental search of a RegexSeq over streamed output.
+    Templates are matched in order as soon as the buffered output contains a match, a template that has not matched
+    yet holds back the following ones until close, where the remaining templates are searched in the complete output
+    and skipped if they don't match, like RegexSeq.search does.
+    Since a match is accepted as soon as it appears, templates should end on a delimiter (such as a line end)
+    rather than on an open-ended repetition.
+    '''
+
+    def __init__(self, seq: RegexSeq, keywords=None):
+        self.seq = seq
+        self.keywords = keywords if keywords is not None else {}
+        self.groups = []
+        self._index = 0
+        self._buffer = bytearray()
+
+    def _match(self, index):
+        match = self.seq.pattern(index, self.keywords).search(self._buffer)
+        if match:
+            self.keywords.update({k.encode(): v for k, v in match.groupdict().items()})
+            self.groups.append(match.groups())
+        return match
+
+    def feed(self, chunk: bytes):
+        self._buffer += chunk
+        while self._index < len(self.seq) and self._match(self._index):
+            self._index += 1
+
+    def close(self):
+        while self._index < len(self.seq):
+            self._match(self._index)
+            self._index += 1
+        return self.groups
+
+
+@functools.lru_cache(maxsize=64)
+def _compiled_seq(templates: tuple) -> RegexSeq:
+    return RegexSeq(templates)
+
+
 def RegexBytesSeq(Regstr, bstring: bytes, keywords=None):
     '''
     Regstr is a list of bytes strings representing regex patterns. Any keywords will be fed back to
     the next elements.
     bstring if os bytes type.
+    Regstr can also be a RegexSeq, other sequences are compiled once and cached.
     :param Regstr:
     :return:
     '''
-
-    if keywords is None:
-        keywords = {}
-    groups = []
-    logging.info('Base keywords : {}'.format(keywords))
-    for s in Regstr:
-        logging.info('Current re is {}'.format(s))
-        match = re.search(s % keywords, bstring)
-        if match:
-            keywords.update({k.encode(): v for k, v in match.groupdict().items()})
-            logging.info('New keywords : {}'.format(keywords))
-            groups.append(match.groups())
-
-    return groups
+    if not isinstance(Regstr, RegexSeq):
+        Regstr = _compiled_seq(tuple(Regstr))
+    return Regstr.search(bstring, keywords)
 
 
-def MergeFolderTo(src, dst, samedrive=-1):
-    srcl = os.listdir(src)
-    dstl = os.listdir(dst)
+def MergeFolderTo(src, dst, samedrive=-1, _progress=None):
+    '''
+    Moves the content of src into dst, replacing existing files.
+    Returns a tuple of flags (copy_ok, delete_ok).
+    The number of merged entries is published on progress.bus under the 'merge' stage when it has subscribers.
+    '''
+    toplevel = _progress is None
+    if toplevel and progress.bus.active:
+        _progress = [src, 0]
+    with os.scandir(src) as it:
+        srcl = list(it)
+    dstl = set(os.listdir(dst))
 
     if samedrive == -1:
         if os.stat(src).st_dev == os.stat(dst).st_dev:
@@ -46,13 +170,15 @@ def MergeFolderTo(src, dst, samedrive=-1):
             samedrive = 0
     copy_ok = 1
     delete_ok = 1
-    for p in srcl:
+    for entry in srcl:
+        p = entry.name
         srcpath = src + '/' + p
-        if os.path.isdir(srcpath):
+        if entry.is_dir():
             if p in dstl:
-                c, d = MergeFolderTo(srcpath, dst + '/' + p, samedrive)
+                c, d = MergeFolderTo(srcpath, dst + '/' + p, samedrive, _progress)
                 copy_ok &= c
                 delete_ok &= d
+                continue
             elif samedrive:
                 shutil.move(srcpath, dst)
             else:
@@ -60,7 +186,7 @@ def MergeFolderTo(src, dst, samedrive=-1):
                 try:
                     shutil.rmtree(srcpath, onerror=onerror)
                 except PermissionError:
-                    logging.exception("Error when removing {}".format(srcpath))
+                    log.exception("Error when removing %s", srcpath)
                     delete_ok = 0
                     continue
         else:
@@ -75,7 +201,7 @@ def MergeFolderTo(src, dst, samedrive=-1):
                     try:
                         RemoveFile(srcpath)
                     except PermissionError:
-                        logging.exception("Error when removing {}".format(srcpath))
+                        log.exception("Error when removing %s", srcpath)
                         delete_ok = 0
                         continue
             elif samedrive:
@@ -85,16 +211,34 @@ def MergeFolderTo(src, dst, samedrive=-1):
                 try:
                     RemoveFile(srcpath)
                 except PermissionError:
-                    logging.exception("Error when removing {}".format(srcpath))
+                    log.exception("Error when removing %s", srcpath)
                     delete_ok = 0
                     continue
+        if _progress:
+            _progress[1] += 1
+            progress.bus.publish(_progress[0], 'merge', _progress[1])
 
+    if toplevel and _progress:
+        progress.bus.publish(_progress[0], 'merge', _progress[1], _progress[1], done=True)
     return copy_ok, delete_ok
 
 
+def CopyFolderTo(src, dst):
+    '''
+    Copies the content of src into dst, replacing existing files and leaving src untouched.
+    Returns a tuple of flags (copy_ok, delete_ok) like MergeFolderTo.
+    '''
+    try:
+        shutil.copytree(src, dst, dirs_exist_ok=True)
+    except shutil.Error:
+        log.exception("Error when copying %s to %s", src, dst)
+        return 0, 1
+    return 1, 1
+
+
 def RemoveFile(path):
     if not os.path.isfile(path):
-        logging.error("Wrong file type when trying to remove {}".format(path))
+        log.error("Wrong file type when trying to remove %s", path)
         raise FileNotFoundError
     try:
         os.remove(path)
@@ -103,37 +247,222 @@ def RemoveFile(path):
         try:
             os.remove(path)
         except PermissionError:
-            logging.exception("Permission error when trying to remove {}".format(path))
+            log.exception("Permission error when trying to remove %s", path)
             raise
 
 
-def cleanupdir(path):
-    for i in os.listdir(path):
-        p = path + '/' + i
-        if os.path.isfile(p):
+class CleanupReport:
+    '''
+    Result of cleanupdir. It is true when every entry was removed, failed holds the paths that could not be.
+    When the removal runs in the background, wait must be called before relying on failed.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.failed = []
+        self._thread = None
+
+    def wait(self, timeout: float = None) -> "CleanupReport":
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self
+
+    @property
+    def pending(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def __bool__(self):
+        return not self.failed
+
+    def __int__(self):
+        return int(bool(self))
+
+
+def RemoveTree(path, retries=5, backoff=0.05, maxbackoff=1.0):
+    '''
+    Removes the file or directory tree at path, making read-only entries writable.
+    Entries that can't be removed (usually held open by another process on Windows) are retried retries times,
+    waiting backoff seconds before the first retry and doubling up to maxbackoff.
+    Returns the list of paths that could not be removed.
+    '''
+    delay = backoff
+    failed = []
+    for attempt in range(retries + 1):
+        failed = []
+
+        def onerror_collect(func, p, exc_info):
             try:
-                os.remove(p)
-            except:
-                os.chmod(p, stat.S_IWRITE | stat.S_IWUSR)
-                os.remove(p)
-        else:
-            shutil.rmtree(path + '/' + i, onerror=onerror)
-    if not len(os.listdir(path)) == 0:
-        time.sleep(2)
-        if not len(os.listdir(path)) == 0:
-            return 0
-    return 1
+                onerror(func, p, exc_info)
+            except OSError:
+                failed.append(p)
+
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, onerror=onerror_collect)
+            else:
+                try:
+                    os.remove(path)
+                except PermissionError:
+                    os.chmod(path, stat.S_IWRITE | stat.S_IWUSR)
+                    os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            failed.append(path)
+
+        if not os.path.lexists(path):
+            return []
+        if attempt < retries:
+            log.debug('Could not remove %s, retrying in %s seconds', path, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, maxbackoff)
+    return failed or [path]
+
+
+def cleanupdir(path, workers=4, retries=5, backoff=0.05, maxbackoff=1.0, background=False):
+    '''
+    Removes the content of the directory path, entries are removed in parallel by workers threads.
+    Entries that can't be removed are retried with a bounded exponential backoff, see RemoveTree.
+    If background is True, the entries are first renamed into a sibling trash directory and deleted by a
+    background thread, so path is empty as soon as the function returns.
+    Returns a CleanupReport listing the paths that could not be removed.
+    '''
+    path = path.rstrip(r'\/')
+    report = CleanupReport(path)
+    entries = [path + '/' + i for i in os.listdir(path)]
+    if not entries:
+        return report
+
+    if background:
+        trash = '{}.trash-{}'.format(path, uuid.uuid4().hex)
+        os.makedirs(trash)
+        remaining = []
+        for p in entries:
+            try:
+                os.rename(p, trash + '/' + os.path.basename(p))
+            except OSError:
+                remaining.append(p)
+
+        def remove_trash():
+            failed = RemoveTree(trash, retries, backoff, maxbackoff)
+            if failed:
+                log.error('Could not remove %s in the background', failed)
+            report.failed.extend(failed)
+
+        report._thread = threading.Thread(target=remove_trash, name='cleanup ' + path, daemon=True)
+        report._thread.start()
+        entries = remaining
+
+    if len(entries) <= 1 or workers <= 1:
+        failed = [RemoveTree(p, retries, backoff, maxbackoff) for p in entries]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(entries))) as executor:
+            failed = list(executor.map(lambda p: RemoveTree(p, retries, backoff, maxbackoff), entries))
+    for f in failed:
+        report.failed.extend(f)
+    if report.failed:
+        log.error('Could not remove %s from %s', report.failed, path)
+    return report
+
+
+def RemoveStaging(path, workers=4):
+    '''
+    Removes the staging directory path once its content was merged, with cleanupdir then rmdir.
+    Returns the CleanupReport of cleanupdir, None if path doesn't exist.
+    '''
+    if not os.path.isdir(path):
+        log.debug('Staging directory %s is already gone', path)
+        return None
+    report = cleanupdir(path, workers)
+    if report:
+        try:
+            os.rmdir(path)
+        except OSError:
+            log.exception('Could not remove %s', path)
+    return report
+
+
+class WalkEntry:
+    '''
+    Entry yielded by walkdir.
+    path is the path of the entry with '/' separators, relpath its path relative to the walked directory and depth
+    its depth below it (1 for direct children). entry is the underlying os.DirEntry, whose type and stat
+    informations are cached.
+    '''
+    __slots__ = ('path', 'relpath', 'depth', 'entry')
+
+    def __init__(self, path: str, relpath: str, depth: int, entry: os.DirEntry):
+        self.path = path
+        self.relpath = relpath
+        self.depth = depth
+        self.entry = entry
+
+    @property
+    def name(self) -> str:
+        return self.entry.name
+
+    def is_dir(self) -> bool:
+        return self.entry.is_dir(follow_symlinks=False)
+
+    def is_file(self) -> bool:
+        return self.entry.is_file(follow_symlinks=False)
+
+    def stat(self) -> os.stat_result:
+        return self.entry.stat(follow_symlinks=False)
+
+    def __repr__(self):
+        return 'WalkEntry({!r})'.format(self.path)
+
+
+def _compile_patterns(patterns):
+    if not patterns:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    flags = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+    return re.compile('|'.join(fnmatch.translate(p) for p in patterns), flags)
+
+
+def walkdir(path: str, include=None, exclude=None, maxdepth: int = None, dirs: bool = True, files: bool = True):
+    '''
+    Lazily walks the tree under path, yielding a WalkEntry for each directory and file.
+    The entries of a directory are yielded before descending into its subdirectories. Symbolic links to
+    directories are yielded but not followed.
+    include and exclude are glob patterns (or lists of them) matched against the relative path of the entries,
+    with '/' separators. Only entries matching include are yielded, excluded entries are neither yielded nor
+    descended into.
+    maxdepth limits how deep the walk goes, 1 only yields the direct children of path.
+    dirs and files select which kinds of entries are yielded.
+    '''
+    include = _compile_patterns(include)
+    exclude = _compile_patterns(exclude)
+    root = path.rstrip(r'\/').replace('\\', '/')
+    stack = [(root, '', 1)]
+    while stack:
+        dirpath, reldir, depth = stack.pop()
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    relpath = reldir + entry.name
+                    if exclude is not None and exclude.match(relpath):
+                        continue
+                    isdir = entry.is_dir(follow_symlinks=False)
+                    if isdir and (maxdepth is None or depth < maxdepth):
+                        subdirs.append((dirpath + '/' + entry.name, relpath + '/', depth + 1))
+                    if (dirs if isdir else files) and (include is None or include.match(relpath)):
+                        yield WalkEntry(dirpath + '/' + entry.name, relpath, depth, entry)
+        except OSError:
+            log.exception('Could not list %s', dirpath)
+        stack.extend(reversed(subdirs))
 
 
 def listsubdir(path: str):
-    s = []
-    for i in os.walk(path.rstrip(r'\/')):
-        # logging.debug('i[0] = {}'.format(i[0]))
-        f = i[0].replace('\\', '/')
-        s.append(f)
-        # logging.debug('f is {}'.format(f))
-        for j in i[2]:
-            m = f + '/' + j
-            # logging.debug('m is {}'.format(m))
-            s.append(m)
+    '''
+    Returns a list with path and the paths of every directory and file below it, with '/' separators.
+    Use walkdir to go through large trees without building the list.
+    '''
+    root = path.rstrip(r'\/').replace('\\', '/')
+    s = [root]
+    s.extend(e.path for e in walkdir(root))
     return s
@@ -1,2 +1,24 @@
-from packaging.version import parse
-from . import download, extraction
+'''
+The submodules are imported on first access, as attributes (tools.download) or with from packagemanager.tools import
+download, so that entry points only pay for the tools they use. packaging.version.parse is available as tools.parse.
+'''
+import importlib
+
+SUBMODULES = ('Utils', 'aiodownload', 'download', 'extraction', 'mapped', 'progress', 'scheduler', 'weidu')
+
+__all__ = list(SUBMODULES) + ['parse']
+
+
+def __getattr__(name):
+    # Only called for missing attributes: once imported, a submodule is an attribute of the package
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    if name == 'parse':
+        from packaging.version import parse
+        globals()['parse'] = parse
+        return parse
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+import ssl
+import urllib.parse
+
+from . import progress
+from .download import IntegrityChecker, INTEGRITY_ERROR, NOT_MODIFIED, checked
+
+log = logging.getLogger(__name__)
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class HTTPResponse:
+    '''
+    Response whose headers are read. Each read of the body raises asyncio.TimeoutError if the server sends nothing
+    for timeout seconds.
+    '''
+
+    def __init__(self, code: int, headers: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 timeout: float = 60):
+        self.code = code
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def _read(self, coro):
+        return asyncio.wait_for(coro, self.timeout)
+
+    async def iter_chunks(self, chunksize: int):
+        '''
+        Yields the body of the response, handling chunked transfer encoding and content length
+        '''
+        if self.getheader('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await self._read(self.reader.readline())).split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    break
+                while size > 0:
+                    data = await self._read(self.reader.read(min(size, chunksize)))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b'', size)
+                    size -= len(data)
+                    yield data
+                await self._read(self.reader.readline())
+            return
+        remaining = self.getheader('content-length')
+        remaining = int(remaining) if remaining is not None else None
+        while remaining is None or remaining > 0:
+            data = await self._read(self.reader.read(chunksize if remaining is None else min(chunksize, remaining)))
+            if not data:
+                if remaining:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+
+async def open_url(url: str, headers: dict = None, maxredirects: int = 5, timeout: float = 60) -> HTTPResponse:
+    '''
+    Sends a GET request for url using asyncio streams and returns the response once its headers are read.
+    Redirections are followed up to maxredirects times.
+    Raises OSError (including ConnectionError and asyncio.TimeoutError) when the server can't be reached or its
+    answer isn't HTTP. Every read, of the headers and of the body, times out after timeout seconds.
+    '''
+    for _ in range(maxredirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme == 'https'
+        port = parts.port or (443 if secure else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, port, ssl=ssl.create_default_context() if secure else None),
+            timeout)
+        request = ['GET {} HTTP/1.1'.format(path),
+                   'Host: {}'.format(parts.netloc),
+                   'User-Agent: Python-asyncio packagemanager',
+                   'Accept-Encoding: identity',
+                   'Connection: close']
+        request.extend('{}: {}'.format(k, v) for k, v in (headers or {}).items())
+        # The response owns the connection once the headers are read, until then it is closed on any error
+        try:
+            writer.write(('\r\n'.join(request) + '\r\n\r\n').encode('latin-1'))
+            await asyncio.wait_for(writer.drain(), timeout)
+
+            status = await asyncio.wait_for(reader.readline(), timeout)
+            if not status:
+                raise ConnectionError('Empty response from {}'.format(url))
+            try:
+                code = int(status.split()[1])
+            except (IndexError, ValueError):
+                raise ConnectionError('Malformed status line {!r} from {}'.format(status[:100], url))
+            resp_headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                resp_headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            writer.close()
+            raise
+        response = HTTPResponse(code, resp_headers, reader, writer, timeout)
+        if code in REDIRECT_CODES and 'location' in resp_headers:
+            await response.close()
+            url = urllib.parse.urljoin(url, resp_headers['location'])
+            log.debug('Redirected to %s', url)
+            continue
+        return response
+    raise ConnectionError('Too many redirections for {}'.format(url))
+
+
+async def _download(url, filename, reporthook, checker, chunksize, headers=None, timeout=60):
+    response = await open_url(url, headers, timeout=timeout)
+    try:
+        # In case download isn't possible
+        if response.code != 200:
+            return response.code, 0, response.headers
+        ln = response.getheader('content-length')
+        if not checker.check_length(ln):
+            log.error('%s announces %s bytes, %s were expected', url, ln, checker.expected_size)
+            return INTEGRITY_ERROR, 0, response.headers
+        ln = int(ln) if ln else None
+        publish = reporthook is None and progress.bus.active
+        check = checker.enabled
+        downloaded = 0
+        with open(filename, 'wb') as out_file:
+            async for chunk in response.iter_chunks(chunksize):
+                downloaded += len(chunk)
+                if check and not checker.update(chunk):
+                    log.error('Received more than the %s bytes expected from %s', checker.expected_size, url)
+                    return INTEGRITY_ERROR, downloaded, response.headers
+                out_file.write(chunk)
+                if reporthook is not None:
+                    reporthook(downloaded)
+                elif publish:
+                    progress.bus.publish(filename, 'download', downloaded, ln)
+        if publish:
+            progress.bus.publish(filename, 'download', downloaded, ln, done=True)
+        if check and not checker.verify():
+            return INTEGRITY_ERROR, downloaded, response.headers
+        log.info('Done downloading from %s to %s, %s bytes downloaded', url, filename, downloaded)
+        return response.code, downloaded, response.headers
+    finally:
+        await response.close()
+
+
+async def AsyncDownloadFile(url, filename, reporthook=None, expected_size=None, expected_hash=None, retries=2,
+                            validators=None, chunksize=64 * 1024, timeout=60):
+    '''
+    Asynchronous version of download.DownloadFile, the network I/O runs on the event loop.
+    Returns the http code and the number of bytes downloaded, (-1, 0) if the request failed,
+    (INTEGRITY_ERROR, bytes downloaded) if the content was truncated or didn't match after the retries, or
+    (NOT_MODIFIED, 0) if validators showed filename to be up to date.
+    A server not sending anything for timeout seconds, or answering with something else than HTTP, fails the request.
+    '''
+    partname = filename + '.part'
+    downloaded = 0
+    error = IntegrityChecker(expected_size, expected_hash).error
+    if error is not None:
+        log.error('Not downloading %s: %s', url, error)
+        return INTEGRITY_ERROR, 0
+    conditional = validators.conditional_headers(url, filename, expected_size) if validators is not None else {}
+    for attempt in range(retries + 1):
+        log.info('Sending request to %s', url)
+        try:
+            code, downloaded, headers = await _download(url, partname, reporthook,
+                                                        IntegrityChecker(expected_size, expected_hash), chunksize,
+                                                        conditional, timeout)
+        except asyncio.IncompleteReadError:
+            log.exception('Connection lost when downloading %s from %s', filename, url)
+            code = INTEGRITY_ERROR
+        except (OSError, asyncio.TimeoutError, ValueError):
+            log.exception('Error when downloading %s from %s', filename, url)
+            code, downloaded = -1, 0
+        if code == NOT_MODIFIED and conditional:
+            log.info('%s is up to date with %s', filename, url)
+            return NOT_MODIFIED, 0
+        if code == 200:
+            os.replace(partname, filename)
+            if expected_size is not None or expected_hash:
+                checked.add(filename, expected_size, expected_hash)
+            if validators is not None:
+                validators.update(url, filename, headers)
+            return code, downloaded
+        if os.path.exists(partname):
+            os.remove(partname)
+        if code != INTEGRITY_ERROR:
+            return code, downloaded
+        log.warning('Integrity check failed for %s, attempt %s of %s', url, attempt + 1, retries + 1)
+    return INTEGRITY_ERROR, downloaded
@@ -1,26 +1,229 @@
+import hashlib
+import http.client
+import json
+import os
+import threading
 import urllib.request
 import urllib.error
 import logging
 
-def DownloadFile(url, filename, reporthook=None):
-    log = logging.getLogger(__name__)
-    log.info('Sending request to {}'.format(url))
+from . import mapped, progress
+
+log = logging.getLogger(__name__)
+
+# Code returned by DownloadFile when the content is truncated or doesn't match the expected size or hash
+INTEGRITY_ERROR = -2
+# Code returned by DownloadFile when a conditional request found the local file up to date
+NOT_MODIFIED = 304
+
+
+class IntegrityChecker:
+    '''
+    Checks downloaded content against an expected size and hash while it is being received.
+    expected_hash is a string 'algorithm:hexdigest' where algorithm is any name accepted by hashlib.new,
+    a bare hexdigest is considered to be a sha256. error describes an expected_hash that can't be checked, content
+    never verifies against it.
+    '''
+
+    def __init__(self, expected_size: int = None, expected_hash: str = None):
+        self.expected_size = expected_size
+        self.expected_hash = None
+        self.hash = None
+        self.error = None
+        if expected_hash:
+            algorithm, _, digest = expected_hash.rpartition(':')
+            self.expected_hash = digest.lower()
+            try:
+                self.hash = hashlib.new(algorithm or 'sha256')
+            except ValueError:
+                self.error = 'unknown hash algorithm {!r} in {!r}'.format(algorithm, expected_hash)
+        self.size = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.expected_size is not None or self.hash is not None or self.error is not None
+
+    def check_length(self, length) -> bool:
+        '''
+        Returns False if the announced content length can't match the expected size
+        '''
+        return length is None or self.expected_size is None or int(length) == self.expected_size
+
+    def update(self, chunk) -> bool:
+        '''
+        Feeds a chunk of content, returns False as soon as the content is larger than expected
+        '''
+        self.size += len(chunk)
+        if self.hash is not None:
+            self.hash.update(chunk)
+        return self.expected_size is None or self.size <= self.expected_size
+
+    def verify(self) -> bool:
+        if self.error is not None:
+            log.error('Can not verify the content: %s', self.error)
+            return False
+        if self.expected_size is not None and self.size != self.expected_size:
+            log.error('Expected %s bytes, got %s', self.expected_size, self.size)
+            return False
+        if self.hash is not None and self.hash.hexdigest() != self.expected_hash:
+            log.error('Expected %s hash %s, got %s', self.hash.name, self.expected_hash, self.hash.hexdigest())
+            return False
+        return True
+
+
+class ValidatorStore:
+    '''
+    Remembers the ETag and Last-Modified headers of downloaded urls, stored as json in filename, so that
+    files pointing at moving targets (latest release, master archive...) are only downloaded again when they
+    changed upstream.
+    '''
+
+    def __init__(self, filename: str = None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._data = {}
+        if filename and os.path.isfile(filename):
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                log.exception('Could not read validators from %s', filename)
+
+    def get(self, url: str):
+        return self._data.get(url)
+
+    def conditional_headers(self, url: str, filename: str, expected_size: int = None) -> dict:
+        '''
+        Returns the headers making a request for url conditional, if filename is still the file downloaded from it
+        '''
+        entry = self._data.get(url)
+        if not entry or entry.get('filename') != os.path.abspath(filename) or not os.path.isfile(filename):
+            return {}
+        size = os.path.getsize(filename)
+        if size != entry.get('size') or (expected_size is not None and size != expected_size):
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last-modified'):
+            headers['If-Modified-Since'] = entry['last-modified']
+        return headers
+
+    def update(self, url: str, filename: str, headers):
+        # http.client headers are case insensitive, the asyncio client lowercases them
+        etag = headers.get('ETag') or headers.get('etag')
+        modified = headers.get('Last-Modified') or headers.get('last-modified')
+        with self._lock:
+            if not etag and not modified:
+                self._data.pop(url, None)
+            else:
+                self._data[url] = {'etag': etag,
+                                   'last-modified': modified,
+                                   'filename': os.path.abspath(filename),
+                                   'size': os.path.getsize(filename)}
+            self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f, indent=4)
+        os.replace(tmp, self.filename)
+
+
+class CheckedFiles:
+    '''
+    Files whose content was checked against an expected size and hash while it was downloaded, with their size and
+    modification time, so that VerifyOrRaise doesn't read them again. A file changed since is verified again.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+
+    @staticmethod
+    def _key(filename, expected_size, expected_hash):
+        st = os.stat(filename)
+        return st.st_size, st.st_mtime_ns, expected_size, expected_hash
+
+    def add(self, filename, expected_size=None, expected_hash=None):
+        key = self._key(filename, expected_size, expected_hash)
+        with self._lock:
+            self._files[os.path.abspath(filename)] = key
+
+    def __contains__(self, item) -> bool:
+        filename, expected_size, expected_hash = item
+        try:
+            key = self._key(filename, expected_size, expected_hash)
+        except OSError:
+            return False
+        with self._lock:
+            return self._files.get(os.path.abspath(filename)) == key
+
+
+checked = CheckedFiles()
+
+
+def VerifyFile(filename, expected_size=None, expected_hash=None, chunksize=1024 * 1024):
+    '''
+    Returns True if the file matches the expected size and hash. The file is hashed from its shared mapping,
+    see mapped.mappings.
+    '''
+    checker = IntegrityChecker(expected_size, expected_hash)
+    checker.size = os.path.getsize(filename)
+    if checker.hash is not None and (expected_size is None or checker.size == expected_size):
+        with mapped.mappings.open(filename) as m:
+            mapped.HashView(m.view, checker.hash, chunksize)
+    return checker.verify()
+
+
+class IntegrityException(Exception): pass
+
+
+class DownloadFailedException(Exception): pass
+
+
+def VerifyOrRaise(filename, expected_size=None, expected_hash=None, lease=None):
+    '''
+    Raises IntegrityException if filename doesn't match the expected size and hash, FileNotFoundError if it is missing.
+    Files checked while they were downloaded (see checked) are not read again.
+    lease is a mapped.MappingLease of filename held for the next stages once verified, it is released on failure.
+    '''
+    if lease is not None:
+        lease.hold()
     try:
-        with urllib.request.urlopen(url) as response, open(filename, 'wb') as out_file:
-            #In case download isn't possible
-            if response.code !=200:
-                return response.code, 0
-            if reporthook==None:
-                #Temp solution while no GUI
-                ln = response.getheader('Content-length')
-                if ln:
-                    ln=int(ln)
-                    def reporthook(n):
-                        print('\r{:.2f}% complete'.format(100*n/ln),end='',flush=True)
-                else:
-                    def reporthook(n):
-                        print('\r{:.0f} kb downloaded'.format(n/1000),end='',flush=True)
-            downloaded = 0
+        if (filename, expected_size, expected_hash) in checked:
+            log.info('%s was checked while downloaded', filename)
+            return True
+        if not VerifyFile(filename, expected_size, expected_hash):
+            log.error('%s does not match its expected size or hash', filename)
+            raise IntegrityException(filename)
+    except BaseException:
+        if lease is not None:
+            lease.release()
+        raise
+    log.info('%s verified', filename)
+    return True
+
+
+def _download(url, filename, reporthook, checker, headers=None):
+    with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {})) as response:
+        #In case download isn't possible
+        if response.code !=200:
+            return response.code, 0, response.headers
+        ln = response.getheader('Content-length')
+        if not checker.check_length(ln):
+            log.error('%s announces %s bytes, %s were expected', url, ln, checker.expected_size)
+            return INTEGRITY_ERROR, 0, response.headers
+        ln = int(ln) if ln else None
+        publish = reporthook is None and progress.bus.active
+        if publish:
+            def reporthook(n):
+                progress.bus.publish(filename, 'download', n, ln)
+        check = checker.enabled
+        downloaded = 0
+        with open(filename, 'wb') as out_file:
             while 1:
 
                 chunk=response.read(16*1024)
@@ -28,11 +231,72 @@ def DownloadFile(url, filename, reporthook=None):
                     break
 
                 downloaded += len(chunk)
+                if check and not checker.update(chunk):
+                    log.error('Received more than the %s bytes expected from %s', checker.expected_size, url)
+                    return INTEGRITY_ERROR, downloaded, response.headers
                 out_file.write(chunk)
-                reporthook(downloaded)
-            log.info('Done downloading from {} to {}, {} bytes downloaded'.format(url,filename,downloaded))
-    except urllib.error.URLError:
-        log.exception('Error when downloading {} from {}'.format(filename, url))
-        return -1, 0
+                if reporthook is not None:
+                    reporthook(downloaded)
+        if publish:
+            progress.bus.publish(filename, 'download', downloaded, ln, done=True)
+        if ln is not None and downloaded != ln:
+            log.error('Truncated download from %s, %s bytes out of %s', url, downloaded, ln)
+            return INTEGRITY_ERROR, downloaded, response.headers
+        if check and not checker.verify():
+            return INTEGRITY_ERROR, downloaded, response.headers
+        log.info('Done downloading from %s to %s, %s bytes downloaded', url,filename,downloaded)
+        return response.code, downloaded, response.headers
+
 
-    return response.code, downloaded
\ No newline at end of file
+def DownloadFile(url, filename, reporthook=None, expected_size=None, expected_hash=None, retries=2,
+                 validators=None):
+    '''
+    Downloads url to filename.
+    reporthook is called with the number of bytes downloaded after each chunk, if it is not given the progress is
+    published on progress.bus under the 'download' stage when it has subscribers.
+    If expected_size or expected_hash are given (see IntegrityChecker), the content is checked while it is
+    received and the download is aborted as soon as it can't match.
+    Truncated or mismatching downloads are retried up to retries times.
+    The content is written to filename + '.part' and only renamed to filename once complete and verified.
+    If validators (a ValidatorStore) is given and filename was downloaded from url before, the request is
+    conditional and NOT_MODIFIED is returned without downloading anything if the file didn't change upstream.
+    Returns the http code and the number of bytes downloaded, (-1, 0) if the server couldn't be reached, or
+    (INTEGRITY_ERROR, bytes downloaded) if the content was still wrong after the retries.
+    '''
+    partname = filename + '.part'
+    downloaded = 0
+    error = IntegrityChecker(expected_size, expected_hash).error
+    if error is not None:
+        log.error('Not downloading %s: %s', url, error)
+        return INTEGRITY_ERROR, 0
+    conditional = validators.conditional_headers(url, filename, expected_size) if validators is not None else {}
+    for attempt in range(retries + 1):
+        log.info('Sending request to %s', url)
+        try:
+            code, downloaded, headers = _download(url, partname, reporthook,
+                                                  IntegrityChecker(expected_size, expected_hash), conditional)
+        except urllib.error.HTTPError as e:
+            if e.code == NOT_MODIFIED and conditional:
+                log.info('%s is up to date with %s', filename, url)
+                return NOT_MODIFIED, 0
+            log.error('Error %s when downloading %s from %s', e.code, filename, url)
+            code, downloaded = e.code, 0
+        except urllib.error.URLError:
+            log.exception('Error when downloading %s from %s', filename, url)
+            code, downloaded = -1, 0
+        except (http.client.HTTPException, ConnectionError):
+            log.exception('Connection lost when downloading %s from %s', filename, url)
+            code = INTEGRITY_ERROR
+        if code == 200:
+            os.replace(partname, filename)
+            if expected_size is not None or expected_hash:
+                checked.add(filename, expected_size, expected_hash)
+            if validators is not None:
+                validators.update(url, filename, headers)
+            return code, downloaded
+        if os.path.exists(partname):
+            os.remove(partname)
+        if code != INTEGRITY_ERROR:
+            return code, downloaded
+        log.warning('Integrity check failed for %s, attempt %s of %s', url, attempt + 1, retries + 1)
+    return INTEGRITY_ERROR, downloaded
@@ -2,10 +2,17 @@ import logging
 import os
 import subprocess
 import shlex
+from functools import partial
 from sys import platform
 
+from . import mapped, progress
 from .Utils import RegexBytesSeq
 
+log = logging.getLogger(__name__)
+
+
+class ExtractionFailedException(Exception): pass
+
 '''
 ext_tools['bar']['foo'] is a list of tuples with a command used to extract files of extension .foo on the platform bar and a command used to test integrity of files
 ext_tools['bar']['foo'][i][0] is used to extract, ext_tools['bar']['foo'][i][1] is used to test.
@@ -60,24 +67,27 @@ def Check_Archive(filepath, basedir='', regex=None, ext_tool=None):
     if ext_tool is None:
         ext_tool = SelectTool(filepath)
 
-    logging.info('Selected ext_tool is {}'.format(ext_tool))
+    log.info('Selected ext_tool is %s', ext_tool)
     command = ext_tool[1].format(filename=filepath, basedir=basedir)
-    logging.info('Command is {}'.format(command))
+    log.info('Command is %s', command)
+    progress.bus.publish(filepath, 'check')
     # uses the extraction tool to check the validity of the archive and its contents
     try:
         res = subprocess.check_output(shlex.split(command), startupinfo=startupinfo)
     except subprocess.CalledProcessError:
-        logging.exception('Returning 0 due to exception during the execution of {}'.format(command))
+        log.exception('Returning 0 due to exception during the execution of %s', command)
+        progress.bus.publish(filepath, 'check', done=True, message='failed')
         return 0
-    logging.info('ext_tool executed without error')
+    progress.bus.publish(filepath, 'check', 1, 1, done=True)
+    log.info('ext_tool executed without error')
 
     s = CheckPat.findall(res)
 
     # Checks if Everything is Ok
     if b'Everything is Ok' not in s[0]:
-        logging.debug('ext_tool found an issue.\n'
-                      's={}\n'
-                      'ext_tool output :\n{}'.format(s, res))
+        log.debug('ext_tool found an issue.\n'
+                  's=%s\n'
+                  'ext_tool output :\n%s', s, res)
         return 3
 
     if regex is None:
@@ -85,7 +95,7 @@ def Check_Archive(filepath, basedir='', regex=None, ext_tool=None):
     else:
         results = RegexBytesSeq(regex, res)
 
-    logging.info('Testing was successful for {}'.format(filepath))
+    log.info('Testing was successful for %s', filepath)
 
     return results
 
@@ -114,29 +124,61 @@ def Extract_Archive(filepath, targetdir=None, basedir='', ext_tool=None):
 
     ext_tool = SelectTool(filepath)
 
-    logging.info('Selected ext_tool is {}'.format(ext_tool))
+    log.info('Selected ext_tool is %s', ext_tool)
     command = ext_tool[0].format(filename=filepath, basedir=basedir, targetdir=targetdir)
-    logging.info('Command is {}'.format(command))
+    log.info('Command is %s', command)
+    progress.bus.publish(filepath, 'extract')
     # uses the extraction tool to check the validity of the archive and its contents
     try:
         res = subprocess.check_output(shlex.split(command), startupinfo=startupinfo)
         # arg posix of split should logically be False on windows but it works only if posix is False on Windows
         # because subprocess.check_output reconstructs the string with proper escapes from the list
     except subprocess.CalledProcessError:
-        logging.exception('Returning 0 due to exception during the execution of {}'.format(command))
+        log.exception('Returning 0 due to exception during the execution of %s', command)
+        progress.bus.publish(filepath, 'extract', done=True, message='failed')
         return 0
+    progress.bus.publish(filepath, 'extract', 1, 1, done=True)
 
-    logging.info('ext_tool executed without error')
+    log.info('ext_tool executed without error')
 
     s = CheckPat.findall(res)
 
     # Checks if Everything is Ok
     if b'Everything is Ok' not in s[0]:
-        logging.debug('ext_tool found an issue.\n'
-                      's={}\n'
-                      'ext_tool output :\n{}'.format(s, res))
+        log.debug('ext_tool found an issue.\n'
+                  's=%s\n'
+                  'ext_tool output :\n%s', s, res)
         return 3
 
-    logging.info('Extracting was successful for {}'.format(filepath))
+    log.info('Extracting was successful for %s', filepath)
 
     return 1
+
+
+def SelectExtract(filepath):
+    '''
+    Returns the function extracting filepath: zip files are extracted from their mapping by mapped.Extract_Zip,
+    with Extract_Archive for the compression methods it doesn't support, other archives by Extract_Archive
+    '''
+    if filepath.lower().endswith('.zip'):
+        return partial(mapped.Extract_Zip, fallback=Extract_Archive)
+    return Extract_Archive
+
+
+def ExtractOrRaise(filepath, targetdir, extract=None, lease=None):
+    '''
+    Extracts filepath into targetdir with extract (see SelectExtract by default), raises ExtractionFailedException
+    if it doesn't return 1.
+    lease is the mapped.MappingLease of filepath taken by the verify stage, released once extracted.
+    '''
+    try:
+        os.makedirs(targetdir, exist_ok=True)
+        if extract is None:
+            extract = SelectExtract(filepath)
+        res = extract(filepath, targetdir)
+    finally:
+        if lease is not None:
+            lease.release()
+    if res != 1:
+        raise ExtractionFailedException(filepath, res)
+    return res
@@ -0,0 +1,315 @@
+import contextlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import Callable, Dict, List, NamedTuple
+
+from . import progress
+
+log = logging.getLogger(__name__)
+
+STORED = 0
+DEFLATED = 8
+
+# End of central directory record, its zip64 locator and record, central directory entry and local file header
+EOCD = struct.Struct('<4s4H2LH')
+EOCD64_LOCATOR = struct.Struct('<4sLQL')
+EOCD64 = struct.Struct('<4sQ2H2L4Q')
+CENTRAL_ENTRY = struct.Struct('<4s6H3L5H2L')
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+# The comment of the end of central directory record is at most 65535 bytes
+MAX_EOCD_SEARCH = EOCD.size + 0xFFFF
+
+
+class ZipFormatException(Exception): pass
+
+
+class UnsupportedZipException(ZipFormatException): pass
+
+
+class MappedFile:
+    '''
+    Read-only memory mapping of filename. view is a memoryview of the whole file: its slices read the mapped pages,
+    no bytes are copied into Python objects until they are used.
+    Slices of view must be released before the file is closed.
+    '''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.refs = 0
+        with open(filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            # Empty files can't be mapped
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else None
+        self.stamp = (st.st_size, st.st_mtime_ns)
+        self.view = memoryview(self.mmap if self.mmap is not None else b'')
+
+    def __len__(self):
+        return len(self.view)
+
+    def rfind(self, sub: bytes, start: int = 0) -> int:
+        return self.mmap.rfind(sub, start) if self.mmap is not None else -1
+
+    def close(self):
+        self.view.release()
+        if self.mmap is not None:
+            self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MappingCache:
+    '''
+    Shares the mappings of files between the stages working on them at the same time.
+    acquire returns the mapping of a file, mapping it if nobody holds it, release closes it once every holder
+    released it. A file replaced on disk, with a different size or modification time, gets a new mapping.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mappings: Dict[str, MappedFile] = {}
+
+    def __len__(self):
+        return len(self._mappings)
+
+    def acquire(self, filename: str) -> MappedFile:
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        with self._lock:
+            mapped = self._mappings.get(path)
+            if mapped is None or mapped.stamp != (st.st_size, st.st_mtime_ns):
+                mapped = MappedFile(path)
+                self._mappings[path] = mapped
+            mapped.refs += 1
+            return mapped
+
+    def release(self, mapped: MappedFile):
+        with self._lock:
+            mapped.refs -= 1
+            if mapped.refs > 0:
+                return
+            if self._mappings.get(mapped.filename) is mapped:
+                del self._mappings[mapped.filename]
+        mapped.close()
+
+    @contextlib.contextmanager
+    def open(self, filename: str):
+        mapped = self.acquire(filename)
+        try:
+            yield mapped
+        finally:
+            self.release(mapped)
+
+
+mappings = MappingCache()
+
+
+class MappingLease:
+    '''
+    Keeps the mapping of filename in cache from hold to release, so that the stages reading an archive one after the
+    other (verify, extract, listing) share one mapping instead of mapping it again each time.
+    hold and release can be called several times, the mapping is released with the lease at the latest.
+    A closed lease is released and can't be held again, so a stage still running when its install was aborted
+    doesn't map the file anew.
+    '''
+
+    def __init__(self, filename: str, cache: MappingCache = None):
+        self.filename = filename
+        self.cache = cache if cache is not None else mappings
+        self._lock = threading.Lock()
+        self._mapped = None
+        self.closed = False
+
+    @property
+    def held(self) -> bool:
+        return self._mapped is not None
+
+    def hold(self) -> MappedFile:
+        with self._lock:
+            if self.closed:
+                raise ValueError('lease of {} is closed'.format(self.filename))
+            if self._mapped is None:
+                self._mapped = self.cache.acquire(self.filename)
+            return self._mapped
+
+    def release(self):
+        with self._lock:
+            mapped, self._mapped = self._mapped, None
+        if mapped is not None:
+            self.cache.release(mapped)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+
+def HashView(view: memoryview, hasher, chunksize: int = 1024 * 1024):
+    '''
+    Feeds view to hasher by slices of chunksize bytes, hashlib releases the GIL while hashing each slice
+    '''
+    for i in range(0, len(view), chunksize):
+        hasher.update(view[i:i + chunksize])
+    return hasher
+
+
+class ZipMember(NamedTuple):
+    name: str
+    method: int
+    crc: int
+    compressed_size: int
+    size: int
+    header_offset: int
+
+    @property
+    def is_dir(self) -> bool:
+        return self.name.endswith('/')
+
+
+def _zip64_extra(extra: memoryview, fields: List[int]) -> List[int]:
+    # The zip64 extra field holds the 64 bits values of the fields set to 0xFFFFFFFF, in order
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from('<2H', extra, pos)
+        if tag == 1:
+            values = iter(struct.unpack_from('<{}Q'.format(min(size, len(extra) - pos - 4) // 8), extra, pos + 4))
+            return [next(values, f) if f == 0xFFFFFFFF else f for f in fields]
+        pos += 4 + size
+    return fields
+
+
+def zip_members(mapped: MappedFile) -> List[ZipMember]:
+    '''
+    Returns the members of the zip file mapped by mapped, read from its central directory.
+    Raises ZipFormatException if it isn't a zip file.
+    '''
+    view = mapped.view
+    pos = mapped.rfind(b'PK\x05\x06', max(0, len(view) - MAX_EOCD_SEARCH))
+    if pos < 0 or pos + EOCD.size > len(view):
+        raise ZipFormatException(mapped.filename, 'no end of central directory')
+    _, _, _, _, count, cdsize, cdoffset, _ = EOCD.unpack_from(view, pos)
+    eocd = pos
+    if count == 0xFFFF or cdsize == 0xFFFFFFFF or cdoffset == 0xFFFFFFFF:
+        locator = pos - EOCD64_LOCATOR.size
+        if locator < 0 or EOCD64_LOCATOR.unpack_from(view, locator)[0] != b'PK\x06\x07':
+            raise ZipFormatException(mapped.filename, 'no zip64 end of central directory locator')
+        eocd = locator - EOCD64.size
+        if eocd < 0 or EOCD64.unpack_from(view, eocd)[0] != b'PK\x06\x06':
+            raise ZipFormatException(mapped.filename, 'no zip64 end of central directory')
+        count, cdsize, cdoffset = EOCD64.unpack_from(view, eocd)[7:10]
+    # Data prepended to the archive, like the stub of a self-extracting archive, shifts every offset
+    shift = eocd - cdsize - cdoffset
+    if shift < 0:
+        raise ZipFormatException(mapped.filename, 'central directory out of the file')
+
+    members = []
+    pos = cdoffset + shift
+    for _ in range(count):
+        if pos + CENTRAL_ENTRY.size > len(view):
+            raise ZipFormatException(mapped.filename, 'truncated central directory')
+        (sig, _, _, flags, method, _, _, crc, csize, usize,
+         namelen, extralen, commentlen, _, _, _, offset) = CENTRAL_ENTRY.unpack_from(view, pos)
+        if sig != b'PK\x01\x02':
+            raise ZipFormatException(mapped.filename, 'bad central directory entry at {}'.format(pos))
+        start = pos + CENTRAL_ENTRY.size
+        name = bytes(view[start:start + namelen]).decode('utf-8' if flags & 0x800 else 'cp437')
+        usize, csize, offset = _zip64_extra(view[start + namelen:start + namelen + extralen], [usize, csize, offset])
+        members.append(ZipMember(name, method, crc, csize, usize, offset + shift))
+        pos = start + namelen + extralen + commentlen
+    return members
+
+
+def member_data(mapped: MappedFile, member: ZipMember) -> memoryview:
+    '''
+    Returns the slice of the mapping holding the compressed data of member
+    '''
+    view = mapped.view
+    if member.header_offset + LOCAL_HEADER.size > len(view):
+        raise ZipFormatException(mapped.filename, 'truncated local header of {}'.format(member.name))
+    header = LOCAL_HEADER.unpack_from(view, member.header_offset)
+    if header[0] != b'PK\x03\x04':
+        raise ZipFormatException(mapped.filename, 'bad local header of {}'.format(member.name))
+    start = member.header_offset + LOCAL_HEADER.size + header[9] + header[10]
+    if start + member.compressed_size > len(view):
+        raise ZipFormatException(mapped.filename, 'truncated data of {}'.format(member.name))
+    return view[start:start + member.compressed_size]
+
+
+def _target(targetdir: str, name: str) -> str:
+    parts = name.replace('\\', '/').split('/')
+    if name.startswith(('/', '\\')) or '..' in parts or ':' in parts[0]:
+        raise ZipFormatException(name, 'path out of the target directory')
+    return os.path.join(targetdir, *[p for p in parts if p])
+
+
+def _write_member(mapped: MappedFile, member: ZipMember, f, chunksize: int):
+    if member.method == STORED:
+        decompress = None
+    elif member.method == DEFLATED:
+        decompress = zlib.decompressobj(-15)
+    else:
+        raise UnsupportedZipException(member.name, 'unsupported compression method {}'.format(member.method))
+    crc = 0
+    size = 0
+    # Slices are released as soon as they are written, even on errors, so that the mapping can be closed
+    with member_data(mapped, member) as data:
+        for i in range(0, len(data), chunksize):
+            with data[i:i + chunksize] as chunk:
+                out = chunk if decompress is None else decompress.decompress(chunk)
+                f.write(out)
+                crc = zlib.crc32(out, crc)
+                size += len(out)
+    if decompress is not None:
+        out = decompress.flush()
+        f.write(out)
+        crc = zlib.crc32(out, crc)
+        size += len(out)
+    if crc != member.crc or size != member.size:
+        raise ZipFormatException(member.name, 'crc or size mismatch')
+
+
+def Extract_Zip(filepath: str, targetdir: str, chunksize: int = 64 * 1024, fallback: Callable = None):
+    '''
+    Extracts the zip file filepath into targetdir from its shared mapping, without any external tool: stored members
+    are written from the mapped pages, deflated ones are decompressed slice by slice, both are checked against
+    their crc.
+    Archives using other compression methods are extracted with fallback(filepath, targetdir) if it is given,
+    before anything is written.
+    Returns 1 like Extract_Archive, 0 if the archive is corrupted, uses an unsupported compression method without
+    fallback or has members out of targetdir.
+    '''
+    try:
+        with mappings.open(filepath) as mapped:
+            members = zip_members(mapped)
+            unsupported = [m.name for m in members if not m.is_dir and m.method not in (STORED, DEFLATED)]
+            if unsupported and fallback is not None:
+                log.info('%s uses unsupported compression methods for %s, extracting it with %s', filepath,
+                         unsupported[0], getattr(fallback, '__name__', fallback))
+                return fallback(filepath, targetdir)
+            for i, member in enumerate(members):
+                target = _target(targetdir, member.name)
+                if member.is_dir:
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as f:
+                    _write_member(mapped, member, f, chunksize)
+                if progress.bus.active:
+                    progress.bus.publish(filepath, 'extract', i + 1, len(members))
+    except (ZipFormatException, zlib.error):
+        log.exception('Could not extract %s', filepath)
+        progress.bus.publish(filepath, 'extract', done=True, message='failed')
+        return 0
+    progress.bus.publish(filepath, 'extract', len(members), len(members), done=True)
+    log.info('Extracting was successful for %s', filepath)
+    return 1
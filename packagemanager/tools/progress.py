@@ -0,0 +1,150 @@
+import logging
+import sys
+import threading
+import time
+from typing import Callable, Dict, List
+
+log = logging.getLogger(__name__)
+
+
+class ProgressEvent:
+    '''
+    Describes the progress of a task.
+    task identifies what is being worked on (usually a filename), stage is the kind of work ('download', 'extract',
+    'check', 'merge'...), current and total are amounts of work in the unit of the stage (total can be None if unknown).
+    done is True for the last event of a stage.
+    '''
+    __slots__ = ('task', 'stage', 'current', 'total', 'done', 'message')
+
+    def __init__(self, task: str, stage: str, current: int = 0, total: int = None, done: bool = False,
+                 message: str = None):
+        self.task = task
+        self.stage = stage
+        self.current = current
+        self.total = total
+        self.done = done
+        self.message = message
+
+    @property
+    def fraction(self):
+        if self.total:
+            return self.current / self.total
+        return None
+
+    def __repr__(self):
+        return 'ProgressEvent({!r}, {!r}, {}, {}, done={})'.format(self.task, self.stage, self.current, self.total,
+                                                                  self.done)
+
+
+class ProgressBus:
+    '''
+    Dispatches progress events to subscribers.
+    Events of a task are rate limited to one every interval seconds, events published in between are coalesced:
+    only the latest one is kept and it is dispatched by the next allowed publish or by flush.
+    Events marked as done are always dispatched.
+    Publishers in hot loops should check active before building events, publishing costs nothing when
+    nobody is subscribed.
+    '''
+
+    def __init__(self, interval: float = 0.1, clock: Callable[[], float] = time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self._subscribers: List[Callable[[ProgressEvent], None]] = []
+        self._last: Dict[tuple, float] = {}
+        self._pending: Dict[tuple, ProgressEvent] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return bool(self._subscribers)
+
+    def subscribe(self, callback: Callable[[ProgressEvent], None]):
+        '''
+        Adds callback to the subscribers, it will be called with every dispatched ProgressEvent.
+        Returns the callback so it can be used as a decorator.
+        '''
+        with self._lock:
+            self._subscribers = self._subscribers + [callback]
+        return callback
+
+    def unsubscribe(self, callback: Callable[[ProgressEvent], None]):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s != callback]
+            if not self._subscribers:
+                self._last.clear()
+                self._pending.clear()
+
+    def publish(self, task: str, stage: str, current: int = 0, total: int = None, done: bool = False,
+                message: str = None):
+        if not self._subscribers:
+            return
+        key = (task, stage)
+        event = ProgressEvent(task, stage, current, total, done, message)
+        now = self.clock()
+        with self._lock:
+            if done:
+                self._pending.pop(key, None)
+                self._last.pop(key, None)
+            elif key in self._last and now - self._last[key] < self.interval:
+                self._pending[key] = event
+                return
+            else:
+                self._pending.pop(key, None)
+                self._last[key] = now
+        self._dispatch(event)
+
+    def flush(self):
+        '''
+        Dispatches the coalesced events that were held back by the rate limit
+        '''
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for event in pending:
+            self._dispatch(event)
+
+    def _dispatch(self, event: ProgressEvent):
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception:
+                log.exception('Progress subscriber %s failed', callback)
+
+
+class ConsolePrinter:
+    '''
+    Subscriber writing the progress of the latest task on a single console line
+    '''
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+
+    def __call__(self, event: ProgressEvent):
+        if event.fraction is not None:
+            line = '\r{} {}: {:.2f}% complete'.format(event.stage, event.task, 100 * event.fraction)
+        else:
+            line = '\r{} {}: {}'.format(event.stage, event.task, event.current)
+        if event.done:
+            line += '\n'
+        self.stream.write(line)
+        self.stream.flush()
+
+
+class LogSubscriber:
+    '''
+    Subscriber logging progress events, by default only the end of each stage
+    '''
+
+    def __init__(self, logger: logging.Logger = log, level: int = logging.INFO, only_done: bool = True):
+        self.logger = logger
+        self.level = level
+        self.only_done = only_done
+
+    def __call__(self, event: ProgressEvent):
+        if event.done or not self.only_done:
+            self.logger.log(self.level, '%s %s: %s/%s%s', event.stage, event.task, event.current, event.total,
+                            ' done' if event.done else '')
+
+
+# Default bus used by the tools
+bus = ProgressBus()
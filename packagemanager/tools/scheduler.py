@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict
+
+from . import download, aiodownload
+
+log = logging.getLogger(__name__)
+
+# Codes worth retrying on the same host, other failures move on to the next mirror right away
+RETRYABLE_CODES = {-1, download.INTEGRITY_ERROR, 408, 429, 500, 502, 503, 504}
+
+
+class HostState:
+    '''
+    Failure bookkeeping of a host.
+    budget is the number of retries the host has left, it is refilled by successes up to the scheduler maximum.
+    The circuit of the host is open after too many consecutive failures: no request is sent to it until the
+    cooldown is over, then a single trial request decides whether it is closed again.
+    '''
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+
+class DownloadScheduler:
+    '''
+    Downloads files from ordered lists of mirrors with retries, exponential backoff with jitter and per host
+    circuit breaking.
+    Each attempt on a host waits a random delay between 0 and min(maxbackoff, backoff * 2 ** attempt) before
+    retrying. A host accepts at most retries retries per download and spends them from a shared budget of
+    retry_budget retries, refilled by one on each success. After failure_threshold consecutive failures the
+    host is skipped for cooldown seconds.
+    download and asyncdownload are the functions used to download a single url, they take the same arguments
+    as download.DownloadFile. validators is passed to them to make requests conditional, a NOT_MODIFIED answer
+    counts as a success.
+    '''
+
+    def __init__(self, retries: int = 3, retry_budget: int = 20, backoff: float = 0.5, maxbackoff: float = 30,
+                 failure_threshold: int = 5, cooldown: float = 60,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep,
+                 asyncsleep: Callable = asyncio.sleep, rand: Callable[[], float] = random.random,
+                 download: Callable = download.DownloadFile, asyncdownload: Callable = aiodownload.AsyncDownloadFile,
+                 validators: download.ValidatorStore = None):
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.asyncsleep = asyncsleep
+        self.rand = rand
+        self._download = download
+        self._asyncdownload = asyncdownload
+        self.validators = validators
+        self.hosts: Dict[str, HostState] = {}
+        self._lock = threading.Lock()
+
+    def host(self, url: str) -> HostState:
+        name = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if name not in self.hosts:
+                self.hosts[name] = HostState(self.retry_budget)
+            return self.hosts[name]
+
+    def delay(self, attempt: int) -> float:
+        return self.rand() * min(self.maxbackoff, self.backoff * 2 ** attempt)
+
+    def _acquire(self, state: HostState, retry: bool) -> bool:
+        '''
+        Returns True if a request can be sent to the host, spending a retry from its budget if retry is True
+        '''
+        with self._lock:
+            if state.open:
+                if state.trial or self.clock() - state.opened_at < self.cooldown:
+                    return False
+                # Half open, let a single request through
+                state.trial = True
+            if retry:
+                if state.budget <= 0:
+                    return False
+                state.budget -= 1
+            return True
+
+    def _record(self, state: HostState, success: bool):
+        with self._lock:
+            state.trial = False
+            if success:
+                state.failures = 0
+                state.opened_at = None
+                state.budget = min(state.budget + 1, self.retry_budget)
+            else:
+                state.failures += 1
+                if state.failures >= self.failure_threshold or state.opened_at is not None:
+                    state.opened_at = self.clock()
+
+    def _done(self, url: str, state: HostState, attempt: int, res) -> bool:
+        '''
+        Records the result of an attempt, returns True if no other attempt should be made on url
+        '''
+        code = res[0]
+        if code in (200, download.NOT_MODIFIED):
+            self._record(state, True)
+            return True
+        log.warning('Attempt %s on %s failed with %s', attempt + 1, url, code)
+        if code in RETRYABLE_CODES:
+            self._record(state, False)
+            return False
+        # The host answered, the file just isn't there
+        self._record(state, True)
+        return True
+
+    def download(self, urls, filename, reporthook=None, expected_size=None, expected_hash=None):
+        '''
+        Downloads filename from the first mirror of urls (a url or a list of urls) that succeeds.
+        Returns the result of the last attempt, see download.DownloadFile.
+        '''
+        res = (-1, 0)
+        for url in ([urls] if isinstance(urls, str) else urls):
+            state = self.host(url)
+            for attempt in range(self.retries + 1):
+                if not self._acquire(state, attempt > 0):
+                    log.warning('Skipping %s, its host is unavailable or out of retries', url)
+                    break
+                if attempt:
+                    self.sleep(self.delay(attempt - 1))
+                res = self._download(url, filename, reporthook, expected_size, expected_hash, retries=0,
+                                     validators=self.validators)
+                if self._done(url, state, attempt, res):
+                    break
+            if res[0] in (200, download.NOT_MODIFIED):
+                return res
+        return res
+
+    async def download_async(self, urls, filename, reporthook=None, expected_size=None, expected_hash=None):
+        '''
+        Asynchronous version of download
+        '''
+        res = (-1, 0)
+        for url in ([urls] if isinstance(urls, str) else urls):
+            state = self.host(url)
+            for attempt in range(self.retries + 1):
+                if not self._acquire(state, attempt > 0):
+                    log.warning('Skipping %s, its host is unavailable or out of retries', url)
+                    break
+                if attempt:
+                    await self.asyncsleep(self.delay(attempt - 1))
+                res = await self._asyncdownload(url, filename, reporthook, expected_size, expected_hash, retries=0,
+                                                validators=self.validators)
+                if self._done(url, state, attempt, res):
+                    break
+            if res[0] in (200, download.NOT_MODIFIED):
+                return res
+        return res
+
+    def _raise_on_failure(self, urls, filename, res):
+        if res[0] not in (200, download.NOT_MODIFIED):
+            log.error('Could not download %s from %s: %s', filename, urls, res)
+            raise download.DownloadFailedException(filename, res)
+        return res
+
+    def download_or_raise(self, urls, filename, reporthook=None, expected_size=None, expected_hash=None):
+        '''
+        download raising download.DownloadFailedException with the result unless the file was downloaded or is
+        up to date
+        '''
+        return self._raise_on_failure(urls, filename,
+                                      self.download(urls, filename, reporthook, expected_size, expected_hash))
+
+    async def download_or_raise_async(self, urls, filename, reporthook=None, expected_size=None, expected_hash=None):
+        return self._raise_on_failure(urls, filename, await self.download_async(urls, filename, reporthook,
+                                                                                expected_size, expected_hash))
+
+
+# Scheduler shared by the install actions
+scheduler = DownloadScheduler()
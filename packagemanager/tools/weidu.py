@@ -0,0 +1,315 @@
+import concurrent.futures
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import threading
+from sys import platform
+from typing import Dict, List, Tuple, Union
+
+from packagemanager import logs
+from . import progress
+from .Utils import RemoveTree, walkdir
+
+log = logging.getLogger(__name__)
+
+# Executable used to run the setups, a command line as a list can be given instead
+WEIDU = os.environ.get('PACKAGEMANAGER_WEIDU', 'weidu')
+
+# Status printed by WeiDU at the end of each component
+StatusPat = re.compile(r'(SUCCESSFULLY INSTALLED|INSTALLED WITH WARNINGS|NOT INSTALLED DUE TO ERRORS|'
+                       r'SUCCESSFULLY UNINSTALLED)\s+(.*)')
+
+# Logs appended to by every setup, merged back from sandboxes by appending instead of replacing
+APPENDED_FILES = ('weidu.log',)
+
+
+class SetupFailedException(Exception): pass
+
+
+class CappedOutput:
+    '''
+    Keeps the first and last maxbytes / 2 bytes written to it, the middle is dropped and counted
+    '''
+
+    def __init__(self, maxbytes: int):
+        self.maxbytes = maxbytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+
+    def write(self, data: bytes):
+        room = self.maxbytes // 2 - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        self.tail += data
+        extra = len(self.tail) - (self.maxbytes - self.maxbytes // 2)
+        if extra > 0:
+            del self.tail[:extra]
+            self.dropped += extra
+
+    def getvalue(self) -> bytes:
+        middle = b'\n[... %d bytes dropped ...]\n' % self.dropped if self.dropped else b''
+        return bytes(self.head) + middle + bytes(self.tail)
+
+
+class SetupResult:
+    '''
+    Outcome of a setup run. components maps the component descriptions printed by the setup to their status.
+    '''
+
+    def __init__(self, tp2: str, returncode: int, output: bytes, timed_out: bool, components: Dict[str, str]):
+        self.tp2 = tp2
+        self.returncode = returncode
+        self.output = output
+        self.timed_out = timed_out
+        self.components = components
+
+    @property
+    def failed(self) -> List[str]:
+        return [c for c, status in self.components.items() if status == 'NOT INSTALLED DUE TO ERRORS']
+
+    @property
+    def warnings(self) -> List[str]:
+        return [c for c, status in self.components.items() if status == 'INSTALLED WITH WARNINGS']
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out and not self.failed
+
+    def __repr__(self):
+        return 'SetupResult({!r}, returncode={}, timed_out={}, components={})'.format(
+            self.tp2, self.returncode, self.timed_out, self.components)
+
+
+def setup_command(tp2: str, components: List[Union[int, str]], language: int = 0, uninstall: bool = False,
+                  weidu: Union[str, List[str]] = None) -> List[str]:
+    if weidu is None:
+        weidu = WEIDU
+    command = [weidu] if isinstance(weidu, str) else list(weidu)
+    command.append(tp2)
+    command.extend(['--language', str(language)])
+    command.append('--force-uninstall-list' if uninstall else '--force-install-list')
+    command.extend(str(c) for c in components)
+    command.extend(['--no-exit-pause', '--noautoupdate', '--skip-at-view',
+                    '--log', os.path.splitext(os.path.basename(tp2))[0] + '.debug'])
+    return command
+
+
+def _kill(proc: subprocess.Popen):
+    # Kills the setup and the processes it started, the process group on posix, the process tree on windows
+    try:
+        if platform == 'win32':
+            if subprocess.run(['taskkill', '/T', '/F', '/PID', str(proc.pid)], stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+                proc.kill()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    except OSError:
+        log.exception('Could not kill the process tree of %s', proc.pid)
+        proc.kill()
+
+
+def RunSetup(gamedir: str, tp2: str, components: List[str], language: int = 0, uninstall: bool = False,
+             weidu: Union[str, List[str]] = None, timeout: float = 3600, maxlog: int = 2 ** 20,
+             chunksize: int = 64 * 1024) -> SetupResult:
+    '''
+    Installs (or uninstalls) components of tp2 in gamedir without any prompt, by running weidu (WEIDU if None)
+    in its own process group.
+    The output is streamed to a CappedOutput of maxlog bytes and parsed for the status of each component as it
+    arrives. The setup is killed, with the processes it started, after timeout seconds.
+    Returns a SetupResult.
+    '''
+    command = setup_command(tp2, components, language, uninstall, weidu)
+    log.info('Running %s in %s', command, gamedir)
+    # Stops the console window from popping
+    if platform == 'win32':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        isolation = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        startupinfo = None
+        isolation = {'start_new_session': True}
+
+    output = CappedOutput(maxlog)
+    statuses = {}
+    trace = logs.tracing(log)
+
+    def parse(line: bytes):
+        line = line.decode('utf-8', 'replace').strip()
+        if trace:
+            log.debug('%s: %s', tp2, line)
+        m = StatusPat.match(line)
+        if m:
+            statuses[m.group(2)] = m.group(1)
+            progress.bus.publish(tp2, 'install-script', len(statuses), len(components))
+
+    def read(stream):
+        pending = b''
+        for chunk in iter(lambda: stream.read1(chunksize), b''):
+            output.write(chunk)
+            lines = (pending + chunk).split(b'\n')
+            # Only the status lines matter, the end of overlong lines is enough
+            pending = lines.pop()[-chunksize:]
+            for line in lines:
+                parse(line)
+        if pending:
+            parse(pending)
+
+    proc = subprocess.Popen(command, cwd=gamedir, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, startupinfo=startupinfo, **isolation)
+    reader = threading.Thread(target=read, args=(proc.stdout,), daemon=True)
+    reader.start()
+    timed_out = False
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        log.error('%s did not finish in %s seconds, killing it', tp2, timeout)
+        timed_out = True
+        _kill(proc)
+        proc.wait()
+    finally:
+        reader.join(5)
+        proc.stdout.close()
+
+    result = SetupResult(tp2, proc.returncode, output.getvalue(), timed_out, statuses)
+    progress.bus.publish(tp2, 'install-script', len(statuses), len(components), done=True,
+                         message=None if result.ok else 'failed')
+    if result.ok:
+        log.info('%s done: %s', tp2, statuses)
+    else:
+        log.error('%s failed with code %s, failed components %s', tp2, proc.returncode, result.failed)
+    return result
+
+
+def RunSetupOrRaise(*args, **kwargs) -> SetupResult:
+    '''
+    RunSetup raising SetupFailedException with the result if the setup failed
+    '''
+    result = RunSetup(*args, **kwargs)
+    if not result.ok:
+        raise SetupFailedException(result)
+    return result
+
+
+class Sandbox:
+    '''
+    Copy of a game directory in which a setup can run next to setups running in other sandboxes.
+    commit moves the files created or modified in the sandbox back to the game directory and removes from it the
+    files deleted in the sandbox. Files of APPENDED_FILES get the lines added in the sandbox appended instead.
+    Sandboxes are only safe for setups touching disjoint files.
+    '''
+
+    def __init__(self, gamedir: str, path: str):
+        self.gamedir = gamedir
+        self.path = path
+        self.snapshot: Dict[str, Tuple[int, int]] = {}
+
+    def create(self) -> "Sandbox":
+        log.info('Creating sandbox %s of %s', self.path, self.gamedir)
+        shutil.copytree(self.gamedir, self.path)
+        for entry in walkdir(self.path, dirs=False):
+            st = entry.stat()
+            self.snapshot[entry.relpath] = (st.st_size, st.st_mtime_ns)
+        return self
+
+    def changes(self) -> Tuple[List[str], List[str]]:
+        '''
+        Returns the paths, relative to the sandbox, of the files created or modified since create and of the files
+        deleted since create
+        '''
+        changed = []
+        present = set()
+        for entry in walkdir(self.path, dirs=False):
+            st = entry.stat()
+            present.add(entry.relpath)
+            if self.snapshot.get(entry.relpath) != (st.st_size, st.st_mtime_ns):
+                changed.append(entry.relpath)
+        deleted = [relpath for relpath in self.snapshot if relpath not in present]
+        return changed, deleted
+
+    def commit(self, changes: Tuple[List[str], List[str]] = None) -> List[str]:
+        '''
+        Applies the changes of the sandbox to the game directory, returns the paths changed or deleted.
+        changes is the result of changes if it was already computed.
+        '''
+        changed, deleted = changes if changes is not None else self.changes()
+        for relpath in deleted:
+            try:
+                os.remove(os.path.join(self.gamedir, relpath))
+            except FileNotFoundError:
+                pass
+        samedrive = os.stat(self.path).st_dev == os.stat(self.gamedir).st_dev
+        for relpath in changed:
+            src = os.path.join(self.path, relpath)
+            dst = os.path.join(self.gamedir, relpath)
+            if os.path.basename(relpath).lower() in APPENDED_FILES and relpath in self.snapshot:
+                with open(src, 'rb') as f:
+                    f.seek(self.snapshot[relpath][0])
+                    added = f.read()
+                with open(dst, 'ab') as f:
+                    f.write(added)
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if samedrive:
+                os.replace(src, dst)
+            else:
+                shutil.copy2(src, dst)
+        log.info('Committed %s files and %s deletions from sandbox %s', len(changed), len(deleted), self.path)
+        return changed + deleted
+
+    def cleanup(self):
+        RemoveTree(self.path)
+
+    def __enter__(self):
+        return self.create()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cleanup()
+
+
+def RunSetupsSideBySide(gamedir: str, runs: List[Dict], sandboxdir: str, workers: int = 2) -> List[SetupResult]:
+    '''
+    Runs several setups at the same time, each one in its own Sandbox of gamedir created in sandboxdir.
+    runs are the keyword arguments of RunSetup for each setup, without gamedir.
+    The sandboxes of the setups that succeeded are committed in the order of runs, unless they changed a file
+    (other than APPENDED_FILES) already changed by a committed one, like dialog.tlk: those setups are run again one
+    after another in gamedir once the others are committed.
+    Returns the results in the order of runs.
+    '''
+    sandboxes = [Sandbox(gamedir, os.path.join(sandboxdir, 'sandbox{}'.format(i))) for i in range(len(runs))]
+
+    def run(sandbox, kwargs):
+        sandbox.create()
+        return RunSetup(sandbox.path, **kwargs)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run, sandboxes, runs))
+        claimed = set()
+        rerun = []
+        for i, (sandbox, result) in enumerate(zip(sandboxes, results)):
+            if not result.ok:
+                continue
+            changes = sandbox.changes()
+            paths = {p for p in changes[0] + changes[1] if os.path.basename(p).lower() not in APPENDED_FILES}
+            overlap = paths & claimed
+            if overlap:
+                log.warning('%s changed files changed by another setup (%s), running it again in %s',
+                            runs[i].get('tp2'), sorted(overlap)[:5], gamedir)
+                rerun.append(i)
+                continue
+            claimed |= paths
+            sandbox.commit(changes)
+        for i in rerun:
+            results[i] = RunSetup(gamedir, **runs[i])
+    finally:
+        for sandbox in sandboxes:
+            if os.path.exists(sandbox.path):
+                sandbox.cleanup()
+    return results
@@ -1,11 +1,144 @@
+import asyncio
+import collections
+import hashlib
+import http.server
+import io
 import json
 import logging.config
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import threading
 import unittest
+import unittest.mock
+import zipfile
+from functools import partial
 
 log = logging.getLogger(__name__)
 logging.config.dictConfig(json.load(open('logging_config.json', 'r')))
 
-from packagemanager import manager as mngr
+from packagemanager import manager as mngr, logs, tools, aioinstall, conflicts, planning, iemods, multiprofile, search
+from packagemanager.tools import aiodownload
+from packagemanager.tools import download, extraction, mapped, progress, scheduler, weidu, Utils
+import consoleGUI
+
+try:
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtCore, QtWidgets
+    import PyQt5GUI
+except ImportError:
+    PyQt5GUI = None
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class TruncatingHandler(QuietHandler):
+    '''
+    Serves the first truncate bytes of the files while announcing their full length
+    '''
+    truncate = 10
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        with open(self.translate_path(self.path), 'rb') as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data[:self.truncate])
+        self.close_connection = True
+
+
+class FailingHandler(QuietHandler):
+    '''
+    Answers 503 to the first failures requests then serves the files
+    '''
+    failures = 0
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        if type(self).failures > 0:
+            type(self).failures -= 1
+            self.send_error(503)
+            return
+        super().do_GET()
+
+
+class StallingHandler(QuietHandler):
+    '''
+    Sends the headers and the first bytes of the files then stalls for stall seconds
+    '''
+    stall = 2
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '1000')
+        self.end_headers()
+        self.wfile.write(b'x' * 10)
+        self.wfile.flush()
+        time.sleep(self.stall)
+        self.close_connection = True
+
+
+class GarbageHandler(QuietHandler):
+    '''
+    Answers with something else than HTTP
+    '''
+
+    def do_GET(self):
+        self.wfile.write(b'garbage\r\n\r\n')
+        self.close_connection = True
+
+
+class LocalServer:
+    def __init__(self, directory, handler=QuietHandler):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=directory))
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# Stands in for WeiDU: installs each component by writing a file to override and a line to weidu.log, the components
+# named fail, sleep and spam fail, hang and print a lot
+STUB_WEIDU = """
+import os, sys, time
+tp2 = sys.argv[1]
+args = sys.argv[sys.argv.index('--force-install-list') + 1:]
+failed = False
+for comp in args[:args.index('--no-exit-pause')]:
+    if comp == 'sleep':
+        time.sleep(30)
+    if comp == 'spam':
+        print('x' * 100000)
+    if comp == 'tlk':
+        with open('dialog.tlk', 'a') as f:
+            f.write(tp2)
+    if comp == 'fail':
+        print('NOT INSTALLED DUE TO ERRORS Component ' + comp, flush=True)
+        failed = True
+        continue
+    os.makedirs('override', exist_ok=True)
+    with open('override/{}_{}.txt'.format(tp2, comp), 'w') as f:
+        f.write(comp)
+    with open('weidu.log', 'a') as f:
+        f.write('~{}~ #0 #{}\\n'.format(tp2, comp))
+    print('SUCCESSFULLY INSTALLED Component ' + comp, flush=True)
+sys.exit(1 if failed else 0)
+"""
 
 
 class TestDependencies(unittest.TestCase):
@@ -252,7 +385,479 @@ class TestManager(unittest.TestCase):
         with self.assertRaises(mngr.UnavailablePackageException):
             m.select_pkg(self.p2, list(self.p2.get_childrens()))
 
+    def test_getcomp(self):
+        m = mngr.Manager()
+        m.add_pkg(self.p3)
+        self.assertIs(m.getcomp('pid03'), self.p3)
+        self.assertIs(m.getcomp('pid03.cid05.cid04'), self.c4)
+        self.assertIs(m.getcomp('pid03.cid05.cid04.cid03'), self.c3)
+
+
+
+class RecordingPackage(mngr.Package):
+    def generate_install_actions(self, installed_components):
+        return [mngr.InstallAction(installmethod=None, args=[], prev=[],
+                                   id='install ' + ','.join(c.get_full_id() for c in installed_components))]
+
+    def generate_uninstall_actions(self, installed_components):
+        return [mngr.InstallAction(installmethod=None, args=[], prev=[],
+                                   id='uninstall ' + ','.join(c.get_full_id() for c in installed_components))]
+
+    def generate_component_actions(self, components):
+        return [mngr.InstallAction(installmethod=None, args=[], prev=[],
+                                   id='components ' + ','.join(c.get_full_id() for c in components))]
+
+
+class TestSelectionDiff(unittest.TestCase):
+    def setUp(self):
+        self.m = mngr.Manager()
+        self.pkgs = {}
+        # b must be installed before a, c after every component of a
+        for pkgid, depends in (('a', mngr.Dependencies()), ('b', mngr.Dependencies(before=['a'])),
+                               ('c', mngr.Dependencies(after=['a'])), ('d', mngr.Dependencies())):
+            comps = [mngr.SubComponent(componentid=str(i), name=str(i)) for i in range(2)]
+            self.pkgs[pkgid] = RecordingPackage(packageid=pkgid, name=pkgid, depends=depends, components=comps)
+            self.m.add_pkg(self.pkgs[pkgid])
+
+    def select(self, *ids):
+        for cid in ids:
+            self.m.select_pkg(self.pkgs[cid[0]], [self.m.getcomp(cid)])
+
+    def test_install_order(self):
+        self.select('c.0', 'a.0', 'd.0', 'a.1', 'b.0')
+        self.assertEqual(self.m.install_order(), ['d.0', 'b.0', 'a.0', 'a.1', 'c.0'])
+        # The previous order is kept where the constraints allow it
+        self.assertEqual(self.m.install_order(['d.0', 'a.1', 'c.0']), ['d.0', 'b.0', 'a.1', 'a.0', 'c.0'])
+
+    def test_order_loop(self):
+        self.pkgs['a'].depends.before.add('b')
+        self.select('a.0', 'b.0', 'd.0')
+        with self.assertRaises(mngr.IncompatibleOrderException):
+            self.m.install_order()
+
+    def test_diff_suffix(self):
+        self.select('a.0', 'a.1', 'c.0', 'd.0', 'd.1')
+        installed = mngr.InstalledState(self.m.install_order())
+        self.assertFalse(self.m.diff(installed))
+
+        # Toggling a late component only redoes what follows it
+        self.m.unselect_package(self.pkgs['d'], [self.m.getcomp('d.0')])
+        diff = self.m.diff(installed)
+        self.assertEqual((diff.kept, diff.uninstall, diff.install, diff.reinstall),
+                         (3, ['d.1', 'd.0'], ['d.1'], ['d.1']))
+        self.assertEqual([a.id for a in self.m.generate_diff_action_list(diff)],
+                         ['uninstall d.1,d.0', 'install d.1'])
+
+        # b has to go before a, so everything is redone
+        self.select('b.1')
+        diff = self.m.diff(installed)
+        self.assertEqual(diff.kept, 0)
+        self.assertEqual(diff.install, ['d.1', 'b.1', 'a.0', 'a.1', 'c.0'])
+        actions = self.m.generate_diff_action_list(diff)
+        self.assertEqual([a.id for a in actions], ['uninstall d.1,d.0', 'uninstall c.0', 'uninstall a.1,a.0',
+                                                   'install d.1', 'install b.1', 'install a.0,a.1', 'install c.0'])
+        self.assertEqual([a.id for a in mngr.sortInstallActionList(actions[-1:])], [a.id for a in actions])
+
+    def test_diff_split_package(self):
+        self.m.getcomp('a.1').depends.after.add('d')
+        self.select('a.0', 'a.1', 'd.0')
+        diff = self.m.diff(mngr.InstalledState())
+        self.assertEqual(diff.install, ['a.0', 'd.0', 'a.1'])
+        actions = self.m.generate_diff_action_list(diff)
+        self.assertEqual([a.id for a in actions], ['install a.0', 'install d.0', 'components a.1'])
+        self.assertEqual([a.prev for a in actions[1:]], [[a] for a in actions[:-1]])
+
+    def test_installed_state_json(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(mngr.InstalledState.load_from_json(tmp + '/installed.json').components, [])
+            mngr.InstalledState(['a.0', 'b.1']).save_to_json(tmp + '/installed.json')
+            self.assertEqual(mngr.InstalledState.load_from_json(tmp + '/installed.json').components, ['a.0', 'b.1'])
+
+
+class TestSavedSelection(unittest.TestCase):
+    def setUp(self):
+        self.m = mngr.Manager()
+        for pkgid in ('a', 'b'):
+            comps = [mngr.SubComponent(componentid=str(i), name=str(i)) for i in range(3)]
+            self.m.add_pkg(mngr.Package(packageid=pkgid, name=pkgid, depends=mngr.Dependencies(), components=comps))
+        self.m.getcomp('b.2').depends.conflicts.add('a.0')
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = self.tmp.name + '/selection.txt'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        self.m.select_components([self.m.getcomp(c) for c in ('a.1', 'b.0', 'a.2')])
+        self.m.save_selection(self.filename)
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), 'a.1\na.2\nb.0\n')
+
+        self.m.clear_selection()
+        self.assertEqual(self.m.selectedpkg, {})
+        self.m.select_components([self.m.getcomp('b.1')])
+        self.m.load_selection(self.filename)
+        self.assertEqual({k: s.get_components_id() for k, s in self.m.selectedpkg.items()},
+                         {'a': ['a.1', 'a.2'], 'b': ['b.0']})
+
+    def test_conflicts_checked_once(self):
+        with open(self.filename, 'w') as f:
+            f.write('# conflicting selection\nb.2\n\na.0\n')
+        self.m.select_components([self.m.getcomp('a.1')])
+        with self.assertRaises(mngr.PackageHasConflictException) as cm:
+            self.m.load_selection(self.filename)
+        self.assertEqual(cm.exception.args[0], ['a.0'])
+        # The previous selection is restored with its conflict counters
+        self.assertEqual(list(self.m.selectedpkg), ['a'])
+        self.assertEqual(self.m.getcomp('a.0').nb_conflicts, 0)
+        self.m.load_selection(self.filename, raiseconflicts=False)
+        self.assertEqual(self.m.getcomp('a.0').nb_conflicts, 1)
+
+    def test_unknown_components(self):
+        with open(self.filename, 'w') as f:
+            f.write('a.0\na.9\nz.0\n')
+        with self.assertRaises(mngr.UnexistingComponentException) as cm:
+            self.m.load_selection(self.filename)
+        self.assertEqual(cm.exception.args[0], ['a.9', 'z.0'])
+
+
+class TestCatalogIndex(unittest.TestCase):
+    def setUp(self):
+        self.m = mngr.Manager()
+        for pkgid, name, desc, comps in (('golems', 'Golem Construction', 'Tomes teaching how to build golems',
+                                          ['Improve enemy spellcaster AI']),
+                                         ('tweaks', 'Tweaks Anthology', 'Assorted tweaks', ['Golem immunities']),
+                                         ('brynnlaw', 'Back to Brynnlaw', 'A rogue Cowled Wizard', [])):
+            self.m.add_pkg(iemods.IEMod(packageid=pkgid, name=name, desc=desc, depends=mngr.Dependencies(),
+                                        components=[mngr.SubComponent(componentid=str(i), name=c)
+                                                    for i, c in enumerate(comps)], versionno='1.0',
+                                        downloadurl='http://127.0.0.1/mod.zip'))
+        self.tmp = tempfile.TemporaryDirectory()
+        with open(self.tmp.name + '/brynnlaw.ini', 'w', encoding='latin-1') as f:
+            f.write('[Tp2]\nsetup-brynnlaw.tp2\n\n[Mod]\nName = Back to Brynnlaw\n\n'
+                    '[WeiDU-GE]\n@0 = Zurück nach Brynnlaw\nTra = 1\n\n'
+                    '[Description]\nMod-EN = Investigations with Imoen\n')
+        with open(self.tmp.name + '/unknown.ini', 'w') as f:
+            f.write('[Description]\nMod-EN = golems\n')
+        self.index = search.CatalogIndex.from_manager(self.m, self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_ranking(self):
+        # The name of golems matches, only a component of tweaks does
+        self.assertEqual([r[0] for r in self.index.search('golem')], ['golems', 'tweaks'])
+        self.assertEqual([r[0] for r in self.index.search('golem tweak')], ['tweaks'])
+        self.assertEqual(self.index.search('golem', limit=1)[0][0], 'golems')
+        self.assertEqual(self.index.search(''), [])
+        self.assertEqual(self.index.search('dragon'), [])
+
+    def test_prefix_and_substring(self):
+        self.assertEqual(list(self.index.prefix('im')), ['immunities', 'imoen', 'improve'])
+        self.assertEqual(self.index.search('struct'), [])
+        self.assertEqual([r[0] for r in self.index.search('struct', substring=True)], ['golems'])
+
+    def test_ini(self):
+        self.assertEqual([r[0] for r in self.index.search('zurück')], ['brynnlaw'])
+        self.assertEqual([r[0] for r in self.index.search('imoen')], ['brynnlaw'])
+        self.assertNotIn('unknown', {pkgid for postings in self.index.postings.values() for pkgid in postings})
+
+
+class TestConsoleCommands(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.catalog = self.tmp.name + '/mods.json'
+        mods = {}
+        for i in range(3):
+            c = mngr.SubComponent(componentid='0', name='Component {}'.format(i))
+            mods['mod' + str(i)] = iemods.IEMod(packageid='mod' + str(i), name='Mod {}'.format(i),
+                                                depends=mngr.Dependencies(), components=[c], versionno='1.0',
+                                                downloadurl='http://localhost/mod{}.zip'.format(i))
+        iemods.IEMod.save_to_json(mods, self.catalog)
+
+    def tearDown(self):
+        self.tmp.cleanup()
 
+    def run_main(self, *argv):
+        out, err = io.StringIO(), io.StringIO()
+        with unittest.mock.patch.object(sys, 'stdout', out), unittest.mock.patch.object(sys, 'stderr', err):
+            self.assertEqual(consoleGUI.main(['--catalog', self.catalog] + list(argv)), 0)
+        return out.getvalue(), err.getvalue()
+
+    def test_commands(self):
+        out, err = self.run_main('list')
+        self.assertEqual(out, 'Mod 0 : mod0\nMod 1 : mod1\nMod 2 : mod2\n')
+        self.assertEqual(err, '')
+        out, _ = self.run_main('search', 'component', '1')
+        self.assertEqual(out, 'Mod 1 : mod1\n')
+
+        with open(self.tmp.name + '/selection.txt', 'w') as f:
+            f.write('mod0.0\nmod2.0\n')
+        mngr.InstalledState(['mod0.0', 'mod1.0']).save_to_json(self.tmp.name + '/installed.json')
+        out, _ = self.run_main('status', '--installed', self.tmp.name + '/installed.json',
+                               '--selection', self.tmp.name + '/selection.txt')
+        self.assertEqual(out, '2 components installed\n1 kept, 1 to uninstall, 1 to install\n')
+
+    def test_profile_startup(self):
+        out, err = self.run_main('--profile-startup', 'search', 'mod')
+        self.assertEqual(len(out.splitlines()), 3)
+        steps = [line.split()[0] for line in err.splitlines()[:-1]]
+        self.assertEqual(steps, ['imports', 'logging', 'catalog', 'index', 'search', 'total'])
+        self.assertIn('packagemanager modules loaded', err)
+
+    def test_install_needs_game_directory(self):
+        gui = consoleGUI.BWSconsoleGUI()
+        gui.load_mods(self.catalog)
+        out = io.StringIO()
+        with unittest.mock.patch('builtins.input', return_value=self.tmp.name), \
+                unittest.mock.patch.object(sys, 'stdout', out), \
+                unittest.mock.patch('packagemanager.planning.plan_install') as plan:
+            gui.install_current()
+        plan.assert_not_called()
+        self.assertIsNone(gui.gamedir)
+        self.assertEqual(out.getvalue(), '{} is not a game directory, aborting installation\n'.format(self.tmp.name))
+        self.assertEqual(consoleGUI.parse_args(['--gamedir', 'bg2']).gamedir, 'bg2')
+
+    def test_install_only_changes(self):
+        game = self.tmp.name + '/game'
+        os.makedirs(game)
+        open(game + '/chitin.key', 'w').close()
+        mngr.InstalledState(['mod1.0']).save_to_game(game)
+        gui = consoleGUI.BWSconsoleGUI(game)
+        gui.load_mods(self.catalog)
+        gui.mngr.select_pkg(gui.mngr.availablepkg['mod1'], gui.mngr.availablepkg['mod1'].subcomponents)
+        out = io.StringIO()
+        with unittest.mock.patch.object(sys, 'stdout', out), \
+                unittest.mock.patch('packagemanager.planning.plan_install') as plan:
+            gui.install_current()
+        plan.assert_not_called()
+        self.assertEqual(out.getvalue(), '1 kept, 0 to uninstall, 0 to install\n')
+        out, _ = self.run_main('--gamedir', game, 'status')
+        self.assertEqual(out, '1 components installed\n')
+
+    def test_lazy_tools(self):
+        code = ('import sys, consoleGUI\n'
+                'from packagemanager import tools\n'
+                'print(sorted(m for m in ("packagemanager.tools.download", "asyncio", "subprocess", "logging.config")'
+                ' if m in sys.modules))\n'
+                'tools.extraction.Extract_Archive\n'
+                'print("packagemanager.tools.extraction" in sys.modules, "extraction" in dir(tools))\n')
+        res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(res.stdout.splitlines(), ['[]', 'True True'])
+        with self.assertRaises(AttributeError):
+            tools.unknown
+
+
+class TestPagedTreeView(unittest.TestCase):
+    def setUp(self):
+        self.pkgs = []
+        for i in range(5):
+            comps = [mngr.SubComponent(componentid=str(j), name='c{}.{}'.format(i, j),
+                                       subcomponents=[mngr.SubComponent(componentid='s', name='s{}.{}'.format(i, j))])
+                     for j in range(3)]
+            self.pkgs.append(iemods.IEMod(packageid='p{}'.format(i), name='P{}'.format(i), desc='D{}'.format(i),
+                                          depends=mngr.Dependencies(), components=comps, versionno='1.0',
+                                          downloadurl='http://127.0.0.1/p{}.zip'.format(i)))
+        self.out = io.StringIO()
+        self.view = consoleGUI.PagedTreeView(self.pkgs, pagesize=4, out=self.out)
+
+    def names(self, start=0):
+        return [node.name for _, node in self.view.walk(start)]
+
+    def test_collapsed(self):
+        self.assertEqual(self.names(), ['P0', 'P1', 'P2', 'P3', 'P4'])
+        self.assertEqual(self.view.pages, 2)
+        self.assertEqual(self.view.render().splitlines(), ['   1 + P0 : p0', '   2 + P1 : p1', '   3 + P2 : p2',
+                                                          '   4 + P3 : p3', 'Page 1/2'])
+
+    def test_expand(self):
+        self.view.toggle(self.pkgs[1])
+        self.view.toggle(self.pkgs[1].subcomponents[1])
+        self.assertEqual(self.names(), ['P0', 'P1', 'c1.0', 'c1.1', 's1.1', 'c1.2', 'P2', 'P3', 'P4'])
+        # Rows before start are skipped by subtree
+        self.assertEqual(self.names(4), ['s1.1', 'c1.2', 'P2', 'P3', 'P4'])
+        self.assertEqual(self.names(9), [])
+        self.assertEqual(self.view.pages, 3)
+        self.view.toggle(self.pkgs[1])
+        self.assertEqual(self.names(1), ['P1', 'P2', 'P3', 'P4'])
+
+    def test_browse(self):
+        answers = iter(['n', '1', 'i 2', 'p', 'q'])
+        with unittest.mock.patch.object(self.out, 'write', wraps=self.out.write) as write:
+            self.view.browse(lambda prompt: next(answers))
+        # One write per page shown and one for the details
+        self.assertEqual(write.call_count, 6)
+        self.assertIn('   2     + c4.0', self.out.getvalue())
+        self.assertIn('P4 : p4\nD4\n1.0\nComponents :\n    c4.0\n        s4.0\n', self.out.getvalue())
+
+
+@unittest.skipIf(PyQt5GUI is None, 'PyQt5 is not installed')
+class TestPyQt5GUI(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    def wait(self, condition, timeout=5):
+        timer = QtCore.QElapsedTimer()
+        timer.start()
+        while not condition():
+            self.assertLess(timer.elapsed(), timeout * 1000)
+            self.app.processEvents(QtCore.QEventLoop.AllEvents, 50)
+
+    def packages(self, n):
+        return [iemods.IEMod(packageid='mod{}'.format(i), name='Mod {}'.format(i), depends=mngr.Dependencies(),
+                             components=[mngr.SubComponent(componentid=str(j), name='c{}'.format(j))
+                                         for j in range(3)], versionno='1.0', downloadurl='http://127.0.0.1/m.zip')
+                for i in range(n)]
+
+    def test_lazy_model(self):
+        model = PyQt5GUI.CatalogModel(self.packages(250), batch=100)
+        root = QtCore.QModelIndex()
+        self.assertEqual(model.rowCount(root), 0)
+        self.assertTrue(model.canFetchMore(root))
+        model.fetchMore(root)
+        self.assertEqual(model.rowCount(root), 100)
+        pkg = model.index(5, 0, root)
+        self.assertEqual(model.data(pkg), 'Mod 5')
+        self.assertTrue(model.hasChildren(pkg))
+        self.assertEqual(model.rowCount(pkg), 0)
+        model.fetchMore(pkg)
+        comp = model.index(1, 0, pkg)
+        self.assertEqual(model.data(comp, QtCore.Qt.DisplayRole), 'c1')
+        self.assertEqual(model.parent(comp), pkg)
+        self.assertTrue(model.setData(comp, QtCore.Qt.Checked, QtCore.Qt.CheckStateRole))
+        self.assertEqual(model.checked, {model.packages[5].subcomponents[1]})
+        self.assertFalse(model.setData(pkg, QtCore.Qt.Checked, QtCore.Qt.CheckStateRole))
+
+    def test_window(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            iemods.IEMod.save_to_json({p.id: p for p in self.packages(30)}, tmp + '/mods.json')
+            window = PyQt5GUI.MainWindow()
+            try:
+                window.load(tmp + '/mods.json')
+                self.wait(lambda: window.model.packages)
+                self.assertEqual(len(window.model.packages), 30)
+
+                window.searchbox.setText('mod 29')
+                window.search()
+                self.wait(lambda: len(window.model.packages) < 30)
+                self.assertEqual([p.id for p in window.model.packages], ['mod29'])
+
+                window.model.checked = {window.manager.getcomp('mod2.1')}
+                with unittest.mock.patch.object(PyQt5GUI, 'install', return_value={}):
+                    window.install()
+                    self.assertFalse(window.installbutton.isEnabled())
+                    self.wait(window.installbutton.isEnabled)
+                self.assertEqual(window.status.text(), 'Installation done')
+                self.assertEqual(list(window.manager.selectedpkg), ['mod2'])
+
+                progress.bus.publish('archive', 'download', 5, 10, done=True)
+                self.wait(lambda: window.progressbar.value() == 500)
+                progress.bus.publish('archive', 'download', 3 * 2 ** 30, 4 * 2 ** 30, done=True)
+                self.wait(lambda: window.progressbar.value() == 750)
+            finally:
+                # closeEvent isn't sent to windows that were never shown
+                window.bridge.close()
+                window.close()
+            self.assertFalse(progress.bus.active)
+
+
+class TestWeidu(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.game = self.tmp.name + '/game'
+        os.makedirs(self.game + '/override')
+        with open(self.game + '/weidu.log', 'w') as f:
+            f.write('// Log of Currently Installed WeiDU Mods\n')
+        with open(self.tmp.name + '/weidu.py', 'w') as f:
+            f.write(STUB_WEIDU)
+        self.weidu = [sys.executable, self.tmp.name + '/weidu.py']
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_command(self):
+        self.assertEqual(weidu.setup_command('mod/setup-mod.tp2', ['0', '10'], 2, weidu='weidu'),
+                         ['weidu', 'mod/setup-mod.tp2', '--language', '2', '--force-install-list', '0', '10',
+                          '--no-exit-pause', '--noautoupdate', '--skip-at-view', '--log', 'setup-mod.debug'])
+        self.assertIn('--force-uninstall-list', weidu.setup_command('setup-mod.tp2', ['0'], uninstall=True))
+
+    def test_run(self):
+        result = weidu.RunSetup(self.game, 'a.tp2', ['0', 'fail', '10'], weidu=self.weidu)
+        self.assertEqual(result.returncode, 1)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.failed, ['Component fail'])
+        self.assertEqual(result.components['Component 10'], 'SUCCESSFULLY INSTALLED')
+        self.assertTrue(os.path.isfile(self.game + '/override/a.tp2_10.txt'))
+        with self.assertRaises(weidu.SetupFailedException):
+            weidu.RunSetupOrRaise(self.game, 'a.tp2', ['fail'], weidu=self.weidu)
+
+    def test_capped_output(self):
+        result = weidu.RunSetup(self.game, 'a.tp2', ['spam', '0'], weidu=self.weidu, maxlog=1000)
+        self.assertTrue(result.ok)
+        self.assertLess(len(result.output), 1100)
+        self.assertIn(b'bytes dropped', result.output)
+        self.assertTrue(result.output.endswith(b'SUCCESSFULLY INSTALLED Component 0\n'))
+        self.assertEqual(set(result.components), {'Component spam', 'Component 0'})
+
+    def test_timeout(self):
+        start = time.monotonic()
+        result = weidu.RunSetup(self.game, 'a.tp2', ['0', 'sleep'], weidu=self.weidu, timeout=1)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.components, {'Component 0': 'SUCCESSFULLY INSTALLED'})
+
+    def test_side_by_side(self):
+        results = weidu.RunSetupsSideBySide(self.game, [{'tp2': 'a.tp2', 'components': ['0'], 'weidu': self.weidu},
+                                                        {'tp2': 'b.tp2', 'components': ['fail'], 'weidu': self.weidu},
+                                                        {'tp2': 'c.tp2', 'components': ['1'], 'weidu': self.weidu}],
+                                            self.tmp.name + '/sandboxes')
+        self.assertEqual([r.ok for r in results], [True, False, True])
+        self.assertEqual(sorted(os.listdir(self.game + '/override')), ['a.tp2_0.txt', 'c.tp2_1.txt'])
+        with open(self.game + '/weidu.log') as f:
+            self.assertEqual(f.read(), '// Log of Currently Installed WeiDU Mods\n~a.tp2~ #0 #0\n~c.tp2~ #0 #1\n')
+        self.assertEqual(os.listdir(self.tmp.name + '/sandboxes'), [])
+
+
+    def test_side_by_side_overlap(self):
+        with open(self.game + '/dialog.tlk', 'w') as f:
+            f.write('base')
+        results = weidu.RunSetupsSideBySide(self.game, [{'tp2': 'a.tp2', 'components': ['tlk'], 'weidu': self.weidu},
+                                                        {'tp2': 'b.tp2', 'components': ['0'], 'weidu': self.weidu},
+                                                        {'tp2': 'c.tp2', 'components': ['tlk'], 'weidu': self.weidu}],
+                                            self.tmp.name + '/sandboxes')
+        self.assertEqual([r.ok for r in results], [True, True, True])
+        # c.tp2 was run again on top of the dialog.tlk of a.tp2 instead of overwriting it
+        with open(self.game + '/dialog.tlk') as f:
+            self.assertEqual(f.read(), 'basea.tp2c.tp2')
+        with open(self.game + '/weidu.log') as f:
+            self.assertEqual(f.read().splitlines()[1:], ['~a.tp2~ #0 #tlk', '~b.tp2~ #0 #0', '~c.tp2~ #0 #tlk'])
+
+    def test_sandbox_deletions(self):
+        with open(self.game + '/override/old.itm', 'w') as f:
+            f.write('old')
+        with weidu.Sandbox(self.game, self.tmp.name + '/sandbox') as sandbox:
+            os.remove(sandbox.path + '/override/old.itm')
+            with open(sandbox.path + '/override/new.itm', 'w') as f:
+                f.write('new')
+            self.assertEqual(sandbox.changes(), ([os.path.join('override', 'new.itm')],
+                                                 [os.path.join('override', 'old.itm')]))
+            sandbox.commit()
+        self.assertEqual(os.listdir(self.game + '/override'), ['new.itm'])
+
+    def test_kill_tree_on_windows(self):
+        proc = unittest.mock.Mock(pid=42)
+        run = unittest.mock.Mock(return_value=subprocess.CompletedProcess([], 0))
+        with unittest.mock.patch.object(weidu, 'platform', 'win32'), \
+                unittest.mock.patch.object(weidu.subprocess, 'run', run):
+            weidu._kill(proc)
+            self.assertEqual(run.call_args[0][0], ['taskkill', '/T', '/F', '/PID', '42'])
+            proc.kill.assert_not_called()
+            run.return_value = subprocess.CompletedProcess([], 128)
+            weidu._kill(proc)
+            proc.kill.assert_called_once_with()
 
 
 class TestActionSort(unittest.TestCase):
@@ -290,6 +895,955 @@ class TestActionSort(unittest.TestCase):
         with self.assertRaises(mngr.IncompatibleActionsException):
             mngr.sortInstallActionList(self.actions)
 
+class TestRegexSeq(unittest.TestCase):
+    def setUp(self):
+        self.templates = [rb'Path = (?P<path>\S+)\n', rb'%(path)s: (?P<size>\d+)\n', rb'missing', rb'Size = %(size)s\n']
+        self.output = b'Path = archive.zip\narchive.zip: 42\nSize = 42\n'
+
+    def test_same_results_as_re(self):
+        expected = [(b'archive.zip',), (b'42',), ()]
+        self.assertEqual(Utils.RegexBytesSeq(self.templates, self.output), expected)
+        self.assertEqual(Utils.RegexSeq(self.templates).search(self.output), expected)
+
+    def test_patterns_compiled_once(self):
+        seq = Utils.RegexSeq(self.templates)
+        self.assertIs(seq.pattern(0, {}), seq.pattern(0, {}))
+        self.assertIs(seq.pattern(1, {b'path': b'a'}), seq.pattern(1, {b'path': b'a'}))
+        self.assertIsNot(seq.pattern(1, {b'path': b'a'}), seq.pattern(1, {b'path': b'b'}))
+
+    def test_bounded_cache(self):
+        seq = Utils.RegexSeq(self.templates, maxcache=2)
+        for i in range(10):
+            seq.pattern(1, {b'path': str(i).encode()})
+        self.assertEqual(len(seq._cache), 2)
+
+    def test_streamed_scan(self):
+        chunks = [self.output[i:i + 5] for i in range(0, len(self.output), 5)]
+        self.assertEqual(Utils.RegexSeq(self.templates).scan(chunks), Utils.RegexBytesSeq(self.templates, self.output))
+
+
+class TestAsyncInstaller(unittest.TestCase):
+    def test_order_and_concurrency(self):
+        running = []
+        peak = []
+        done = []
+
+        async def work(name):
+            running.append(name)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(name)
+            done.append(name)
+
+        actions = [mngr.InstallAction(installmethod=None, args=['a{}'.format(i)], id='a{}'.format(i), prev=[],
+                                      asyncmethod=work) for i in range(6)]
+        last = mngr.InstallAction(installmethod=done.append, args=['last'], id='last', prev=actions)
+        results = asyncio.run(aioinstall.AsyncInstaller(concurrency=2).run([last]))
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(done[-1], 'last')
+        self.assertEqual(set(results), {'last'} | {a.id for a in actions})
+
+    def test_failure_cancels_dependents(self):
+        executed = []
+
+        async def fail():
+            raise RuntimeError
+
+        first = mngr.InstallAction(installmethod=None, args=[], id='first', prev=[], asyncmethod=fail)
+        second = mngr.InstallAction(installmethod=executed.append, args=['second'], id='second', prev=[first])
+        with self.assertRaises(RuntimeError):
+            asyncio.run(aioinstall.AsyncInstaller().run([second]))
+        self.assertEqual(executed, [])
+
+    def test_async_download(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(tmp + '/served')
+            data = os.urandom(200000)
+            with open(tmp + '/served/file.bin', 'wb') as f:
+                f.write(data)
+            with LocalServer(tmp + '/served') as server:
+                code, n = asyncio.run(aiodownload.AsyncDownloadFile(server.url + '/file.bin', tmp + '/out.bin'))
+                missing = asyncio.run(aiodownload.AsyncDownloadFile(server.url + '/none.bin', tmp + '/none.bin'))
+            self.assertEqual((code, n), (200, len(data)))
+            self.assertEqual(missing, (404, 0))
+            with open(tmp + '/out.bin', 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_async_download_errors(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with LocalServer(tmp, StallingHandler) as server:
+                start = time.monotonic()
+                res = asyncio.run(aiodownload.AsyncDownloadFile(server.url + '/file.bin', tmp + '/out.bin',
+                                                                retries=0, timeout=0.2))
+                self.assertLess(time.monotonic() - start, StallingHandler.stall)
+            self.assertEqual(res, (-1, 0))
+            self.assertFalse(os.path.exists(tmp + '/out.bin.part'))
+            with LocalServer(tmp, GarbageHandler) as server:
+                res = asyncio.run(aiodownload.AsyncDownloadFile(server.url + '/file.bin', tmp + '/out.bin'))
+            self.assertEqual(res, (-1, 0))
+
+
+class TestCleanupdir(unittest.TestCase):
+    def make_tree(self, root):
+        for d in ('a/b/c', 'd', 'e/f'):
+            os.makedirs(root + '/' + d)
+            for i in range(5):
+                with open('{}/{}/file{}'.format(root, d, i), 'w') as f:
+                    f.write('x')
+        open(root + '/top', 'w').close()
+
+    def test_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.make_tree(tmp)
+            report = Utils.cleanupdir(tmp)
+            self.assertTrue(report)
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_background(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(tmp + '/staging')
+            self.make_tree(tmp + '/staging')
+            report = Utils.cleanupdir(tmp + '/staging', background=True)
+            self.assertEqual(os.listdir(tmp + '/staging'), [])
+            self.assertTrue(report.wait())
+            self.assertEqual(os.listdir(tmp), ['staging'])
+
+    def test_failure_reported(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.make_tree(tmp)
+            with unittest.mock.patch('os.remove', side_effect=PermissionError):
+                report = Utils.cleanupdir(tmp, retries=2, backoff=0.001)
+            self.assertFalse(report)
+            self.assertIn(tmp + '/top', report.failed)
+            self.assertTrue(os.path.exists(tmp + '/top'))
+
+
+    def test_remove_staging(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.make_tree(tmp + '/mod_1.0')
+            self.assertTrue(Utils.RemoveStaging(tmp + '/mod_1.0'))
+            self.assertEqual(os.listdir(tmp), [])
+            self.assertIsNone(Utils.RemoveStaging(tmp + '/mod_1.0'))
+
+
+class TestWalkdir(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        for f in ('a.txt', 'b.tp2', 'sub/c.txt', 'sub/deep/d.txt', 'skip/e.txt'):
+            os.makedirs(os.path.dirname(self.root + '/' + f), exist_ok=True)
+            with open(self.root + '/' + f, 'w') as fh:
+                fh.write(f)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_all_entries(self):
+        self.assertEqual({e.relpath for e in Utils.walkdir(self.root)},
+                         {'a.txt', 'b.tp2', 'sub', 'sub/c.txt', 'sub/deep', 'sub/deep/d.txt', 'skip', 'skip/e.txt'})
+
+    def test_filters(self):
+        entries = list(Utils.walkdir(self.root, include='*.txt', exclude='skip', dirs=False))
+        self.assertEqual({e.relpath for e in entries}, {'a.txt', 'sub/c.txt', 'sub/deep/d.txt'})
+        self.assertEqual({e.relpath: e.stat().st_size for e in entries}['sub/c.txt'], len('sub/c.txt'))
+
+    def test_maxdepth(self):
+        self.assertEqual({e.relpath for e in Utils.walkdir(self.root, maxdepth=2, dirs=False)},
+                         {'a.txt', 'b.tp2', 'sub/c.txt', 'skip/e.txt'})
+
+    def test_listsubdir(self):
+        root = self.root.replace('\\', '/')
+        self.assertEqual(set(Utils.listsubdir(self.root + '/')),
+                         {root + '/' + p for p in ('a.txt', 'b.tp2', 'sub', 'sub/c.txt', 'sub/deep',
+                                                   'sub/deep/d.txt', 'skip', 'skip/e.txt')} | {root})
+
+
+class TestPlanning(unittest.TestCase):
+    def setUp(self):
+        self.m = mngr.Manager()
+        for i, size in enumerate([100, 300, 200, None]):
+            c = mngr.SubComponent(componentid='c', name='c', number=0)
+            mod = iemods.IEMod(packageid='mod{}'.format(i), name='mod', depends=mngr.Dependencies(), components=[c],
+                               versionno='1.0', downloadurl='http://127.0.0.1/mod.zip', size=size)
+            self.m.add_pkg(mod)
+            self.m.select_pkg(mod, [c])
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def plan(self, free, **kwargs):
+        usage = unittest.mock.Mock(free=free)
+        with unittest.mock.patch('shutil.disk_usage', return_value=usage):
+            return planning.plan_install(self.m, self.tmp.name + '/cache', self.tmp.name + '/staging', self.tmp.name,
+                                         expansion=2, reserve=0, **kwargs)
+
+    def test_estimates(self):
+        os.makedirs(self.tmp.name + '/cache')
+        with open(self.tmp.name + '/cache/mod0_1.0.zip', 'wb'):
+            pass
+        plan = self.plan(10 ** 6)
+        self.assertEqual(plan.unknown, ['mod3'])
+        self.assertEqual(plan.cached, ['mod0'])
+        self.assertEqual(plan.download_bytes, 500)
+        self.assertEqual(plan.extracted_bytes, 1200)
+        self.assertEqual(len(plan.volumes), 1)
+        self.assertEqual(list(plan.volumes.values())[0].required, 1700)
+        self.assertTrue(plan.ok)
+
+    def test_shortfall(self):
+        plan = self.plan(1000)
+        self.assertFalse(plan.ok)
+        with self.assertRaises(planning.InsufficientDiskSpaceException):
+            plan.check()
+
+    def test_download_concurrency(self):
+        # Merged files take 1200 bytes, the rest is left for the archives in flight
+        plan = self.plan(1200 + 500, keep_archives=False, maxdownloads=4, maxextractions=1)
+        self.assertEqual(plan.download_concurrency, 1)
+        self.assertTrue(plan.ok)
+        plan = self.plan(1200 + 600, keep_archives=False, maxdownloads=4, maxextractions=1)
+        self.assertEqual(plan.download_concurrency, 4)
+
+
+class TestMultiProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(self.tmp.name + '/served')
+        for mod in ('mod0', 'mod1'):
+            with zipfile.ZipFile('{}/served/{}.zip'.format(self.tmp.name, mod), 'w') as z:
+                z.writestr(mod + '/setup.tp2', mod)
+                z.writestr('override/shared.txt', mod)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def profile(self, name, url, mods):
+        m = mngr.Manager()
+        for mod in mods:
+            c = mngr.SubComponent(componentid='c', name='c', number=0)
+            pkg = iemods.IEMod(packageid=mod, name=mod, depends=mngr.Dependencies(), components=[c],
+                               versionno='1.0', downloadurl='{}/{}.zip'.format(url, mod))
+            m.add_pkg(pkg)
+            m.select_pkg(pkg, [c])
+        os.makedirs(self.tmp.name + '/' + name)
+        return multiprofile.Profile(name, m, self.tmp.name + '/' + name)
+
+    @staticmethod
+    def extract(filepath, targetdir):
+        with zipfile.ZipFile(filepath) as z:
+            z.extractall(targetdir)
+        return 1
+
+    def test_shared_pipeline(self):
+        with LocalServer(self.tmp.name + '/served') as server:
+            profiles = [self.profile('bg1', server.url, ['mod0', 'mod1']), self.profile('bg2', server.url, ['mod0'])]
+            install = multiprofile.MultiProfileInstall(profiles, self.tmp.name, self.tmp.name + '/staging',
+                                                       extract=self.extract)
+            actions = install.generate_action_list()
+            self.assertEqual(sorted(a.id for a in actions if a.stage not in ('merge', 'install-script')),
+                             ['Clean up mod0', 'Clean up mod1', 'Download mod0', 'Download mod1', 'Extract mod0',
+                              'Extract mod1', 'Verify mod0', 'Verify mod1'])
+            cleanup = next(a for a in actions if a.id == 'Clean up mod0')
+            self.assertEqual([a.id for a in cleanup.prev], ['Merge mod0 into bg2'])
+            with open(self.tmp.name + '/weidu.py', 'w') as f:
+                f.write(STUB_WEIDU)
+            with unittest.mock.patch.object(weidu, 'WEIDU', [sys.executable, self.tmp.name + '/weidu.py']):
+                asyncio.run(aioinstall.AsyncInstaller().install(install))
+        for name, shared in (('bg1', 'mod1'), ('bg2', 'mod0')):
+            with open('{}/{}/override/shared.txt'.format(self.tmp.name, name)) as f:
+                self.assertEqual(f.read(), shared)
+            self.assertTrue(os.path.isfile('{}/{}/mod0/setup.tp2'.format(self.tmp.name, name)))
+        self.assertFalse(os.path.exists(self.tmp.name + '/bg2/mod1'))
+        with open(self.tmp.name + '/bg1/weidu.log') as f:
+            self.assertEqual(f.read(), '~setup-mod0.tp2~ #0 #0\n~setup-mod1.tp2~ #0 #0\n')
+        # The staging directories are removed once their last profile moved the files out
+        self.assertEqual(os.listdir(self.tmp.name + '/staging'), [])
+
+    def test_install_order(self):
+        with LocalServer(self.tmp.name + '/served') as server:
+            profile = self.profile('bg1', server.url, ['mod0', 'mod1'])
+            # mod0 is selected first but goes after mod1
+            profile.manager.availablepkg['mod0'].depends.after.add('mod1')
+            install = multiprofile.MultiProfileInstall([profile], self.tmp.name, self.tmp.name + '/staging',
+                                                       extract=self.extract)
+            actions = install.generate_action_list()
+            merge = next(a for a in actions if a.id == 'Merge mod0 into bg1')
+            self.assertIn('Install mod1 into bg1', [a.id for a in merge.prev])
+            with open(self.tmp.name + '/weidu.py', 'w') as f:
+                f.write(STUB_WEIDU)
+            with unittest.mock.patch.object(weidu, 'WEIDU', [sys.executable, self.tmp.name + '/weidu.py']):
+                asyncio.run(aioinstall.AsyncInstaller().install(install))
+        with open(self.tmp.name + '/bg1/weidu.log') as f:
+            self.assertEqual(f.read(), '~setup-mod1.tp2~ #0 #0\n~setup-mod0.tp2~ #0 #0\n')
+        with open(self.tmp.name + '/bg1/override/shared.txt') as f:
+            self.assertEqual(f.read(), 'mod0')
+
+    def test_extraction_failure(self):
+        with self.assertRaises(extraction.ExtractionFailedException):
+            extraction.ExtractOrRaise('missing.zip', self.tmp.name + '/out', lambda f, t: 0)
+
+
+class TestConflicts(unittest.TestCase):
+    LISTING = (b'Listing archive: mod.7z\n\n--\nPath = mod.7z\nType = 7z\n\n----------\n'
+               b'Path = mod\nFolder = +\n\nPath = mod\\setup.tp2\nFolder = -\nSize = 3\n\n'
+               b'Path = Override\\SPWI101.SPL\nFolder = -\n')
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.m = mngr.Manager()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add(self, pkgid, files, depends=None):
+        with zipfile.ZipFile('{}/{}_1.0.zip'.format(self.tmp.name, pkgid), 'w') as z:
+            for name in files:
+                z.writestr(name, pkgid)
+        c = mngr.SubComponent(componentid='c', name='c', number=0)
+        pkg = iemods.IEMod(packageid=pkgid, name=pkgid, depends=depends or mngr.Dependencies(), components=[c],
+                           versionno='1.0', downloadurl='http://localhost/{}.zip'.format(pkgid))
+        self.m.add_pkg(pkg)
+        self.m.select_pkg(pkg, [c])
+
+    def test_parse_7z_listing(self):
+        self.assertEqual(conflicts.parse_7z_listing(self.LISTING), ['mod\\setup.tp2', 'Override\\SPWI101.SPL'])
+        self.assertEqual(conflicts.normalize('.\\Override\\SPWI101.SPL'), 'override/spwi101.spl')
+
+    def test_analyse(self):
+        self.add('mod0', ['mod0/setup.tp2', 'override/spwi101.spl', 'override/a.itm'])
+        self.add('mod1', ['mod1/setup.tp2', 'Override/SPWI101.SPL', 'override/A.ITM'])
+        self.add('mod2', ['mod2/setup.tp2', 'override/a.itm'], mngr.Dependencies(after=['mod1']))
+        self.add('mod3', ['mod3/setup.tp2'])
+        os.remove(self.tmp.name + '/mod3_1.0.zip')
+        report = conflicts.analyse(self.m, self.tmp.name)
+        self.assertEqual(report.order, ['mod0', 'mod1', 'mod2', 'mod3'])
+        self.assertEqual(report.missing, ['mod3'])
+        self.assertEqual(report.conflicts, {'override/spwi101.spl': ['mod0', 'mod1'],
+                                            'override/a.itm': ['mod0', 'mod1', 'mod2']})
+        self.assertEqual(report.pairs()[('mod1', 'mod2')], ['override/a.itm'])
+        self.assertEqual(sorted(report.pairs()[('mod0', 'mod1')]), ['override/a.itm', 'override/spwi101.spl'])
+        self.assertEqual(sorted(report.unconstrained), [('mod0', 'mod1'), ('mod0', 'mod2')])
+        summary = report.summary()
+        self.assertIn('mod1 overwrites 2 files of mod0 (no before/after constraint)', summary)
+        self.assertIn('mod2 overwrites 1 files of mod1: override/a.itm', summary)
+        self.assertIn('Archives not found for mod3', summary)
+
+
+    def test_unreadable_archives(self):
+        for pkgid in ('mod0', 'mod1', 'mod2'):
+            self.add(pkgid, ['{}/setup.tp2'.format(pkgid), 'override/a.itm'])
+        # Not zip files, listed with 7z which fails or isn't installed
+        for pkgid in ('mod0', 'mod2'):
+            with open('{}/{}_1.0.zip'.format(self.tmp.name, pkgid), 'wb') as f:
+                f.write(b'7z' * 100)
+
+        def check_output(command, **kwargs):
+            if command[-1].endswith('mod0_1.0.zip'):
+                raise subprocess.CalledProcessError(2, command)
+            raise FileNotFoundError(command[0])
+
+        with unittest.mock.patch.object(conflicts.subprocess, 'check_output', check_output):
+            report = conflicts.analyse(self.m, self.tmp.name)
+        self.assertEqual(report.unreadable, ['mod0', 'mod2'])
+        self.assertEqual(report.index['override/a.itm'], ['mod1'])
+        self.assertIn('Archives that could not be listed for mod0, mod2', report.summary())
+
+
+class TestMapped(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.zip = self.tmp.name + '/mod.zip'
+        self.files = {'mod/setup.tp2': b'BACKUP ~mod/backup~', 'override/big.bin': os.urandom(200000),
+                      'override/text.txt': b'text ' * 10000, 'Überlist.txt': b''}
+        with zipfile.ZipFile(self.zip, 'w') as z:
+            z.writestr('empty/', b'')
+            for i, (name, data) in enumerate(self.files.items()):
+                z.writestr(name, data, zipfile.ZIP_DEFLATED if i % 2 else zipfile.ZIP_STORED)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_zip_members(self):
+        with mapped.mappings.open(self.zip) as m:
+            members = mapped.zip_members(m)
+        with zipfile.ZipFile(self.zip) as z:
+            expected = [(i.filename, i.file_size, i.compress_size, i.CRC) for i in z.infolist()]
+        self.assertEqual([(mb.name, mb.size, mb.compressed_size, mb.crc) for mb in members], expected)
+        self.assertEqual([mb.name for mb in members if mb.is_dir], ['empty/'])
+
+        # Self-extracting archives have a stub before the zip data
+        with open(self.zip, 'rb') as f:
+            data = f.read()
+        with open(self.tmp.name + '/mod.exe', 'wb') as f:
+            f.write(b'MZ' + b'\0' * 1000 + data)
+        self.assertEqual(mapped.Extract_Zip(self.tmp.name + '/mod.exe', self.tmp.name + '/sfx'), 1)
+        with open(self.tmp.name + '/sfx/override/big.bin', 'rb') as f:
+            self.assertEqual(f.read(), self.files['override/big.bin'])
+
+        with open(self.tmp.name + '/not.zip', 'wb') as f:
+            f.write(b'7z' * 100)
+        with mapped.mappings.open(self.tmp.name + '/not.zip') as m:
+            self.assertRaises(mapped.ZipFormatException, mapped.zip_members, m)
+        self.assertEqual(len(mapped.mappings), 0)
+
+    def test_extract(self):
+        self.assertEqual(mapped.Extract_Zip(self.zip, self.tmp.name + '/out'), 1)
+        for name, data in self.files.items():
+            with open(os.path.join(self.tmp.name, 'out', name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertTrue(os.path.isdir(self.tmp.name + '/out/empty'))
+
+        # Corrupts the data of the last member
+        with open(self.zip, 'r+b') as f:
+            data = f.read()
+            pos = data.index(b'text text')
+            f.seek(pos)
+            f.write(b'TEXT')
+        self.assertEqual(mapped.Extract_Zip(self.zip, self.tmp.name + '/bad'), 0)
+
+        with zipfile.ZipFile(self.tmp.name + '/slip.zip', 'w') as z:
+            z.writestr('../outside.txt', b'x')
+        self.assertEqual(mapped.Extract_Zip(self.tmp.name + '/slip.zip', self.tmp.name + '/slip'), 0)
+        self.assertFalse(os.path.exists(self.tmp.name + '/outside.txt'))
+        self.assertEqual(len(mapped.mappings), 0)
+
+    def test_fallback(self):
+        with zipfile.ZipFile(self.tmp.name + '/bz2.zip', 'w') as z:
+            z.writestr('stored.txt', b'stored')
+            z.writestr('bz2.txt', b'bz2', zipfile.ZIP_BZIP2)
+        fallback = unittest.mock.Mock(return_value=1)
+        self.assertEqual(mapped.Extract_Zip(self.tmp.name + '/bz2.zip', self.tmp.name + '/out', fallback=fallback), 1)
+        fallback.assert_called_once_with(self.tmp.name + '/bz2.zip', self.tmp.name + '/out')
+        self.assertFalse(os.path.exists(self.tmp.name + '/out'))
+        self.assertEqual(mapped.Extract_Zip(self.tmp.name + '/bz2.zip', self.tmp.name + '/out'), 0)
+
+        # Zip files are extracted without 7z by default
+        self.assertEqual(extraction.ExtractOrRaise(self.zip, self.tmp.name + '/default'), 1)
+        with open(self.tmp.name + '/default/override/big.bin', 'rb') as f:
+            self.assertEqual(f.read(), self.files['override/big.bin'])
+
+    def test_lease(self):
+        size = os.path.getsize(self.zip)
+        digest = 'sha256:' + hashlib.sha256(open(self.zip, 'rb').read()).hexdigest()
+        with unittest.mock.patch.object(mapped, 'MappedFile', wraps=mapped.MappedFile) as mapping:
+            lease = mapped.MappingLease(self.zip)
+            download.VerifyOrRaise(self.zip, size, digest, lease=lease)
+            self.assertTrue(lease.held)
+            self.assertEqual(len(conflicts.list_archive(self.zip)), 4)
+            extraction.ExtractOrRaise(self.zip, self.tmp.name + '/out', lease=lease)
+            self.assertEqual(mapping.call_count, 1)
+        self.assertFalse(lease.held)
+        self.assertEqual(len(mapped.mappings), 0)
+
+        # Failed verifications release the lease, dropped leases release their mapping
+        with self.assertRaises(download.IntegrityException):
+            download.VerifyOrRaise(self.zip, size + 1, None, lease=lease)
+        self.assertFalse(lease.held)
+        lease.hold()
+        del lease
+        self.assertEqual(len(mapped.mappings), 0)
+
+    def test_shared_mapping(self):
+        m1 = mapped.mappings.acquire(self.zip)
+        m2 = mapped.mappings.acquire(self.zip)
+        self.assertIs(m1, m2)
+        self.assertEqual(len(m1), os.path.getsize(self.zip))
+        digest = hashlib.sha256(open(self.zip, 'rb').read()).hexdigest()
+        self.assertTrue(download.VerifyFile(self.zip, os.path.getsize(self.zip), digest, chunksize=1000))
+        self.assertEqual(conflicts.list_archive(self.zip), ['mod/setup.tp2', 'override/big.bin',
+                                                            'override/text.txt', 'überlist.txt'])
+        mapped.mappings.release(m1)
+        self.assertEqual(len(mapped.mappings), 1)
+        mapped.mappings.release(m2)
+        self.assertEqual(len(mapped.mappings), 0)
+        self.assertRaises(ValueError, len, m1.view)
+
+        # A file replaced on disk gets a new mapping
+        with mapped.mappings.open(self.zip) as m:
+            with open(self.zip, 'ab') as f:
+                f.write(b'more')
+            with mapped.mappings.open(self.zip) as other:
+                self.assertIsNot(m, other)
+                self.assertEqual(len(other), len(m) + 4)
+
+        open(self.tmp.name + '/empty', 'wb').close()
+        self.assertTrue(download.VerifyFile(self.tmp.name + '/empty', 0, hashlib.sha256().hexdigest()))
+
+
+class TestInstallStages(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(self.tmp.name + '/served')
+        os.makedirs(self.tmp.name + '/game/override')
+        with zipfile.ZipFile(self.tmp.name + '/served/mod.zip', 'w') as z:
+            z.writestr('mod/setup.tp2', 'mod')
+            z.writestr('override/file.itm', 'itm')
+        with open(self.tmp.name + '/served/mod.zip', 'rb') as f:
+            data = f.read()
+        self.m = mngr.Manager()
+        c = mngr.SubComponent(componentid='0', name='c')
+        self.mod = iemods.IEMod(packageid='mod', name='mod', depends=mngr.Dependencies(), components=[c],
+                                versionno='1.0', downloadurl='http://127.0.0.1/mod.zip', size=len(data),
+                                checksum='sha256:' + hashlib.sha256(data).hexdigest())
+        self.m.add_pkg(self.mod)
+        self.m.select_pkg(self.mod, [c])
+        self.dirs = {'cachedir': self.tmp.name, 'stagingdir': self.tmp.name + '/staging',
+                     'gamedir': self.tmp.name + '/game'}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_stages(self):
+        actions = self.m.generate_action_list(**self.dirs)
+        self.assertEqual([(a.stage, a.resource) for a in actions],
+                         [('download', mngr.NETWORK), ('verify', mngr.CPU), ('extract', mngr.CPU),
+                          ('merge', mngr.DISK), ('install-script', mngr.CPU), ('cleanup', mngr.DISK)])
+        self.assertEqual(actions[4].args, [self.tmp.name + '/game', 'setup-mod.tp2', [0], 0])
+        self.assertEqual([a.prev for a in actions[1:5]], [[a] for a in actions[:4]])
+        # The staging directory is removed after the merge, while the setup runs
+        self.assertEqual(actions[5].prev, [actions[3]])
+        self.assertEqual(actions[5].args, [self.tmp.name + '/staging/mod_1.0'])
+        self.assertEqual(mngr.sortInstallActionList(actions[4:5]), actions[:5])
+        # Verify and extract share the mapping of the archive
+        self.assertIs(actions[2].method.keywords['lease'], actions[1].lease)
+
+    def test_catalog_setup_args(self):
+        mods = iemods.load_catalog('Config/mods.json')
+        mod = mods['A7-GolemConstruction']
+        self.assertEqual(mod.get_tp2(), 'setup-A7-GolemConstruction.tp2')
+        self.assertEqual(mod.languages, {'EN': 0, 'FR': 1, 'GE': 2, 'PO': 3})
+        self.assertEqual([c.number for c in mod.subcomponents], [0, 10, 15, 20, 25, 30, 35, 40, 45, 50])
+        comps = [mod.get_comp('GolemConstr'), mod.get_comp('IdentifyAll')]
+        script = mod.generate_script_action(comps, self.dirs['gamedir'], language='FR')
+        self.assertEqual(script.args, [self.dirs['gamedir'], 'setup-A7-GolemConstruction.tp2', [0, 45], 1])
+        # Numbers survive the catalog round trip, ids which aren't numbers are refused
+        comp = mngr.SubComponent.from_dict(comps[1].to_dict())
+        self.assertEqual(comp.number, 45)
+        self.assertRaises(iemods.UnknownComponentNumberException, mod.generate_script_action,
+                          [mngr.SubComponent(componentid='Unnumbered', name='x')])
+
+    def test_install(self):
+        with open(self.tmp.name + '/weidu.py', 'w') as f:
+            f.write(STUB_WEIDU)
+        with LocalServer(self.tmp.name + '/served') as server:
+            self.mod.downloadurl = server.url + '/mod.zip'
+            with unittest.mock.patch.object(extraction, 'ExtractOrRaise',
+                                            partial(extraction.ExtractOrRaise, extract=TestMultiProfile.extract)), \
+                    unittest.mock.patch.object(weidu, 'WEIDU', [sys.executable, self.tmp.name + '/weidu.py']):
+                installer = aioinstall.AsyncInstaller(limits={mngr.NETWORK: 1, mngr.CPU: 1, mngr.DISK: 1})
+                asyncio.run(installer.install(self.m, **self.dirs))
+        with open(self.tmp.name + '/game/override/file.itm') as f:
+            self.assertEqual(f.read(), 'itm')
+        self.assertTrue(os.path.isfile(self.tmp.name + '/game/mod/setup.tp2'))
+        with open(self.tmp.name + '/game/weidu.log') as f:
+            self.assertEqual(f.read(), '~setup-mod.tp2~ #0 #0\n')
+        self.assertEqual(len(mapped.mappings), 0)
+
+    def test_apply_recorded_state(self):
+        with open(self.tmp.name + '/weidu.py', 'w') as f:
+            f.write(STUB_WEIDU)
+        comps = [mngr.SubComponent(componentid='0', name='c0'), mngr.SubComponent(componentid='1', name='c1')]
+        mod = iemods.IEMod(packageid='mod', name='mod', depends=mngr.Dependencies(), components=comps,
+                           versionno='1.0', downloadurl='http://127.0.0.1/mod.zip')
+        self.m = mngr.Manager()
+        self.m.add_pkg(mod)
+        self.m.select_pkg(mod, comps[:1])
+        with LocalServer(self.tmp.name + '/served') as server:
+            mod.downloadurl = server.url + '/mod.zip'
+            with unittest.mock.patch.object(extraction, 'ExtractOrRaise',
+                                            partial(extraction.ExtractOrRaise, extract=TestMultiProfile.extract)), \
+                    unittest.mock.patch.object(weidu, 'WEIDU', [sys.executable, self.tmp.name + '/weidu.py']):
+                installer = aioinstall.AsyncInstaller()
+                asyncio.run(installer.apply(self.m, **self.dirs))
+                self.assertEqual(mngr.InstalledState.load_from_game(self.dirs['gamedir']).components, ['mod.0'])
+                # Nothing changed, nothing is run again
+                self.assertEqual(asyncio.run(installer.apply(self.m, **self.dirs)), {})
+                # Only the new component is installed
+                self.m.select_pkg(mod, comps[1:])
+                asyncio.run(installer.apply(self.m, **self.dirs))
+        self.assertEqual(mngr.InstalledState.load_from_game(self.dirs['gamedir']).components, ['mod.0', 'mod.1'])
+        with open(self.tmp.name + '/game/weidu.log') as f:
+            self.assertEqual(f.read(), '~setup-mod.tp2~ #0 #0\n~setup-mod.tp2~ #0 #1\n')
+
+    def test_packages_in_install_order(self):
+        with zipfile.ZipFile(self.tmp.name + '/served/mod2.zip', 'w') as z:
+            z.writestr('mod2/setup.tp2', 'mod2')
+        c = mngr.SubComponent(componentid='0', name='c')
+        mod2 = iemods.IEMod(packageid='mod2', name='mod2', depends=mngr.Dependencies(), components=[c],
+                            versionno='1.0', downloadurl='http://127.0.0.1/mod2.zip')
+        self.m.add_pkg(mod2)
+        self.m.select_pkg(mod2, [c])
+        # mod is selected first but goes after mod2
+        self.mod.depends.after.add('mod2')
+        events = []
+
+        def setup(gamedir, tp2, components, language, uninstall=False):
+            events.append(('start', tp2))
+            time.sleep(0.05)
+            events.append(('end', tp2))
+
+        with LocalServer(self.tmp.name + '/served') as server:
+            self.mod.downloadurl = server.url + '/mod.zip'
+            mod2.downloadurl = server.url + '/mod2.zip'
+            with unittest.mock.patch.object(extraction, 'ExtractOrRaise',
+                                            partial(extraction.ExtractOrRaise, extract=TestMultiProfile.extract)), \
+                    unittest.mock.patch.object(weidu, 'RunSetupOrRaise', setup):
+                installer = aioinstall.AsyncInstaller(concurrency=4, limits={mngr.CPU: 4, mngr.DISK: 4})
+                asyncio.run(installer.install(self.m, **self.dirs))
+        self.assertEqual(events, [('start', 'setup-mod2.tp2'), ('end', 'setup-mod2.tp2'),
+                                  ('start', 'setup-mod.tp2'), ('end', 'setup-mod.tp2')])
+
+    def test_split_package(self):
+        # mod2 goes between the components of mod, the archive of mod is only fetched and merged once
+        m = mngr.Manager()
+        comps = [mngr.SubComponent(componentid='0', name='c0'),
+                 mngr.SubComponent(componentid='1', name='c1', depends=mngr.Dependencies(after=['mod2']))]
+        mod = iemods.IEMod(packageid='mod', name='mod', depends=mngr.Dependencies(), components=comps,
+                           versionno='1.0', downloadurl='http://127.0.0.1/mod.zip')
+        mod2 = iemods.IEMod(packageid='mod2', name='mod2', depends=mngr.Dependencies(after=['mod.0']),
+                            components=[mngr.SubComponent(componentid='0', name='c')], versionno='1.0',
+                            downloadurl='http://127.0.0.1/mod2.zip')
+        for pkg in (mod, mod2):
+            m.add_pkg(pkg)
+            m.select_pkg(pkg, pkg.subcomponents)
+        self.assertEqual(m.install_order(), ['mod.0', 'mod2.0', 'mod.1'])
+        actions = m.generate_action_list(**self.dirs)
+        self.assertEqual([a.id for a in actions],
+                         ['Download mod', 'Verify mod', 'Extract mod', 'Merge mod', 'Install mod', 'Clean up mod',
+                          'Download mod2', 'Verify mod2', 'Extract mod2', 'Merge mod2', 'Install mod2',
+                          'Clean up mod2', 'Install mod'])
+        scripts = [a for a in actions if a.stage == 'install-script']
+        self.assertEqual([a.args[2] for a in scripts], [[0], [0], [1]])
+        self.assertIn(scripts[0], actions[9].prev)
+        self.assertEqual(scripts[2].prev, [scripts[1]])
+
+    def test_corrupted_archive(self):
+        self.mod.size += 1
+        with LocalServer(self.tmp.name + '/served') as server:
+            self.mod.downloadurl = server.url + '/mod.zip'
+            with self.assertRaises(download.DownloadFailedException):
+                asyncio.run(aioinstall.AsyncInstaller().install(self.m, **self.dirs))
+            self.mod.downloadurl = server.url + '/none.zip'
+            with self.assertRaises(download.DownloadFailedException):
+                asyncio.run(aioinstall.AsyncInstaller().install(self.m, **self.dirs))
+        self.assertEqual(os.listdir(self.tmp.name + '/game'), ['override'])
+
+    def test_catalog_size_estimate(self):
+        # The archive of a moving target changed upstream, the catalog size without checksum is only an estimate
+        self.mod.size += 1000
+        self.mod.checksum = None
+        with LocalServer(self.tmp.name + '/served') as server:
+            self.mod.downloadurl = server.url + '/mod.zip'
+            with unittest.mock.patch.object(extraction, 'ExtractOrRaise',
+                                            partial(extraction.ExtractOrRaise, extract=TestMultiProfile.extract)), \
+                    unittest.mock.patch.object(weidu, 'RunSetupOrRaise'):
+                asyncio.run(aioinstall.AsyncInstaller().install(self.m, **self.dirs))
+        self.assertTrue(os.path.isfile(self.tmp.name + '/game/override/file.itm'))
+        self.assertIsNone(self.mod.get_verified_size())
+
+    def test_aborted_install_releases_lease(self):
+        def fail():
+            raise RuntimeError('failed')
+
+        actions = self.m.generate_action_list(**self.dirs)
+        verify, extract = actions[1:3]
+        # A sibling of the extraction fails once the archive is verified, the extraction never runs
+        failing = mngr.InstallAction(installmethod=fail, args=[], id='Fail', prev=[verify])
+        extract.prev.append(failing)
+        with LocalServer(self.tmp.name + '/served') as server:
+            actions[0].args[0] = [server.url + '/mod.zip']
+            with self.assertRaises(RuntimeError):
+                asyncio.run(aioinstall.AsyncInstaller().run(actions))
+        self.assertFalse(verify.lease.held)
+        self.assertTrue(extract.lease.closed)
+        self.assertEqual(len(mapped.mappings), 0)
+        self.assertRaises(ValueError, extract.lease.hold)
+
+    def test_verify_cached_archives_only(self):
+        archive = os.path.join(self.tmp.name, self.mod.get_archive_name())
+        actions = self.m.generate_action_list(**self.dirs)
+        with LocalServer(self.tmp.name + '/served') as server:
+            self.mod.downloadurl = server.url + '/mod.zip'
+            actions[0].args[0] = self.mod.get_urls()
+            asyncio.run(aioinstall.AsyncInstaller().run(actions[:1]))
+        # Checked while downloaded
+        with unittest.mock.patch.object(download, 'VerifyFile') as verify:
+            actions[1].execute()
+        verify.assert_not_called()
+        # Changed in the cache since
+        with open(archive, 'r+b') as f:
+            f.write(b'XX')
+        with self.assertRaises(download.IntegrityException):
+            actions[1].execute()
+
+    def test_resource_limits(self):
+        running = collections.Counter()
+        peak = collections.Counter()
+        overlap = []
+
+        async def work(resource):
+            running[resource] += 1
+            peak[resource] = max(peak[resource], running[resource])
+            overlap.append(sum(1 for n in running.values() if n))
+            await asyncio.sleep(0.01)
+            running[resource] -= 1
+
+        actions = [cls(installmethod=None, args=[cls.resource], id='{}{}'.format(cls.stage, i), prev=[],
+                       asyncmethod=work)
+                   for cls in (mngr.DownloadAction, mngr.ExtractAction, mngr.MergeAction) for i in range(4)]
+        installer = aioinstall.AsyncInstaller(concurrency=1, limits={mngr.NETWORK: 2, mngr.CPU: 1, mngr.DISK: 3})
+        asyncio.run(installer.run(actions))
+        self.assertEqual(peak, {mngr.NETWORK: 2, mngr.CPU: 1, mngr.DISK: 3})
+        self.assertEqual(max(overlap), 3)
+
+
+class TestDownloadIntegrity(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(self.tmp.name + '/served')
+        self.data = os.urandom(50000)
+        with open(self.tmp.name + '/served/file.bin', 'wb') as f:
+            f.write(self.data)
+        self.sha = 'sha256:' + hashlib.sha256(self.data).hexdigest()
+        self.out = self.tmp.name + '/out.bin'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_valid(self):
+        with LocalServer(self.tmp.name + '/served') as server:
+            res = download.DownloadFile(server.url + '/file.bin', self.out, lambda n: None, len(self.data), self.sha)
+            self.assertEqual(res, (200, len(self.data)))
+            res = asyncio.run(aiodownload.AsyncDownloadFile(server.url + '/file.bin', self.out, None, len(self.data),
+                                                            self.sha))
+            self.assertEqual(res, (200, len(self.data)))
+        self.assertTrue(download.VerifyFile(self.out, len(self.data), self.sha))
+
+    def test_hash_mismatch(self):
+        with LocalServer(self.tmp.name + '/served') as server:
+            res = download.DownloadFile(server.url + '/file.bin', self.out, lambda n: None,
+                                        expected_hash='sha256:' + '0' * 64, retries=1)
+        self.assertEqual(res, (download.INTEGRITY_ERROR, len(self.data)))
+        self.assertFalse(os.path.exists(self.out))
+        self.assertFalse(os.path.exists(self.out + '.part'))
+
+    def test_unknown_algorithm(self):
+        with LocalServer(self.tmp.name + '/served', FailingHandler) as server:
+            FailingHandler.requests = 0
+            res = download.DownloadFile(server.url + '/file.bin', self.out, lambda n: None,
+                                        expected_hash='nohash:' + '0' * 64)
+            self.assertEqual(res, (download.INTEGRITY_ERROR, 0))
+            res = asyncio.run(aiodownload.AsyncDownloadFile(server.url + '/file.bin', self.out,
+                                                            expected_hash='nohash:' + '0' * 64))
+            self.assertEqual(res, (download.INTEGRITY_ERROR, 0))
+        self.assertEqual(FailingHandler.requests, 0)
+        self.assertFalse(download.VerifyFile(self.tmp.name + '/served/file.bin', expected_hash='nohash:00'))
+        self.assertRaises(download.IntegrityException, download.VerifyOrRaise, self.tmp.name + '/served/file.bin',
+                          None, 'nohash:00')
+
+    def test_size_mismatch_fails_fast(self):
+        with LocalServer(self.tmp.name + '/served') as server:
+            res = download.DownloadFile(server.url + '/file.bin', self.out, lambda n: None, expected_size=10)
+        self.assertEqual(res, (download.INTEGRITY_ERROR, 0))
+
+    def test_truncated_retried(self):
+        TruncatingHandler.requests = 0
+        with LocalServer(self.tmp.name + '/served', TruncatingHandler) as server:
+            res = download.DownloadFile(server.url + '/file.bin', self.out, lambda n: None, retries=2)
+        self.assertEqual(res[0], download.INTEGRITY_ERROR)
+        self.assertEqual(TruncatingHandler.requests, 3)
+        self.assertFalse(os.path.exists(self.out))
+
+
+class TestConditionalDownload(unittest.TestCase):
+    def test_not_modified(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(tmp + '/served')
+            served = tmp + '/served/master.zip'
+            with open(served, 'wb') as f:
+                f.write(b'first')
+            os.utime(served, (1000000000, 1000000000))
+            out = tmp + '/master.zip'
+            store = download.ValidatorStore(tmp + '/validators.json')
+            with LocalServer(tmp + '/served') as server:
+                url = server.url + '/master.zip'
+                self.assertEqual(download.DownloadFile(url, out, lambda n: None, validators=store), (200, 5))
+                self.assertIn('If-Modified-Since', store.conditional_headers(url, out))
+                # The store is persisted
+                store = download.ValidatorStore(tmp + '/validators.json')
+                self.assertEqual(download.DownloadFile(url, out, lambda n: None, validators=store),
+                                 (download.NOT_MODIFIED, 0))
+                self.assertEqual(asyncio.run(aiodownload.AsyncDownloadFile(url, out, lambda n: None,
+                                                                           validators=store)),
+                                 (download.NOT_MODIFIED, 0))
+
+                with open(served, 'wb') as f:
+                    f.write(b'second')
+                self.assertEqual(download.DownloadFile(url, out, lambda n: None, validators=store), (200, 6))
+                with open(out, 'rb') as f:
+                    self.assertEqual(f.read(), b'second')
+
+                # A local file that changed since is downloaded again
+                with open(out, 'wb') as f:
+                    f.write(b'local')
+                self.assertEqual(store.conditional_headers(url, out), {})
+
+
+class TestDownloadScheduler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(self.tmp.name + '/served')
+        with open(self.tmp.name + '/served/file.bin', 'wb') as f:
+            f.write(b'data')
+        self.out = self.tmp.name + '/out.bin'
+        self.delays = []
+        self.now = 0.0
+        FailingHandler.requests = 0
+        FailingHandler.failures = 0
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_scheduler(self, **kwargs):
+        return scheduler.DownloadScheduler(sleep=self.delays.append, rand=lambda: 1.0, clock=lambda: self.now,
+                                           backoff=1, **kwargs)
+
+    def test_retry_with_backoff(self):
+        FailingHandler.failures = 2
+        s = self.make_scheduler(retries=3)
+        with LocalServer(self.tmp.name + '/served', FailingHandler) as server:
+            res = s.download(server.url + '/file.bin', self.out)
+        self.assertEqual(res, (200, 4))
+        self.assertEqual(FailingHandler.requests, 3)
+        self.assertEqual(self.delays, [1, 2])
+
+    def test_download_keywords(self):
+        calls = []
+
+        # DownloadFile-compatible, with its optional parameters in another order
+        def download(url, filename, reporthook=None, expected_size=None, expected_hash=None, validators=None,
+                     retries=2):
+            calls.append((validators, retries))
+            return 200, 4
+
+        async def asyncdownload(*args, **kwargs):
+            return download(*args, **kwargs)
+
+        validators = unittest.mock.Mock()
+        s = self.make_scheduler(download=download, asyncdownload=asyncdownload, validators=validators)
+        s.download('http://127.0.0.1/file.bin', self.out)
+        asyncio.run(s.download_async('http://127.0.0.1/file.bin', self.out))
+        self.assertEqual(calls, [(validators, 0)] * 2)
+
+    def test_mirror_failover(self):
+        FailingHandler.failures = 100
+        s = self.make_scheduler(retries=1)
+        with LocalServer(self.tmp.name + '/served', FailingHandler) as failing, \
+                LocalServer(self.tmp.name + '/served') as mirror:
+            res = s.download([failing.url + '/missing.bin', failing.url + '/file.bin', mirror.url + '/file.bin'],
+                             self.out)
+        self.assertEqual(res, (200, 4))
+        self.assertEqual(FailingHandler.requests, 4)
+
+    def test_not_found_not_retried(self):
+        s = self.make_scheduler(retries=3)
+        with LocalServer(self.tmp.name + '/served', FailingHandler) as server:
+            res = s.download(server.url + '/missing.bin', self.out)
+            async_res = asyncio.run(s.download_async(server.url + '/missing.bin', self.out))
+        self.assertEqual((res, async_res), ((404, 0), (404, 0)))
+        self.assertEqual(FailingHandler.requests, 2)
+
+    def test_circuit_breaker(self):
+        FailingHandler.failures = 100
+        s = self.make_scheduler(retries=5, failure_threshold=3, cooldown=10)
+        with LocalServer(self.tmp.name + '/served', FailingHandler) as server:
+            self.assertEqual(s.download(server.url + '/file.bin', self.out)[0], 503)
+            self.assertEqual(FailingHandler.requests, 3)
+            s.download(server.url + '/file.bin', self.out)
+            self.assertEqual(FailingHandler.requests, 3)
+            # After the cooldown a single trial request is sent
+            self.now = 20
+            FailingHandler.failures = 0
+            self.assertEqual(s.download(server.url + '/file.bin', self.out), (200, 4))
+            self.assertEqual(FailingHandler.requests, 4)
+
+
+class TestLogs(unittest.TestCase):
+    def test_performance_mode(self):
+        log = logging.getLogger('packagemanager.test')
+        log.setLevel(logging.DEBUG)
+        try:
+            self.assertEqual(logs.tracing(log), __debug__)
+            logs.set_performance_mode()
+            self.assertFalse(logs.tracing(log))
+        finally:
+            logs.set_performance_mode(False)
+            log.setLevel(logging.NOTSET)
+
+    def test_level_disabled(self):
+        log = logging.getLogger('packagemanager.test')
+        log.setLevel(logging.INFO)
+        try:
+            self.assertFalse(logs.tracing(log))
+        finally:
+            log.setLevel(logging.NOTSET)
+
+
+class TestProgress(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.bus = progress.ProgressBus(interval=1.0, clock=lambda: self.now)
+        self.events = []
+        self.bus.subscribe(self.events.append)
+
+    def test_rate_limit_coalesces(self):
+        self.bus.publish('f', 'download', 1, 10)
+        self.bus.publish('f', 'download', 2, 10)
+        self.bus.publish('f', 'download', 3, 10)
+        self.assertEqual([e.current for e in self.events], [1])
+        self.now = 1.5
+        self.bus.publish('f', 'download', 4, 10)
+        self.assertEqual([e.current for e in self.events], [1, 4])
+        self.bus.publish('f', 'download', 5, 10)
+        self.bus.flush()
+        self.assertEqual([e.current for e in self.events], [1, 4, 5])
+
+    def test_done_always_dispatched(self):
+        self.bus.publish('f', 'extract', 0)
+        self.bus.publish('f', 'extract', 1, 1, done=True)
+        self.assertEqual([e.done for e in self.events], [False, True])
+        self.bus.flush()
+        self.assertEqual(len(self.events), 2)
+
+    def test_inactive_without_subscribers(self):
+        self.bus.unsubscribe(self.events.append)
+        self.assertFalse(self.bus.active)
+        self.bus.publish('f', 'download', 1)
+        self.assertEqual(self.events, [])
+
+    def test_download_and_merge_publish(self):
+        events = []
+        progress.bus.subscribe(events.append)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                os.makedirs(tmp + '/served')
+                with open(tmp + '/served/file.bin', 'wb') as f:
+                    f.write(os.urandom(100000))
+                with LocalServer(tmp + '/served') as server:
+                    code, n = download.DownloadFile(server.url + '/file.bin', tmp + '/out.bin')
+                self.assertEqual((code, n), (200, 100000))
+                os.makedirs(tmp + '/src/sub')
+                os.makedirs(tmp + '/dst/sub')
+                for f in ('a', 'sub/b', 'sub/c'):
+                    open(tmp + '/src/' + f, 'w').close()
+                Utils.MergeFolderTo(tmp + '/src', tmp + '/dst')
+        finally:
+            progress.bus.unsubscribe(events.append)
+        done = [(e.stage, e.current) for e in events if e.done]
+        self.assertEqual(done, [('download', 100000), ('merge', 3)])
+
+
 if __name__ == '__main__':
     log.info('Starting tests')
     unittest.main()